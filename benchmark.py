@@ -0,0 +1,382 @@
+"""
+benchmark.py
+Goal: measure ingestion and care-plan generation offline, and catch performance regressions
+
+Runs the real HTML conversion, loading, splitting, dedup, upsert, retrieval and care-plan
+code against stand-ins: deterministic fake embeddings, a fake chat model with configurable
+latency, an in-memory vector sink and a synthetic corpus of HTML pages, Markdown and PDF
+files. No API keys, network or Google Sheet are needed. Reports throughput and latency percentiles per stage, and with
+--baseline compares them to a stored run, exiting with an error on a regression.
+
+    python benchmark.py --save-baseline     # record this machine's baseline
+    python benchmark.py                     # compare against it
+"""
+
+# Import statements
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import argparse
+import tempfile
+import itertools
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# Code from other files:
+import main
+import process_documents
+import initial_retrieval
+from local_vector_store import LocalVectorStore, LocalVectorSink
+from context_packing import ContextPacker
+from chunk_dedup import ChunkDeduplicator
+from compare_generation_modes import make_fake_chat
+
+# Configuration
+BENCHMARK_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+REGRESSION_TOLERANCE = 0.25  # Allowed throughput drop / latency rise before a stage counts as regressed
+REPEATS = 3  # Rounds per run; each stage keeps its best round, which damps noise from the machine
+MIN_LATENCY_MS = 1.0  # p95 latencies below this are too noisy to compare
+SEED = 7
+EMBEDDING_DIMENSIONS = 256
+
+WORDS = ("frailty patient gait speed balance mobility aid walker caregiver home safety falls assessment "
+         "strength exercise nutrition cognition medication review social support community program risk "
+         "independence hospital discharge physiotherapy occupational therapy monitoring prevention older "
+         "adults screening questionnaire timed up and go test muscle weakness fatigue weight loss").split()
+
+
+# --------- Stand-ins ---------
+
+class FakeEmbeddings(Embeddings):
+    """
+    Deterministic embeddings: each text maps to a fixed pseudo-random unit vector seeded by
+    its hash, with an optional delay per call to stand in for the API round trip.
+    """
+    def __init__(self, dimensions=EMBEDDING_DIMENSIONS, delay=0.0):
+        self.dimensions = dimensions
+        self.delay = delay
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dimensions)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        if self.delay:
+            time.sleep(self.delay)
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+
+# --------- Synthetic corpus ---------
+
+def paragraph(rng, sentences=6):
+    return " ".join(
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 20))).capitalize() + "."
+        for _ in range(sentences)
+    )
+
+def write_pdf(path, lines, lines_per_page=45):
+    """
+    Write a minimal text PDF (Helvetica, one text block per page) without any PDF library.
+    """
+    pages = [lines[start:start + lines_per_page] for start in range(0, len(lines), lines_per_page)] or [[]]
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for page in pages:
+        text = " ".join("(" + line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ") '" for line in page)
+        content = f"BT /F1 10 Tf 14 TL 40 800 Td {text} ET"
+        objects.append(f"<< /Length {len(content)} >>\nstream\n{content}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {len(objects)} 0 R "
+                       f"/Resources << /Font << /F1 3 0 R >> >> >>")
+        page_ids.append(len(objects))
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] /Count {len(page_ids)} >>"
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    output += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("latin-1")
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    with open(path, "wb") as f:
+        f.write(output)
+
+def generate_html_page(rng, paragraphs):
+    """
+    A downloaded-page stand-in: the article between a large navigation menu, inline scripts
+    and a footer, with no declared charset, as UTF-8 bytes.
+    """
+    menu = "".join(f'<li><a href="/topic/{i}">{rng.choice(WORDS)} {rng.choice(WORDS)}</a></li>' for i in range(200))
+    script = "".join(f"window.analytics{i} = {{id: {i}, track: true}};" for i in range(500))
+    article = "".join(f'<h2>Section {j}</h2><p>{paragraph(rng)} See <a href="https://example.org/ref/{j}">the guidance</a>.</p>'
+                      for j in range(paragraphs))
+    return (f"<!DOCTYPE html><html><head><title>Frailty care \u2013 caf\u00e9 guide</title><script>{script}</script></head>"
+            f"<body><nav><ul>{menu}</ul></nav><main><h1>Frailty care</h1>{article}</main>"
+            f"<footer><ul>{menu}</ul></footer></body></html>").encode("utf-8")
+
+def generate_corpus(directory, markdown_files, pdf_files, paragraphs, seed=SEED):
+    """
+    Write markdown_files Markdown pages and pdf_files PDFs of synthetic frailty-care text,
+    each with paragraphs paragraphs. Returns the number of bytes written.
+    """
+    rng = random.Random(seed)
+    total_bytes = 0
+    for i in range(markdown_files):
+        path = os.path.join(directory, f"page_{i:05d}.md")
+        body = "\n\n".join(f"## Section {j}\n\n{paragraph(rng)}" for j in range(paragraphs))
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"<!-- Source URL: https://example.org/page/{i} -->\n\n# Page {i}\n\n{body}\n")
+        total_bytes += os.path.getsize(path)
+    for i in range(pdf_files):
+        path = os.path.join(directory, f"paper_{i:05d}.pdf")
+        words = " ".join(paragraph(rng) for _ in range(paragraphs)).split()
+        write_pdf(path, [" ".join(words[start:start + 12]) for start in range(0, len(words), 12)])
+        total_bytes += os.path.getsize(path)
+    return total_bytes
+
+
+# --------- Measuring ---------
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def stage_result(items, seconds, latencies=None):
+    """
+    Throughput (items/sec) plus, when per-item latencies were timed, their p50/p95/p99 in milliseconds.
+    """
+    result = {"items": items, "seconds": seconds, "throughput": items / seconds if seconds > 0 else 0.0}
+    if latencies:
+        for name, fraction in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+            result[name] = percentile(latencies, fraction) * 1000.0
+    return result
+
+def timed_each(function, items):
+    """
+    Call function on every item; returns (results, total seconds, per-call latencies).
+    """
+    results = []
+    latencies = []
+    start = time.perf_counter()
+    for item in items:
+        call_start = time.perf_counter()
+        results.append(function(item))
+        latencies.append(time.perf_counter() - call_start)
+    return results, time.perf_counter() - start, latencies
+
+def random_input_data(rng):
+    return main.build_input_data(
+        rng.uniform(0.3, 7.0), rng.uniform(5, 300), rng.uniform(5, 300), rng.choice(main.RISK_LEVELS),
+        rng.uniform(0.3, 7.0), rng.uniform(5, 300), rng.uniform(5, 300), rng.choice(main.RISK_LEVELS),
+        *(rng.random() < 0.5 for _ in main.PRISMA_QUESTIONS)
+    )
+
+
+def run_benchmark(markdown_files=200, pdf_files=0, paragraphs=12, requests=50, chat_token_delay=0.0,
+                  embed_delay=0.0, load_workers=1, html_pages=20, html_paragraphs=300, seed=SEED):
+    """
+    Run every stage once on a fresh synthetic corpus and return {"config", "stages"}.
+    """
+    config = dict(markdown_files=markdown_files, pdf_files=pdf_files, paragraphs=paragraphs, requests=requests,
+                  chat_token_delay=chat_token_delay, embed_delay=embed_delay, load_workers=load_workers,
+                  html_pages=html_pages, html_paragraphs=html_paragraphs, seed=seed)
+    stages = {}
+    rng = random.Random(seed)
+
+    # Converting downloaded pages: charset detection, then HTML to Markdown
+    if html_pages:
+        pages = [generate_html_page(rng, html_paragraphs) for _ in range(html_pages)]
+        print(f"HTML: {html_pages} pages, {sum(map(len, pages)) / 1024:.0f} KiB")
+        _, seconds, latencies = timed_each(
+            lambda body: initial_retrieval.html_to_markdown(initial_retrieval.decode_body(body, "text/html")), pages)
+        stages["convert.html"] = stage_result(len(pages), seconds, latencies)
+    with tempfile.TemporaryDirectory() as workspace:
+        downloads = os.path.join(workspace, "downloads")
+        os.makedirs(downloads)
+        corpus_bytes = generate_corpus(downloads, markdown_files, pdf_files, paragraphs, seed)
+        print(f"Corpus: {markdown_files} Markdown + {pdf_files} PDF files, {corpus_bytes / 1024:.0f} KiB")
+
+        # Loading, file by file, then through the streaming pipeline with its worker pool
+        paths = [os.path.join(downloads, name) for name in process_documents.list_document_files(downloads)]
+        for kind, suffix in (("markdown", ".md"), ("pdf", ".pdf")):
+            kind_paths = [path for path in paths if path.endswith(suffix)]
+            if kind_paths:
+                results, seconds, latencies = timed_each(
+                    lambda path: process_documents.load_file(path, "https://example.org/" + os.path.basename(path)), kind_paths)
+                stages[f"load.{kind}"] = stage_result(len(kind_paths), seconds, latencies)
+                failed = sum(1 for status, _, _, _ in results if status != "processed")
+                if failed:
+                    print(f"Warning: {failed} {kind} files failed to load (are the loaders installed?)")
+        start = time.perf_counter()
+        document_batches = [documents for _, documents in process_documents.iter_documents(downloads, workers=load_workers)]
+        stages["load.pipeline"] = stage_result(len(document_batches), time.perf_counter() - start)
+
+        # Splitting, file by file
+        splitter = process_documents.make_text_splitter()
+        chunk_batches, seconds, latencies = timed_each(splitter.split_documents, document_batches)
+        chunks = list(itertools.chain.from_iterable(chunk_batches))
+        stages["split"] = stage_result(len(chunks), seconds, latencies)
+
+        # Duplicate detection between the splitter and the upsert engine
+        dedup = ChunkDeduplicator(workspace, "benchmark")
+        start = time.perf_counter()
+        for chunk in chunks:
+            dedup.resolve(process_documents.chunk_id(chunk), chunk, chunk.metadata["source"])
+        stages["dedup"] = stage_result(len(chunks), time.perf_counter() - start)
+
+        # Embedding and upserting through the upsert engine
+        embeddings = FakeEmbeddings(delay=embed_delay)
+        sink = process_documents.InMemoryVectorSink()
+        start = time.perf_counter()
+        engine = process_documents.UpsertEngine(sink, embeddings)
+        for chunk in chunks:
+            engine.add(process_documents.chunk_id(chunk), chunk)
+        engine.close()
+        stages["upsert"] = stage_result(engine.upserted_chunks, time.perf_counter() - start)
+
+        # Retrieval against the local vector store built from the upserted vectors
+        index_dir = os.path.join(workspace, "index")
+        local_sink = LocalVectorSink(index_dir, reset=True)
+        local_sink.upsert([(record_id, vector, text, metadata) for record_id, (vector, text, metadata) in sink.vectors.items()])
+        local_sink.close()
+        store = LocalVectorStore(index_dir, embeddings)
+        inputs = [random_input_data(rng) for _ in range(requests)]
+        _, seconds, latencies = timed_each(
+            lambda input_data: store.similarity_search(main.retrieval_query(input_data), k=main.RETRIEVAL_K), inputs)
+        stages["retrieval"] = stage_result(len(inputs), seconds, latencies)
+
+        # Care plans: the engine's orchestration around a fake chat model
+        care_plan_engine = main.CarePlanEngine(
+            chat=make_fake_chat(chat_token_delay),
+            retriever=store.as_retriever(search_type="similarity", search_kwargs={"k": main.RETRIEVAL_K}),
+            context_table=False,
+            context_packer=ContextPacker(count_tokens=estimate_tokens),
+        )
+        _, seconds, latencies = timed_each(care_plan_engine.generate, inputs)
+        stages["care_plan.generate"] = stage_result(len(inputs), seconds, latencies)
+        start = time.perf_counter()
+        results = asyncio.run(care_plan_engine.agenerate_batch(inputs))
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            raise errors[0]
+        stages["care_plan.batch"] = stage_result(len(inputs), time.perf_counter() - start)
+
+    return {"config": config, "stages": stages}
+
+
+def best_of(results):
+    """
+    Merge rounds of run_benchmark: per stage, the highest throughput and lowest latencies seen.
+    """
+    merged = {"config": results[0]["config"], "stages": {}}
+    for stage in results[0]["stages"]:
+        rounds = [result["stages"][stage] for result in results]
+        best = dict(max(rounds, key=lambda current: current["throughput"]))
+        for name in ("p50_ms", "p95_ms", "p99_ms"):
+            if name in best:
+                best[name] = min(current[name] for current in rounds)
+        merged["stages"][stage] = best
+    return merged
+
+
+# --------- Baseline comparison ---------
+
+def compare(result, baseline, tolerance=REGRESSION_TOLERANCE):
+    """
+    Compare each stage with the baseline. Returns a list of regression messages.
+    """
+    regressions = []
+    for stage, current in result["stages"].items():
+        previous = baseline["stages"].get(stage)
+        if previous is None:
+            continue
+        if previous["throughput"] and current["throughput"] < previous["throughput"] * (1 - tolerance):
+            regressions.append(f"{stage}: throughput {current['throughput']:.1f}/s, "
+                               f"baseline {previous['throughput']:.1f}/s")
+        if ("p95_ms" in current and "p95_ms" in previous and previous["p95_ms"] >= MIN_LATENCY_MS
+                and current["p95_ms"] > previous["p95_ms"] * (1 + tolerance)):
+            regressions.append(f"{stage}: p95 latency {current['p95_ms']:.2f}ms, baseline {previous['p95_ms']:.2f}ms")
+    return regressions
+
+def print_report(result, baseline=None):
+    print(f"{'stage':22}{'items':>8}{'items/sec':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'vs baseline':>14}")
+    for stage, current in result["stages"].items():
+        previous = (baseline or {}).get("stages", {}).get(stage)
+        change = f"{(current['throughput'] / previous['throughput'] - 1) * 100:+.1f}%" if previous and previous["throughput"] else ""
+        latencies = "".join(f"{current[name]:>10.2f}" if name in current else f"{'-':>10}" for name in ("p50_ms", "p95_ms", "p99_ms"))
+        print(f"{stage:22}{current['items']:>8}{current['throughput']:>12.1f}{latencies}{change:>14}")
+
+
+# Run from the command line
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark of ingestion and care-plan generation.")
+    parser.add_argument("--markdown-files", type=int, default=200)
+    parser.add_argument("--pdf-files", type=int, default=0, help="PDFs need the langchain_community PDF loaders")
+    parser.add_argument("--paragraphs", type=int, default=12, help="Paragraphs per synthetic file")
+    parser.add_argument("--requests", type=int, default=50, help="Retrieval queries and care plans")
+    parser.add_argument("--chat-token-delay", type=float, default=0.0, help="Fake chat model seconds per token")
+    parser.add_argument("--embed-delay", type=float, default=0.0, help="Fake embeddings seconds per call")
+    parser.add_argument("--load-workers", type=int, default=1)
+    parser.add_argument("--html-pages", type=int, default=20, help="Synthetic downloaded pages to convert")
+    parser.add_argument("--html-paragraphs", type=int, default=300, help="Paragraphs per synthetic page")
+    parser.add_argument("--repeats", type=int, default=REPEATS, help="Rounds to run; each stage keeps its best")
+    parser.add_argument("--baseline", default=BENCHMARK_BASELINE, help="Baseline JSON to compare against or save to")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    parser.add_argument("--output", help="Also write this run's results to a JSON file")
+    args = parser.parse_args()
+
+    # Keep per-file progress logs out of the report
+    for name in ("process_documents", "main", "context_packing"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    result = best_of([
+        run_benchmark(args.markdown_files, args.pdf_files, args.paragraphs, args.requests,
+                      args.chat_token_delay, args.embed_delay, args.load_workers,
+                      args.html_pages, args.html_paragraphs)
+        for _ in range(args.repeats)
+    ])
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print_report(result)
+        print(f"Saved baseline to {args.baseline}")
+        sys.exit(0)
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["config"] != result["config"]:
+            print_report(result)
+            print(f"Baseline {args.baseline} was recorded with different settings: {baseline['config']}")
+            sys.exit(2)
+    print_report(result, baseline)
+    if baseline is None:
+        print(f"No baseline at {args.baseline}; run with --save-baseline to record one.")
+        sys.exit(0)
+
+    regressions = compare(result, baseline, args.tolerance)
+    if regressions:
+        print("\nPERFORMANCE REGRESSION (more than {:.0%} worse than baseline):".format(args.tolerance))
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print("\nNo regressions against the baseline.")
@@ -0,0 +1,191 @@
+"""
+bulk_care_plans.py
+Goal: generate care plans for a whole file of PRISMA-7 and Gait/TUG assessments (CSV or JSONL)
+
+Identical patient profiles are generated only once. Results are written to the output file as
+they finish, and every generated care plan is kept in a checkpoint file next to it, so a run
+that crashes can be started again with the same arguments and resumes where it stopped.
+"""
+
+# Import statements
+import os
+import csv
+import json
+import inspect
+import argparse
+import itertools
+
+# Code from other files:
+import main
+from openai_scheduler import BATCH, request_priority
+
+# Configuration
+BULK_BATCH_SIZE = 50  # Input rows read, generated and written per step
+CHECKPOINT_SUFFIX = '.profiles.jsonl'  # Generated care plans by profile key, next to the output file
+TRUE_VALUES = {'yes', 'y', 'true', 't', '1'}
+FALSE_VALUES = {'no', 'n', 'false', 'f', '0'}
+
+ASSESSMENT_FIELDS = inspect.signature(main.build_input_data).parameters
+
+
+# --------- Reading assessments ---------
+
+def parse_value(field, value):
+    """
+    Convert a raw CSV/JSON value to the type generate_frailty_care_plan expects for the field.
+    """
+    annotation = ASSESSMENT_FIELDS[field].annotation
+    if annotation is bool:
+        if isinstance(value, bool):
+            return value
+        text = str(value).strip().lower()
+        if text in TRUE_VALUES:
+            return True
+        if text in FALSE_VALUES:
+            return False
+        raise ValueError(f"Cannot read {field}={value!r} as yes/no")
+    if annotation is float:
+        return float(value)
+    return str(value).strip()
+
+def parse_assessment(record):
+    """
+    Pick the assessment fields out of an input record; other columns (e.g. an id) are ignored.
+    """
+    missing = [field for field in ASSESSMENT_FIELDS if field not in record]
+    if missing:
+        raise ValueError(f"Missing fields: {', '.join(missing)}")
+    return {field: parse_value(field, record[field]) for field in ASSESSMENT_FIELDS}
+
+def read_records(input_path):
+    """
+    Stream input records (dicts) from a CSV file with a header row, or from a JSONL file.
+    """
+    # utf-8-sig drops the byte order mark Excel writes, which would otherwise become part of the first header
+    with open(input_path, 'r', encoding='utf-8-sig', newline='') as f:
+        if input_path.lower().endswith(('.jsonl', '.json')):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+
+
+# --------- Checkpointing ---------
+
+def load_checkpoint(checkpoint_path):
+    """
+    Care plans already generated, by profile key.
+    """
+    care_plans = {}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A crash mid-write can leave a partial last line
+                    continue
+                care_plans[entry['profile']] = entry['care_plan']
+    return care_plans
+
+def count_written_rows(output_path):
+    """
+    Number of complete rows in the output file. A partial last line left by a crash is removed.
+    """
+    if not os.path.exists(output_path):
+        return 0
+    with open(output_path, 'rb+') as f:
+        data = f.read()
+        complete = data.rfind(b'\n') + 1
+        if complete < len(data):
+            f.truncate(complete)
+    return data[:complete].count(b'\n')
+
+
+# --------- Bulk run ---------
+
+def run_bulk(input_path, output_path, max_concurrency=main.BATCH_MAX_CONCURRENCY, batch_size=BULK_BATCH_SIZE, engine=None):
+    """
+    Generate a care plan for every assessment in input_path and write one JSON line per input
+    row to output_path: {"row", "id", "profile", "care_plan", "error"}. Returns a summary dict.
+    Rows that fail are written with their error and are not retried on resume.
+    """
+    checkpoint_path = output_path + CHECKPOINT_SUFFIX
+    care_plans = load_checkpoint(checkpoint_path)
+    rows_done = count_written_rows(output_path)
+    summary = {"rows": rows_done, "resumed_rows": rows_done, "generated": 0, "reused": 0, "errors": 0}
+    if rows_done:
+        print(f"Resuming after {rows_done} rows, with {len(care_plans)} care plans already generated")
+
+    records = itertools.islice(enumerate(read_records(input_path)), rows_done, None)
+    with open(output_path, 'a', encoding='utf-8') as output, open(checkpoint_path, 'a', encoding='utf-8') as checkpoint:
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+
+            # Work out each row's profile, and which profiles still need generating
+            rows = []
+            to_generate = {}
+            for row, record in batch:
+                try:
+                    input_data = main.build_input_data(**parse_assessment(record))
+                    key = main.profile_key(input_data)
+                    if key not in care_plans:
+                        to_generate[key] = input_data
+                    rows.append((row, record, key, None))
+                except Exception as e:
+                    rows.append((row, record, None, f"Invalid assessment: {e}"))
+
+            # Generate each new profile once, and checkpoint it before anything refers to it
+            errors = {}
+            if to_generate:
+                engine = engine or main.get_engine()
+                with request_priority(BATCH):
+                    # Every batch runs on the same event loop, which the engine's async clients are bound to
+                    results = main.run_in_engine_loop(engine.agenerate_batch(list(to_generate.values()), max_concurrency))
+                for key, result in zip(to_generate, results):
+                    if isinstance(result, Exception):
+                        errors[key] = f"{type(result).__name__}: {result}"
+                        continue
+                    care_plans[key] = result
+                    checkpoint.write(json.dumps({"profile": key, "care_plan": result}) + '\n')
+                    summary["generated"] += 1
+                checkpoint.flush()
+
+            first_rows = set()
+            for row, record, key, error in rows:
+                error = error or errors.get(key)
+                if error:
+                    summary["errors"] += 1
+                elif key in to_generate and key not in first_rows:
+                    first_rows.add(key)
+                else:
+                    summary["reused"] += 1
+                output.write(json.dumps({
+                    "row": row,
+                    "id": record.get("id") if isinstance(record, dict) else None,
+                    "profile": key,
+                    "care_plan": None if error else care_plans[key],
+                    "error": error,
+                }) + '\n')
+            output.flush()
+            summary["rows"] += len(rows)
+            print(f"Wrote {summary['rows']} rows ({summary['generated']} care plans generated, {summary['reused']} reused)")
+
+    return summary
+
+
+# Run from the command line
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate care plans for a CSV or JSONL file of assessments.")
+    parser.add_argument("input", help="CSV (with a header row) or JSONL file of assessments")
+    parser.add_argument("output", help="JSONL file to write results to; re-run with the same path to resume")
+    parser.add_argument("--concurrency", type=int, default=main.BATCH_MAX_CONCURRENCY, help="Care plans generated at once")
+    parser.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE, help="Input rows processed per step")
+    args = parser.parse_args()
+
+    summary = run_bulk(args.input, args.output, args.concurrency, args.batch_size)
+    print(f"Done: {summary['rows']} rows, {summary['generated']} care plans generated, "
+          f"{summary['reused']} reused, {summary['errors']} errors")
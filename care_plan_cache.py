@@ -0,0 +1,210 @@
+"""
+care_plan_cache.py
+Goal: reuse care plans for patients whose assessments produce the same profile
+"""
+
+# Import Statements:
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Configuration
+CARE_PLAN_CACHE_ENABLED = os.environ.get("CARE_PLAN_CACHE_ENABLED", "1") == "1"
+CARE_PLAN_CACHE_PATH = os.environ.get(
+    "CARE_PLAN_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.care_plan_cache.sqlite'),
+)
+CARE_PLAN_CACHE_TTL = float(os.environ.get("CARE_PLAN_CACHE_TTL", str(7 * 24 * 3600)))  # Seconds
+CARE_PLAN_CACHE_MEMORY_ENTRIES = int(os.environ.get("CARE_PLAN_CACHE_MEMORY_ENTRIES", "1024"))
+CARE_PLAN_CACHE_DISK_ENTRIES = int(os.environ.get("CARE_PLAN_CACHE_DISK_ENTRIES", "100000"))
+VERSION_CHECK_INTERVAL = 60  # Seconds between re-checks of the index/prompt version
+
+
+def parse_buckets(text):
+    """
+    Parse "field=size,field=size" (e.g. "first_gait_test_speed=0.5,first_tug_test_time=10") into {field: size}.
+    """
+    buckets = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        field, separator, size = item.partition("=")
+        if not separator or float(size) <= 0:
+            raise ValueError(f"Invalid care-plan cache bucket {item!r}; expected field=size with size > 0")
+        buckets[field.strip()] = float(size)
+    return buckets
+
+# Round these readings to buckets before keying, so nearby readings share a care plan; empty for exact matching
+CARE_PLAN_CACHE_BUCKETS = parse_buckets(os.environ.get("CARE_PLAN_CACHE_BUCKETS", ""))
+
+
+def bucket_value(value, size):
+    """
+    Round a reading to the nearest multiple of size, e.g. 6.349 with size 0.5 -> 6.5.
+    """
+    return round(round(float(value) / size) * size, 6)
+
+def canonical_profile(assessment, buckets=None):
+    """
+    Canonical JSON form of an assessment (generate_frailty_care_plan's keyword arguments).
+    Numeric readings named in buckets ({field: bucket size}) are rounded to their bucket,
+    so nearby readings share a cache entry; all other values are kept exactly.
+    """
+    buckets = buckets or {}
+    profile = {
+        field: bucket_value(value, buckets[field]) if field in buckets else value
+        for field, value in assessment.items()
+    }
+    return json.dumps(profile, sort_keys=True, separators=(",", ":"))
+
+
+class CarePlanCache:
+    """
+    Two-tier care-plan cache keyed by the canonical patient profile: an in-memory LRU in
+    front of a SQLite table on disk. Entries expire after ttl seconds and are dropped when
+    version() changes (e.g. the index was re-ingested or the prompts were edited). While
+    version() returns None (unknown) nothing is read from or written to the cache.
+    Counts memory hits, disk hits and misses.
+    """
+    def __init__(self, version=lambda: "", path=CARE_PLAN_CACHE_PATH, ttl=CARE_PLAN_CACHE_TTL,
+                 memory_entries=CARE_PLAN_CACHE_MEMORY_ENTRIES, disk_entries=CARE_PLAN_CACHE_DISK_ENTRIES,
+                 buckets=CARE_PLAN_CACHE_BUCKETS):
+        self.version_function = version
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.buckets = buckets or {}
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._version = None
+        self._version_checked = 0.0
+        self.connection = None
+        if path:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS care_plans ("
+                "key TEXT PRIMARY KEY, version TEXT NOT NULL, created_at REAL NOT NULL, care_plan TEXT NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS care_plans_created_at ON care_plans (created_at)")
+            self.connection.commit()
+
+    def key(self, assessment, variant=""):
+        """
+        Cache key for an assessment. variant separates care plans made with different
+        generation settings (see CarePlanEngine.cache_variant) for the same profile.
+        """
+        return hashlib.sha256((canonical_profile(assessment, self.buckets) + "\n" + variant).encode("utf-8")).hexdigest()
+
+    def version(self):
+        """
+        Current index/prompt version, re-read at most every VERSION_CHECK_INTERVAL seconds.
+        A change empties the memory tier; stale disk rows are skipped and overwritten.
+        """
+        now = time.monotonic()
+        if not self._version_checked or now - self._version_checked > VERSION_CHECK_INTERVAL:
+            version = self.version_function()
+            with self.lock:
+                if version != self._version:
+                    self.memory.clear()
+                self._version = version
+                self._version_checked = now
+        return self._version
+
+    def get(self, key):
+        version = self.version()
+        now = time.time()
+        if version is None:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.memory[key]
+            if self.connection is not None:
+                row = self.connection.execute(
+                    "SELECT created_at, care_plan FROM care_plans WHERE key = ? AND version = ?", (key, version)
+                ).fetchone()
+                if row is not None and now - row[0] <= self.ttl:
+                    self._remember(key, row[0], row[1])
+                    self.disk_hits += 1
+                    return row[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, care_plan):
+        version = self.version()
+        now = time.time()
+        if version is None:
+            return
+        with self.lock:
+            self._remember(key, now, care_plan)
+            if self.connection is not None:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO care_plans (key, version, created_at, care_plan) VALUES (?, ?, ?, ?)",
+                    (key, version, now, care_plan),
+                )
+                # Drop expired and stale-version rows, then the oldest rows beyond the size limit
+                self.connection.execute("DELETE FROM care_plans WHERE created_at < ? OR version != ?", (now - self.ttl, version))
+                self.connection.execute(
+                    "DELETE FROM care_plans WHERE key IN (SELECT key FROM care_plans ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.disk_entries,),
+                )
+                self.connection.commit()
+
+    def _remember(self, key, created_at, care_plan):
+        self.memory[key] = (created_at, care_plan)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_generate(self, assessment, generate, variant=""):
+        """
+        Return the cached care plan for the assessment, or call generate() and cache its result.
+        """
+        key = self.key(assessment, variant)
+        care_plan = self.get(key)
+        if care_plan is None:
+            care_plan = generate()
+            self.put(key, care_plan)
+        return care_plan
+
+    async def aget_or_generate(self, assessment, agenerate, variant=""):
+        key = self.key(assessment, variant)
+        care_plan = self.get(key)
+        if care_plan is None:
+            care_plan = await agenerate()
+            self.put(key, care_plan)
+        return care_plan
+
+    def invalidate(self):
+        """
+        Drop every cached care plan.
+        """
+        with self.lock:
+            self.memory.clear()
+            if self.connection is not None:
+                self.connection.execute("DELETE FROM care_plans")
+                self.connection.commit()
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,239 @@
+"""
+chunk_dedup.py
+Goal: embed and store each passage once, even when mirrored or syndicated sources repeat it
+
+Runs between the text splitter and the upsert engine. A chunk whose normalized text was seen
+before (exact hash), or whose MinHash signature estimates a word-shingle Jaccard similarity of
+at least CHUNK_DEDUP_THRESHOLD with a kept chunk, is not embedded; the kept chunk records its
+source URL instead, so "Sources used" still lists every page the passage came from.
+"""
+
+# Import Statements:
+import os
+import re
+import json
+import hashlib
+import logging
+import numpy as np
+
+# Code from other files:
+from context_packing import shingles
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+CHUNK_DEDUP_ENABLED = os.environ.get("CHUNK_DEDUP_ENABLED", "1") == "1"
+CHUNK_DEDUP_THRESHOLD = float(os.environ.get("CHUNK_DEDUP_THRESHOLD", "0.85"))  # Estimated Jaccard similarity of word shingles
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16  # LSH bands of MINHASH_PERMUTATIONS / MINHASH_BANDS rows; pairs above ~0.5 similarity become candidates
+MINHASH_SEED = 1
+MERSENNE_PRIME = (1 << 61) - 1
+CHUNK_DEDUP_FILE = '.chunk_dedup.{index_name}.json'  # Lives inside the downloads directory
+
+
+def normalized_text(text):
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+def exact_key(text):
+    return hashlib.sha256(normalized_text(text).encode('utf-8')).hexdigest()
+
+_rng = np.random.default_rng(MINHASH_SEED)
+_coefficients = _rng.integers(1, 1 << 31, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+_offsets = _rng.integers(0, 1 << 31, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+def minhash(text_shingles, permutations=MINHASH_PERMUTATIONS):
+    """
+    MinHash signature (uint32 array) of a non-empty set of word shingles. Shingles are hashed
+    with blake2b rather than hash(), so signatures stay comparable across runs.
+    """
+    hashes = np.array([int.from_bytes(hashlib.blake2b(" ".join(shingle).encode('utf-8'), digest_size=4).digest(), 'little')
+                       for shingle in text_shingles], dtype=np.uint64)
+    # (a * x + b) mod p with a, b < 2**31 and x < 2**32 cannot overflow 64 bits
+    values = (np.outer(hashes, _coefficients[:permutations]) + _offsets[:permutations]) % np.uint64(MERSENNE_PRIME)
+    return (values & np.uint64(0xFFFFFFFF)).min(axis=0).astype(np.uint32)
+
+def similarity(first, second):
+    """
+    Estimated Jaccard similarity of two MinHash signatures.
+    """
+    return float(np.mean(first == second))
+
+
+class ChunkDeduplicator:
+    """
+    Persistent record, for one index, of the chunks that were kept ("canonical" chunks):
+    their exact-text hash, MinHash signature and, per file that produced them, the source URL.
+    resolve() maps every new chunk to the canonical chunk it duplicates, or registers it as
+    a new canonical chunk. Canonical chunks whose source list changed are collected for
+    source_updates(), so their "sources" metadata can be rewritten in the index.
+    """
+    def __init__(self, directory, index_name, threshold=CHUNK_DEDUP_THRESHOLD,
+                 permutations=MINHASH_PERMUTATIONS, bands=MINHASH_BANDS):
+        self.path = os.path.join(directory, CHUNK_DEDUP_FILE.format(index_name=index_name))
+        self.threshold = threshold
+        self.permutations = permutations
+        self.bands = bands
+        self.rows = permutations // bands
+        self.settings = f"minhash {permutations}x{bands} >= {threshold}"
+        self.chunks = {}
+        self.exact = {}
+        self.buckets = {}
+        self.file_chunks = {}
+        self.dirty = set()
+        self.seen = 0
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+        self.duplicate_bytes = 0
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('settings') == self.settings:
+                    for record_id, entry in data.get('chunks', {}).items():
+                        signature = (np.frombuffer(bytes.fromhex(entry['signature']), dtype='<u4').astype(np.uint32)
+                                     if entry['signature'] else None)
+                        self._register(record_id, entry['source'], entry['exact'], signature, entry['files'])
+                    self.dirty = set(data.get('dirty', [])) & set(self.chunks)
+            except Exception as e:
+                logger.warning(f"Ignoring unreadable chunk dedup index {self.path}: {e}")
+                self.reset()
+
+    def _band_keys(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def _register(self, record_id, source, exact, signature, files):
+        self.chunks[record_id] = {'source': source, 'exact': exact, 'signature': signature, 'files': dict(files)}
+        self.exact.setdefault(exact, record_id)
+        if signature is not None:
+            for key in self._band_keys(signature):
+                self.buckets.setdefault(key, set()).add(record_id)
+        for filename in files:
+            self.file_chunks.setdefault(filename, set()).add(record_id)
+
+    def _unregister(self, record_id):
+        entry = self.chunks.pop(record_id)
+        if self.exact.get(entry['exact']) == record_id:
+            del self.exact[entry['exact']]
+        if entry['signature'] is not None:
+            for key in self._band_keys(entry['signature']):
+                bucket = self.buckets.get(key)
+                if bucket is not None:
+                    bucket.discard(record_id)
+                    if not bucket:
+                        del self.buckets[key]
+        self.dirty.discard(record_id)
+
+    def _near_duplicate(self, signature):
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates |= self.buckets.get(key, set())
+        best, best_similarity = None, self.threshold
+        for record_id in candidates:
+            score = similarity(signature, self.chunks[record_id]['signature'])
+            if score >= best_similarity:
+                best, best_similarity = record_id, score
+        return best
+
+    def forget_file(self, filename):
+        """
+        Drop what a file contributed, before it is re-ingested or after it was removed.
+        Canonical chunks no other file uses are forgotten; their vectors go with the file's ledger entry.
+        """
+        for record_id in self.file_chunks.pop(filename, set()):
+            entry = self.chunks.get(record_id)
+            if entry is None:
+                continue
+            entry['files'].pop(filename, None)
+            if entry['files']:
+                self.dirty.add(record_id)
+            else:
+                self._unregister(record_id)
+
+    def resolve(self, record_id, chunk, filename):
+        """
+        Return (id of the chunk to index for this chunk, whether that is another chunk it duplicates).
+        """
+        self.seen += 1
+        source = chunk.metadata.get('source', '')
+        duplicate = False
+        if record_id not in self.chunks:
+            text = chunk.page_content
+            exact = exact_key(text)
+            duplicate_of = self.exact.get(exact)
+            signature = None
+            if duplicate_of is not None:
+                self.exact_duplicates += 1
+            else:
+                # Chunks of a single shingle or less are only matched exactly
+                text_shingles = shingles(text)
+                signature = minhash(text_shingles, self.permutations) if len(text_shingles) > 1 else None
+                duplicate_of = self._near_duplicate(signature) if signature is not None else None
+                if duplicate_of is not None:
+                    self.near_duplicates += 1
+            if duplicate_of is None:
+                self._register(record_id, source, exact, signature, {filename: source})
+                return record_id, False
+            self.duplicate_bytes += len(text.encode('utf-8'))
+            record_id, duplicate = duplicate_of, True
+        if source not in self.sources(record_id):
+            self.dirty.add(record_id)
+        self.chunks[record_id]['files'][filename] = source
+        self.file_chunks.setdefault(filename, set()).add(record_id)
+        return record_id, duplicate
+
+    def sources(self, record_id):
+        """
+        The canonical chunk's own source first, then the sources of its duplicates; only
+        sources of files still in the corpus are listed.
+        """
+        entry = self.chunks[record_id]
+        sources = [entry['source']] if entry['source'] in entry['files'].values() else []
+        for source in entry['files'].values():
+            if source not in sources:
+                sources.append(source)
+        return sources
+
+    def source_updates(self, live_ids):
+        """
+        {id: {"sources": [...]}} for indexed canonical chunks whose sources changed since the last call.
+        """
+        updates = {record_id: {'sources': self.sources(record_id)}
+                   for record_id in self.dirty if record_id in self.chunks and record_id in live_ids}
+        self.dirty = set()
+        return updates
+
+    def report(self, dimensions=0):
+        """
+        Duplicates skipped this run and the embedding work and index space they would have taken:
+        about 4 bytes of text per token, and the text plus a float32 vector of `dimensions` per chunk.
+        """
+        duplicates = self.exact_duplicates + self.near_duplicates
+        return {
+            "chunks": self.seen,
+            "duplicates": duplicates,
+            "exact_duplicates": self.exact_duplicates,
+            "near_duplicates": self.near_duplicates,
+            "embedding_tokens_saved": self.duplicate_bytes // 4,
+            "index_bytes_saved": self.duplicate_bytes + duplicates * 4 * dimensions,
+        }
+
+    def reset(self):
+        self.chunks = {}
+        self.exact = {}
+        self.buckets = {}
+        self.file_chunks = {}
+        self.dirty = set()
+
+    def save(self):
+        data = {
+            'settings': self.settings,
+            'chunks': {record_id: {'source': entry['source'], 'exact': entry['exact'], 'files': entry['files'],
+                                   'signature': entry['signature'].astype('<u4').tobytes().hex() if entry['signature'] is not None else None}
+                       for record_id, entry in self.chunks.items()},
+            # Source lists not yet written to the index, e.g. after an interrupted run
+            'dirty': sorted(self.dirty),
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
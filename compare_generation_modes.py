@@ -0,0 +1,143 @@
+"""
+compare_generation_modes.py
+Goal: compare care-plan latency and second-stage token cost of single-call and sectioned generation, offline
+
+Uses stand-ins for the chat model and retriever: the fake model writes one word per token
+with a fixed delay per token, and a care plan takes as many tokens in one call as all of its
+sections together. No API keys or network are needed.
+"""
+
+# Import statements
+import time
+import asyncio
+import argparse
+import statistics
+
+# Code from other files:
+import main
+
+# Configuration
+TOKEN_DELAY = 0.005  # Seconds per generated token
+ANALYSIS_TOKENS = 150  # Tokens in the first invocation's analysis
+SECTION_TOKENS = [60, 80, 300, 120, 100, 100, 80]  # Tokens per section, in CARE_PLAN_SECTIONS order
+RUNS = 3
+
+
+def make_fake_chat(token_delay=TOKEN_DELAY, analysis_tokens=ANALYSIS_TOKENS, section_tokens=SECTION_TOKENS):
+    """
+    A LangChain chat model that answers after token_delay seconds per token. The length of the
+    answer depends on the prompt: the analysis, one section of the care plan, or the whole care plan.
+    """
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage, AIMessageChunk
+    from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+    def answer_tokens(messages):
+        prompt = messages[-1].content
+        if "<section>" in prompt:
+            section = next(i for i, text in enumerate(main.CARE_PLAN_SECTIONS) if text in prompt)
+            return [f"s{section}w{i}" for i in range(section_tokens[section])]
+        if "<analysis>" in prompt:
+            return [f"plan{i}" for i in range(sum(section_tokens))]
+        return [f"analysis{i}" for i in range(analysis_tokens)]
+
+    class SlowFakeChat(BaseChatModel):
+        @property
+        def _llm_type(self):
+            return "slow-fake-chat"
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            tokens = answer_tokens(messages)
+            time.sleep(token_delay * len(tokens))
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=" ".join(tokens)))])
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            tokens = answer_tokens(messages)
+            await asyncio.sleep(token_delay * len(tokens))
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=" ".join(tokens)))])
+
+        def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+            for i, token in enumerate(answer_tokens(messages)):
+                time.sleep(token_delay)
+                yield ChatGenerationChunk(message=AIMessageChunk(content=token if i == 0 else " " + token))
+
+        async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+            for i, token in enumerate(answer_tokens(messages)):
+                await asyncio.sleep(token_delay)
+                yield ChatGenerationChunk(message=AIMessageChunk(content=token if i == 0 else " " + token))
+
+    return SlowFakeChat()
+
+def make_fake_retriever():
+    from langchain_core.documents import Document
+    from langchain_core.retrievers import BaseRetriever
+
+    class FakeRetriever(BaseRetriever):
+        def _get_relevant_documents(self, query, *, run_manager=None):
+            return [Document(page_content=f"Frailty guidance {i}.", metadata={"source": f"https://example.org/{i}"})
+                    for i in range(main.RETRIEVAL_K)]
+
+    return FakeRetriever()
+
+def time_mode(sectioned, input_data, runs=RUNS, token_delay=TOKEN_DELAY):
+    """
+    Median latency (seconds) of generate, agenerate and streaming time-to-first-token for one mode.
+    """
+    engine = main.CarePlanEngine(chat=make_fake_chat(token_delay), retriever=make_fake_retriever(),
+                                 context_table=False, context_packer=False, sectioned=sectioned)
+    results = {"generate": [], "agenerate": [], "stream_first_token": [], "stream_total": []}
+    for _ in range(runs):
+        start = time.perf_counter()
+        engine.generate(input_data)
+        results["generate"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        asyncio.run(engine.agenerate(input_data))
+        results["agenerate"].append(time.perf_counter() - start)
+
+        timings = []
+        for _ in engine.stream(input_data, on_timing=timings.append):
+            pass
+        results["stream_first_token"].append(timings[0]["time_to_first_token"])
+        results["stream_total"].append(timings[0]["total"])
+    return {name: statistics.median(values) for name, values in results.items()}
+
+
+def second_call_tokens(sectioned, input_data, analysis_tokens=ANALYSIS_TOKENS, section_tokens=SECTION_TOKENS):
+    """
+    Prompt and completion tokens of the second invocation for one mode, summed over its calls.
+    Sectioned mode sends the input and analysis once per section, so its prompts cost more in total.
+    """
+    from context_packing import get_token_counter
+
+    engine = main.CarePlanEngine(chat=make_fake_chat(0), retriever=make_fake_retriever(),
+                                 context_table=False, context_packer=False, sectioned=sectioned)
+    analysis = " ".join(f"analysis{i}" for i in range(analysis_tokens))
+    prompts = (engine.section_invocation_inputs(input_data, analysis) if sectioned
+               else [engine.second_invocation_input(input_data, analysis)])
+    count_tokens = get_token_counter(main.CHAT_MODEL)
+    return {"prompt_tokens": sum(count_tokens(prompt) for prompt in prompts), "completion_tokens": sum(section_tokens)}
+
+
+# Run from the command line
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare single-call and sectioned care-plan generation with a fake chat model.")
+    parser.add_argument("--token-delay", type=float, default=TOKEN_DELAY, help="Seconds per generated token")
+    parser.add_argument("--runs", type=int, default=RUNS, help="Runs per mode; the median is reported")
+    args = parser.parse_args()
+
+    input_data = main.build_input_data(6.35, 230, 300, "High", 5.63, 200, 300, "High",
+                                       False, True, True, False, False, False, True)
+    single = time_mode(False, input_data, args.runs, args.token_delay)
+    sectioned = time_mode(True, input_data, args.runs, args.token_delay)
+
+    print(f"{'':22}{'single call':>14}{'sectioned':>14}{'speedup':>10}")
+    for name in single:
+        print(f"{name:22}{single[name]:>13.3f}s{sectioned[name]:>13.3f}s{single[name] / sectioned[name]:>9.2f}x")
+
+    single_tokens = second_call_tokens(False, input_data)
+    sectioned_tokens = second_call_tokens(True, input_data)
+    print(f"\n{'second call':22}{'single call':>14}{'sectioned':>14}{'cost':>10}")
+    for name in single_tokens:
+        print(f"{name:22}{single_tokens[name]:>14}{sectioned_tokens[name]:>14}"
+              f"{sectioned_tokens[name] / single_tokens[name]:>9.2f}x")
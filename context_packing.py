@@ -0,0 +1,178 @@
+"""
+context_packing.py
+Goal: assemble the retrieved chunks into a compact context before they are stuffed into the first prompt
+
+The splitter in process_documents makes 1000-character chunks that overlap by 200 characters,
+so the k retrieved chunks often repeat each other. Packing merges overlapping chunks from the
+same source, drops near-duplicates and keeps the context within a token budget.
+"""
+
+# Import Statements:
+import os
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+CONTEXT_PACKING_ENABLED = os.environ.get("CONTEXT_PACKING_ENABLED", "1") == "1"
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "2500"))  # Tokens of retrieved context per prompt
+NEAR_DUPLICATE_THRESHOLD = float(os.environ.get("NEAR_DUPLICATE_THRESHOLD", "0.8"))  # Share of a chunk's word shingles already kept
+SHINGLE_SIZE = 5  # Words per shingle
+MIN_OVERLAP = 20  # Characters two chunks must share to be merged
+MAX_OVERLAP = 400  # Longest overlap looked for; the splitter uses 200
+DOCUMENT_SEPARATOR = "\n\n"  # How create_stuff_documents_chain joins documents
+
+
+def get_token_counter(model):
+    """
+    Token counter for the chat model: tiktoken when its encoding can be loaded, else about 4 characters per token.
+    """
+    try:
+        import tiktoken
+
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception as e:
+        # tiktoken missing, or its encoding file cannot be downloaded (e.g. offline)
+        logger.warning("Estimating tokens from characters; tiktoken unavailable: %s", e)
+        return lambda text: (len(text) + 3) // 4
+
+def shingles(text):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def containment(candidate, kept):
+    """
+    Share of the candidate's shingles that also appear in the kept chunk.
+    """
+    return len(candidate & kept) / len(candidate) if candidate else 1.0
+
+def overlap_length(first, second):
+    """
+    Length of the longest end of first that is also the start of second (0 if under MIN_OVERLAP).
+    """
+    for length in range(min(len(first), len(second), MAX_OVERLAP), MIN_OVERLAP - 1, -1):
+        if first.endswith(second[:length]):
+            return length
+    return 0
+
+def document_sources(doc):
+    """
+    All sources behind a document: its own, plus any recorded on it when duplicates were folded in.
+    """
+    return doc.metadata.get("sources") or [doc.metadata["source"]]
+
+
+class ContextPacker:
+    """
+    Turns retrieved documents (best first) into the context for the first prompt:
+    1. chunks from the same source whose text overlaps or contains one another are merged,
+       keeping the "sources" of both,
+    2. chunks with at least `threshold` of their word shingles in a better-ranked chunk
+       are dropped, their sources recorded on the chunk that is kept ("sources" metadata),
+    3. chunks are kept in rank order while they fit in `token_budget` tokens.
+    Keeps running totals of documents and tokens before and after packing.
+    """
+    def __init__(self, model="gpt-4", token_budget=CONTEXT_TOKEN_BUDGET, threshold=NEAR_DUPLICATE_THRESHOLD, count_tokens=None):
+        self.token_budget = token_budget
+        self.threshold = threshold
+        self.count_tokens = count_tokens or get_token_counter(model)
+        self.requests = 0
+        self.documents_in = 0
+        self.documents_out = 0
+        self.prompt_tokens_before = 0
+        self.prompt_tokens_after = 0
+
+    def merge_overlapping(self, documents):
+        from langchain_core.documents import Document
+
+        texts = [doc.page_content for doc in documents]
+        metadata = [dict(doc.metadata) for doc in documents]
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(texts)):
+                for j in range(i + 1, len(texts)):
+                    if texts[i] is None or texts[j] is None:
+                        continue
+                    if metadata[i].get("source") != metadata[j].get("source"):
+                        continue
+                    # A merged chunk takes the rank of the better-ranked chunk it came from
+                    if texts[j] in texts[i]:
+                        pass
+                    elif texts[i] in texts[j]:
+                        texts[i] = texts[j]
+                    elif overlap_length(texts[i], texts[j]):
+                        texts[i] = texts[i] + texts[j][overlap_length(texts[i], texts[j]):]
+                    elif overlap_length(texts[j], texts[i]):
+                        texts[i] = texts[j] + texts[i][overlap_length(texts[j], texts[i]):]
+                    else:
+                        continue
+                    texts[j] = None
+                    merged = True
+                    # Keep the sources folded into either chunk (both share the same own source)
+                    if "sources" in metadata[i] or "sources" in metadata[j]:
+                        sources = list(metadata[i].get("sources") or [metadata[i]["source"]])
+                        for source in metadata[j].get("sources") or [metadata[j]["source"]]:
+                            if source not in sources:
+                                sources.append(source)
+                        metadata[i]["sources"] = sources
+        return [Document(page_content=text, metadata=meta) for text, meta in zip(texts, metadata) if text is not None]
+
+    def drop_near_duplicates(self, documents):
+        kept = []
+        for doc in documents:
+            doc_shingles = shingles(doc.page_content)
+            duplicate_of = next((kept_doc for kept_doc, kept_shingles in kept
+                                 if containment(doc_shingles, kept_shingles) >= self.threshold), None)
+            if duplicate_of is None:
+                kept.append((doc, doc_shingles))
+                continue
+            sources = list(document_sources(duplicate_of))
+            for source in document_sources(doc):
+                if source not in sources:
+                    sources.append(source)
+            duplicate_of.metadata["sources"] = sources
+        return [doc for doc, _ in kept]
+
+    def fit_budget(self, documents):
+        packed = []
+        used = 0
+        separator = self.count_tokens(DOCUMENT_SEPARATOR)
+        for doc in documents:
+            tokens = self.count_tokens(doc.page_content) + (separator if packed else 0)
+            if used + tokens <= self.token_budget:
+                packed.append(doc)
+                used += tokens
+        return packed
+
+    def pack(self, documents):
+        documents = list(documents)
+        if not documents:
+            return documents
+        return self.fit_budget(self.drop_near_duplicates(self.merge_overlapping(documents)))
+
+    def record(self, documents_in, documents_out, prompt_tokens_before, prompt_tokens_after):
+        self.requests += 1
+        self.documents_in += documents_in
+        self.documents_out += documents_out
+        self.prompt_tokens_before += prompt_tokens_before
+        self.prompt_tokens_after += prompt_tokens_after
+        logger.info("Packed context: %d -> %d documents, prompt tokens %d -> %d",
+                    documents_in, documents_out, prompt_tokens_before, prompt_tokens_after)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "documents_in": self.documents_in,
+            "documents_out": self.documents_out,
+            "prompt_tokens_before": self.prompt_tokens_before,
+            "prompt_tokens_after": self.prompt_tokens_after,
+            "prompt_tokens_saved": self.prompt_tokens_before - self.prompt_tokens_after,
+        }
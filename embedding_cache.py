@@ -0,0 +1,185 @@
+"""
+embedding_cache.py
+Goal: cache embeddings on disk, so identical chunk text or patient queries are only embedded once
+"""
+
+# Import Statements:
+import os
+import time
+import array
+import hashlib
+import sqlite3
+import threading
+from langchain_core.embeddings import Embeddings
+
+# Configuration
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBEDDING_CACHE_PATH = os.environ.get(
+    "EMBEDDING_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.embedding_cache.sqlite'),
+)
+# Size limit for stored vectors; least recently used entries are evicted past it
+EMBEDDING_CACHE_MAX_BYTES = int(os.environ.get("EMBEDDING_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+
+class EmbeddingCache:
+    """
+    On-disk embedding cache keyed by (model, sha256 of text). Vectors are stored as packed
+    float32 blobs in a SQLite table indexed by key. When the stored vectors exceed max_bytes
+    the least recently used entries are evicted down to 90% of the limit.
+    """
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_bytes=EMBEDDING_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, nbytes INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.connection.commit()
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def key(model, text):
+        return f"{model}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def get_many(self, keys):
+        """
+        Return {key: vector} for the keys that are cached, and count hits and misses.
+        """
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self.lock:
+            # Stay well under SQLite's limit on bound parameters
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.connection.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch)
+                for key, blob in rows:
+                    vector = array.array('f')
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+            if found:
+                now = time.time()
+                self.connection.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+                self.connection.commit()
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, items):
+        """
+        Store (key, vector) pairs, then evict if the cache is over its size limit.
+        """
+        now = time.time()
+        rows = []
+        for key, vector in items:
+            blob = array.array('f', vector).tobytes()
+            rows.append((key, blob, len(blob), now))
+        with self.lock:
+            for key, _, nbytes, _ in rows:
+                previous = self.connection.execute("SELECT nbytes FROM embeddings WHERE key = ?", (key,)).fetchone()
+                self.total_bytes += nbytes - (previous[0] if previous else 0)
+            self.connection.executemany("INSERT OR REPLACE INTO embeddings (key, vector, nbytes, last_used) VALUES (?, ?, ?, ?)", rows)
+            self.connection.commit()
+            if self.total_bytes > self.max_bytes:
+                self._evict(int(self.max_bytes * 0.9))
+
+    def _evict(self, target_bytes):
+        rows = self.connection.execute("SELECT key, nbytes FROM embeddings ORDER BY last_used")
+        evicted = []
+        for key, nbytes in rows:
+            if self.total_bytes <= target_bytes:
+                break
+            evicted.append((key,))
+            self.total_bytes -= nbytes
+        self.connection.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+        self.connection.commit()
+        self.evictions += len(evicted)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "bytes": self.total_bytes,
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps a LangChain Embeddings object so that texts already in the cache are not sent
+    to the model again. Drop-in for OpenAIEmbeddings wherever it is passed to a vector store.
+    """
+    def __init__(self, embeddings, model=EMBEDDING_MODEL, cache=None):
+        self.embeddings = embeddings
+        self.model = model
+        self.cache = cache if cache is not None else get_embedding_cache()
+
+    def _lookup(self, texts):
+        keys = [EmbeddingCache.key(self.model, text) for text in texts]
+        found = self.cache.get_many(keys)
+        missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in found))
+        return keys, found, missing
+
+    def _store(self, missing, vectors, found):
+        items = [(EmbeddingCache.key(self.model, text), vector) for text, vector in zip(missing, vectors)]
+        self.cache.put_many(items)
+        found.update(items)
+
+    def embed_documents(self, texts):
+        keys, found, missing = self._lookup(texts)
+        if missing:
+            self._store(missing, self.embeddings.embed_documents(missing), found)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text):
+        keys, found, missing = self._lookup([text])
+        if missing:
+            self._store(missing, [self.embeddings.embed_query(text)], found)
+        return found[keys[0]]
+
+    async def aembed_documents(self, texts):
+        keys, found, missing = self._lookup(texts)
+        if missing:
+            self._store(missing, await self.embeddings.aembed_documents(missing), found)
+        return [found[key] for key in keys]
+
+    async def aembed_query(self, text):
+        keys, found, missing = self._lookup([text])
+        if missing:
+            self._store(missing, [await self.embeddings.aembed_query(text)], found)
+        return found[keys[0]]
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_embedding_cache():
+    """
+    Process-wide cache instance, opened on first use.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+        return _cache
+
+def cached_embeddings(model=EMBEDDING_MODEL, priority=None):
+    """
+    OpenAIEmbeddings for the given model, behind the shared on-disk cache. Calls that miss
+    the cache go through the process-wide OpenAI scheduler at priority (interactive by default).
+    """
+    from langchain_openai import OpenAIEmbeddings
+    from openai_scheduler import INTERACTIVE, OPENAI_CLIENT_MAX_RETRIES, scheduled_embeddings
+
+    embeddings = scheduled_embeddings(OpenAIEmbeddings(model=model, max_retries=OPENAI_CLIENT_MAX_RETRIES),
+                                      INTERACTIVE if priority is None else priority)
+    return CachedEmbeddings(embeddings, model=model)
@@ -10,21 +10,39 @@ Since the code's already written, we're just running it here.
 
 # Import statements
 import os
+import argparse
 import dotenv
 
 # Code from other files:
 import initial_retrieval as initial_retrieval
 import process_documents as process_documents
+import telemetry
 # Load environment variables
 dotenv.load_dotenv()
 
 
 # Run the initialization function
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download the sources and ingest them into the vector store.")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Re-ingest everything from scratch, e.g. once for an index built before the ingest ledger")
+    args = parser.parse_args()
     
-    # Initialize the retrieval process, creating downloads folder with files from Google Sheet
-    initial_retrieval.initialize_retrieval()
-    print("-----------------------------------")
+    # Make sure dependencies are present before any of the heavy imports run
+    initial_retrieval.check_and_install_requirements()
     
-    # Process the documents
-    process_documents.process_documents()
+    # Time every stage of the run when TELEMETRY_ENABLED=1
+    with telemetry.span("ingestion"):
+        # Initialize the retrieval process, creating downloads folder with files from Google Sheet
+        initial_retrieval.initialize_retrieval()
+        print("-----------------------------------")
+        
+        # Process the documents
+        process_documents.process_documents(rebuild=args.rebuild)
+        print("-----------------------------------")
+
+        # Precompute the retrieved context for every discrete patient profile against the updated index
+        import main
+        if main.RETRIEVAL_CONTEXT_ENABLED:
+            with telemetry.span("ingest.precompute_context"):
+                main.build_retrieval_context_table()
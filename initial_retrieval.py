@@ -8,30 +8,54 @@ Goal: get urls from Google Sheet, save as HTML, and convert to Markdown
 import os
 import sys
 import subprocess
-import pkg_resources
-
-# Import Statements for writing/reading with Google Sheets API
-import requests
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from urllib.parse import urlparse, quote
-import chardet
-from bs4 import BeautifulSoup
-import html2text
-import PyPDF2
+
+# Import Statements. Heavy third-party packages (requests, Google API client, html2text,
+# chardet, PyPDF2) are imported inside the functions that use them, so that
+# importing this module stays cheap for callers that only need part of it.
+from urllib.parse import urlparse
 import time
 import re
+import json
+import codecs
+import hashlib
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+# Code from other files:
+from source_manifest import SourceManifest
+from telemetry import current_span, span, timed
 
 # Configuration
 SPREADSHEET_ID = '19ROOIViqZbgc1127K6-QYFbqGNC8RXg0CxWQQBb0bh8'
 RANGE_NAME = 'Sheet1!C:C'
 SERVICE_ACCOUNT_FILE = os.path.join(os.path.expanduser('~'), 'VSCode', 'llm_fralitymodel_remote', 'llm_frality_model', 'frality-docs-c6f8f51d08f4.json')
+FILENAME_COLUMN = 'H'  # Column receiving the saved filename for each URL row
 OUTPUT_DIR = 'downloads'
+FETCH_CACHE_FILE = '.fetch_cache.json'  # Lives inside OUTPUT_DIR
+
+# Download engine settings
+MAX_WORKERS = 8  # Total concurrent downloads
+MAX_PER_HOST = 2  # Concurrent downloads against any single host
+MAX_RETRIES = 3  # Retries per URL on connection errors and 429/5xx responses
+BACKOFF_FACTOR = 0.5  # Sleeps 0.5s, 1s, 2s, ... between retries
+REQUEST_TIMEOUT = 30  # Seconds
+USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36'
+MAX_RESPONSE_BYTES = int(os.environ.get('MAX_RESPONSE_BYTES', str(20 * 1024 * 1024)))  # Larger responses are abandoned
+READ_CHUNK_BYTES = 64 * 1024
+
+# HTML conversion settings
+CHARSET_SNIFF_BYTES = 4096  # Where to look for <meta charset> and a byte order mark
+CHARSET_SAMPLE_BYTES = 64 * 1024  # How much of the body chardet sees when no charset is declared
+BOILERPLATE_TAGS = {'script', 'style', 'noscript', 'template', 'nav', 'footer', 'aside', 'iframe', 'svg'}  # Dropped with their contents
+CONVERTER_VERSION = 2  # Bump when html_to_markdown changes; Markdown saved by an older converter is fetched and converted again
 
 
 # ------ Part 1: Check Package Requirements ------
 
 def check_and_install_requirements():
+    import pkg_resources
+
     requirements_path = 'requirements.txt'
     with open(requirements_path, 'r') as f:
         required_packages = [line.strip() for line in f if line.strip() and not line.startswith('#')]
@@ -42,22 +66,123 @@ def check_and_install_requirements():
         subprocess.check_call([sys.executable, '-m', 'pip', 'install', '-r', requirements_path], stdout=subprocess.DEVNULL)
         print("Installation complete.")
 
-check_and_install_requirements()
-
 # ------ Part 2: Functions Definitions ------
 
-credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=['https://www.googleapis.com/auth/spreadsheets'])
-service = build('sheets', 'v4', credentials=credentials)
+_service = None
+_service_lock = threading.Lock()
+
+def get_sheets_service():
+    """
+    Load the service-account credentials and build the Sheets client on first use.
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            from google.oauth2 import service_account
+            from googleapiclient.discovery import build
+
+            credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=['https://www.googleapis.com/auth/spreadsheets'])
+            _service = build('sheets', 'v4', credentials=credentials)
+        return _service
+
+class GoogleSheetClient:
+    """
+    Thin wrapper over the Sheets values API, so the rest of this module only needs
+    two calls: one column read and one batched write.
+    """
+    def __init__(self, service, spreadsheet_id=SPREADSHEET_ID):
+        self.service = service
+        self.spreadsheet_id = spreadsheet_id
+
+    def get_values(self, range_name):
+        result = self.service.spreadsheets().values().get(spreadsheetId=self.spreadsheet_id, range=range_name).execute()
+        return result.get('values', [])
+
+    def batch_update_values(self, data):
+        body = {'valueInputOption': 'RAW', 'data': data}
+        return self.service.spreadsheets().values().batchUpdate(spreadsheetId=self.spreadsheet_id, body=body).execute()
 
-def get_urls_from_sheet():
+class InMemorySheetClient:
+    """
+    Local stand-in for GoogleSheetClient, for tests and offline runs.
+    Reads return the rows given per range; writes are kept in `updates` (range -> values).
+    """
+    def __init__(self, values_by_range=None):
+        self.values_by_range = values_by_range or {}
+        self.updates = {}
+        self.read_calls = 0
+        self.write_calls = 0
+
+    def get_values(self, range_name):
+        self.read_calls += 1
+        return self.values_by_range.get(range_name, [])
+
+    def batch_update_values(self, data):
+        self.write_calls += 1
+        for item in data:
+            self.updates[item['range']] = item['values']
+        return {'totalUpdatedCells': len(data)}
+
+def get_sheet_client():
+    return GoogleSheetClient(get_sheets_service(), SPREADSHEET_ID)
+
+def read_url_rows(client=None):
+    """
+    Read the URL column once, returning the list of URLs to download and a map of
+    URL -> 1-based sheet row (first occurrence) for recording filenames later.
+    """
+    client = client or get_sheet_client()
+    values = client.get_values(RANGE_NAME)
+    urls = [row[0] for row in values if row and row[0].startswith('http')]
+    url_rows = {}
+    for i, row in enumerate(values):
+        if row and row[0] not in url_rows:
+            url_rows[row[0]] = i + 1
+    return urls, url_rows
+
+def get_urls_from_sheet(client=None):
     try:
-        result = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range=RANGE_NAME).execute()
-        return [row[0] for row in result.get('values', []) if row and row[0].startswith('http')]
+        return read_url_rows(client)[0]
     except Exception as e:
         print(f"Error fetching URLs from Google Sheets: {e}")
         return []
 
-def sanitize_filename(url):
+class SheetFilenameRecorder:
+    """
+    Collects URL -> filename writes during a run and sends them to the sheet in a single batchUpdate.
+    """
+    def __init__(self, client, url_rows):
+        self.client = client
+        self.url_rows = url_rows
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def record(self, url, filename):
+        """
+        Queue a filename write. Returns the source URL if the URL has a row in the sheet, else None.
+        """
+        row = self.url_rows.get(url)
+        if row is None:
+            print(f"URL not found in sheet: {url}")
+            return None
+        with self.lock:
+            self.pending[f'Sheet1!{FILENAME_COLUMN}{row}'] = filename
+        return url
+
+    def flush(self):
+        with self.lock:
+            data = [{'range': range_name, 'values': [[filename]]} for range_name, filename in self.pending.items()]
+            self.pending = {}
+        if not data:
+            return 0
+        try:
+            self.client.batch_update_values(data)
+        except Exception as e:
+            print(f"Error recording filenames in sheet: {e}")
+            return 0
+        return len(data)
+
+def sanitize_filename(url, content_hash=None):
     parsed = urlparse(url)
     path = parsed.path.strip('/')
     path_parts = path.split('/')
@@ -67,9 +192,6 @@ def sanitize_filename(url):
     if len(path_parts) > 1:
         filename = f"{path_parts[-2]}_{filename}"
     
-    # Add timestamp to ensure uniqueness
-    timestamp = int(time.time())
-    
     # Remove any non-alphanumeric characters and replace spaces with underscores
     filename = re.sub(r'[^\w\-_\. ]', '', filename)
     filename = filename.replace(' ', '_')
@@ -79,98 +201,367 @@ def sanitize_filename(url):
     if len(filename) > max_length:
         filename = filename[:max_length]
     
-    return f"{filename}_{timestamp}"
+    # Suffix with a hash of the full URL, so the same path on two hosts (or with two query
+    # strings) never shares a file, and with the content hash so the same bytes from one
+    # URL always map to the same file
+    url_hash = hashlib.sha256(url.encode('utf-8')).hexdigest()[:8]
+    filename = f"{filename}_{url_hash}"
+    if content_hash:
+        filename = f"{filename}_{content_hash[:16]}"
+    
+    return filename
+
+class FetchCache:
+    """
+    Persistent record, keyed by URL, of the validators (ETag/Last-Modified), content hash,
+    saved file and, for Markdown, converter version of the last successful download. Also
+    tracks which files changed in the current run so downstream stages can skip unchanged documents.
+    """
+    def __init__(self, output_dir=OUTPUT_DIR):
+        self.path = os.path.join(output_dir, FETCH_CACHE_FILE)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.changed = []
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f).get('entries', {})
+            except Exception as e:
+                print(f"Ignoring unreadable fetch cache {self.path}: {e}")
+
+    def lookup(self, url):
+        """
+        Return the cached entry for a URL, or None if it was never fetched or its file is gone.
+        """
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry and os.path.exists(entry['filename']):
+            return entry
+        return None
+
+    @staticmethod
+    def needs_conversion(entry):
+        """
+        Whether a cached Markdown file was written by an older html_to_markdown (entries before
+        versioning count as version 1) and must be converted again from a fresh download.
+        """
+        return file_type_for(entry['filename']) == 'markdown' and entry.get('converter', 1) != CONVERTER_VERSION
+
+    def conditional_headers(self, url):
+        """
+        Build If-None-Match/If-Modified-Since headers from the cached validators; none when
+        the cached file needs converting again, so the server sends the full body.
+        """
+        entry = self.lookup(url)
+        headers = {}
+        if entry and not self.needs_conversion(entry):
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url, response, content_hash, filename, changed, converter=None):
+        with self.lock:
+            self.entries[url] = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'content_hash': content_hash,
+                'filename': filename,
+                'fetched_at': int(time.time()),
+            }
+            if converter is not None:
+                self.entries[url]['converter'] = converter
+            if changed:
+                self.changed.append(filename)
+
+    def save(self):
+        with self.lock:
+            data = {'entries': self.entries, 'changed': sorted(self.changed)}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+def get_changed_documents(output_dir=OUTPUT_DIR):
+    """
+    Return the files that were new or changed in the last retrieval run.
+    """
+    path = os.path.join(output_dir, FETCH_CACHE_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f).get('changed', [])
+
+def create_session(pool_size=MAX_WORKERS):
+    """
+    Build a requests session with a shared connection pool and retry/backoff on transient errors.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=['GET', 'HEAD'],
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.headers.update({'User-Agent': USER_AGENT})
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+def host_semaphore(url):
+    """
+    Return the semaphore limiting concurrent downloads against the host of the given URL.
+    """
+    host = urlparse(url).netloc.lower()
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(MAX_PER_HOST)
+        return _host_semaphores[host]
+
+def read_body(response, max_bytes=MAX_RESPONSE_BYTES):
+    """
+    Read a streamed response body, giving up as soon as it is known to exceed max_bytes.
+    """
+    declared = response.headers.get('Content-Length')
+    if declared and declared.isdigit() and int(declared) > max_bytes:
+        response.close()
+        raise ValueError(f"Response of {int(declared)} bytes exceeds the {max_bytes}-byte limit")
+    body = bytearray()
+    for chunk in response.iter_content(chunk_size=READ_CHUNK_BYTES):
+        body += chunk
+        if len(body) > max_bytes:
+            response.close()
+            raise ValueError(f"Response exceeds the {max_bytes}-byte limit")
+    return bytes(body)
+
+_BOMS = ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'))
+_HEADER_CHARSET = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+_META_CHARSET = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
+
+def known_encoding(name):
+    """
+    The codec name if Python knows it, else None.
+    """
+    if not name:
+        return None
+    try:
+        return codecs.lookup(name.strip()).name
+    except LookupError:
+        return None
+
+def detect_encoding(body, content_type=''):
+    """
+    Pick the encoding of an HTML body: a byte order mark, then the charset declared in the
+    Content-Type header, then a <meta> charset near the top, and only then chardet on a
+    sample of the body.
+    """
+    for bom, encoding in _BOMS:
+        if body.startswith(bom):
+            return encoding
+    match = _HEADER_CHARSET.search(content_type or '')
+    encoding = known_encoding(match.group(1)) if match else None
+    if encoding:
+        return encoding
+    match = _META_CHARSET.search(body[:CHARSET_SNIFF_BYTES])
+    encoding = known_encoding(match.group(1).decode('ascii', 'ignore')) if match else None
+    if encoding:
+        return encoding
+    import chardet
+
+    return known_encoding(chardet.detect(body[:CHARSET_SAMPLE_BYTES])['encoding']) or 'utf-8'
+
+def decode_body(body, content_type=''):
+    return body.decode(detect_encoding(body, content_type), errors='replace')
+
+def make_html2text(strip_boilerplate=True):
+    """
+    An html2text converter that, when strip_boilerplate is set, drops BOILERPLATE_TAGS
+    elements and everything inside them as the page is parsed.
+    """
+    import html2text
+
+    class BoilerplateFreeHTML2Text(html2text.HTML2Text):
+        def __init__(self):
+            super().__init__()
+            self.ignore_links = False
+            self.skip_depth = 0
+
+        def handle_starttag(self, tag, attrs):
+            if strip_boilerplate and tag in BOILERPLATE_TAGS:
+                self.skip_depth += 1
+            elif not self.skip_depth:
+                super().handle_starttag(tag, attrs)
+
+        def handle_endtag(self, tag):
+            if strip_boilerplate and tag in BOILERPLATE_TAGS:
+                self.skip_depth = max(0, self.skip_depth - 1)
+            elif not self.skip_depth:
+                super().handle_endtag(tag)
+
+        def handle_data(self, data, entity_char=False):
+            if not self.skip_depth:
+                super().handle_data(data, entity_char)
+
+    return BoilerplateFreeHTML2Text()
 
 def html_to_markdown(html_content):
-    soup = BeautifulSoup(html_content, 'html.parser')
-    h = html2text.HTML2Text()
-    h.ignore_links = False
-    return h.handle(str(soup.body) if soup.body else html_content)
+    """
+    Convert a page to Markdown in a single parse, leaving out navigation, scripts, footers
+    and other boilerplate. html2text already skips everything outside <body>.
+    """
+    markdown = make_html2text().handle(html_content)
+    if not markdown.strip():
+        # An unclosed boilerplate element swallowed the page; convert it whole instead
+        markdown = make_html2text(strip_boilerplate=False).handle(html_content)
+    return markdown
 
-def download_and_save(url, output_dir):
+def download_and_save(url, output_dir, session=None, cache=None, recorder=None, manifest=None):
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36'}
-        response = requests.get(url, headers=headers, stream=True)
-        response.raise_for_status()
+        if session is None:
+            session = create_session(pool_size=1)
+        headers = cache.conditional_headers(url) if cache else {}
+        with host_semaphore(url):
+            response = session.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            # Read the body while holding the host slot, so the limit covers the transfer too
+            body = read_body(response)
+        current_span().add("bytes", len(body))
+        
+        cached = cache.lookup(url) if cache else None
+        if response.status_code == 304 and cached:
+            ensure_in_manifest(manifest, cached['filename'], url)
+            current_span().set(result="not_modified")
+            return cached['filename']
+        
+        content_hash = hashlib.sha256(body).hexdigest()
+        if cached and cached['content_hash'] == content_hash and not cache.needs_conversion(cached):
+            # Server ignored the validators but the bytes are the same: refresh them, skip the write
+            cache.store(url, response, content_hash, cached['filename'], changed=False, converter=cached.get('converter'))
+            ensure_in_manifest(manifest, cached['filename'], url)
+            current_span().set(result="unchanged")
+            return cached['filename']
         
         content_type = response.headers.get('Content-Type', '').lower()
-        safe_filename = sanitize_filename(url)
+        safe_filename = sanitize_filename(url, content_hash)
         
         if 'application/pdf' in content_type or url.lower().endswith('.pdf'):
             filename = os.path.join(output_dir, safe_filename)
             if not filename.lower().endswith('.pdf'):
                 filename += '.pdf'
+            converter = None
             with open(filename, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+                f.write(body)
+            file_hash = content_hash
             
-            source_url = record_filename_in_sheet(url, os.path.basename(filename))
-            if source_url:
-                update_pdf_metadata(filename, source_url)
+            record_filename_in_sheet(url, os.path.basename(filename), recorder)
+            file_type = 'pdf'
         else:
-            encoding = chardet.detect(response.content)['encoding'] or 'utf-8'
-            html_content = response.content.decode(encoding)
+            html_content = decode_body(body, response.headers.get('Content-Type', ''))
             markdown_content = html_to_markdown(html_content)
             
-            markdown_filename = os.path.join(output_dir, safe_filename + '.md')
-            source_url = record_filename_in_sheet(url, os.path.basename(markdown_filename))
+            filename = os.path.join(output_dir, safe_filename + '.md')
+            source_url = record_filename_in_sheet(url, os.path.basename(filename), recorder)
             if source_url:
                 markdown_content = f"<!-- Source URL: {source_url} -->\n\n" + markdown_content
             
-            with open(markdown_filename, 'w', encoding='utf-8', errors='replace') as f:
-                f.write(markdown_content)
+            markdown_bytes = markdown_content.encode('utf-8', errors='replace')
+            with open(filename, 'wb') as f:
+                f.write(markdown_bytes)
+            # Hash what was written, not the HTML, so a reconverted page reads as changed to ingestion
+            file_hash = hashlib.sha256(markdown_bytes).hexdigest()
+            file_type = 'markdown'
+            converter = CONVERTER_VERSION
+        
+        if manifest is not None:
+            manifest.record(filename, url, file_hash, file_type)
         
-        return filename if 'filename' in locals() else markdown_filename
+        if cache:
+            # The source changed, so the previous version must not be ingested alongside the new one
+            if cached and cached['filename'] != filename:
+                handle_existing_file(cached['filename'])
+            cache.store(url, response, content_hash, filename, changed=True, converter=converter)
+        
+        current_span().set(result="changed", file_type=file_type)
+        return filename
     except Exception as e:
         print(f"Error processing {url}: {e}")
+        current_span().set(result="error", error=str(e))
         return None
 
-def update_pdf_metadata(filename, source_url):
-    try:
-        with open(filename, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            pdf_writer = PyPDF2.PdfWriter()
-            
-            for page in pdf_reader.pages:
-                pdf_writer.add_page(page)
-            
-            pdf_writer.add_metadata({'/SourceURL': source_url})
-            
-            with open(filename, 'wb') as output_file:
-                pdf_writer.write(output_file)
-    except Exception as pdf_error:
-        print(f"Error updating PDF metadata: {pdf_error}")
+def file_type_for(filename):
+    return 'pdf' if filename.lower().endswith('.pdf') else 'markdown'
+
+def saved_file_hash(filename):
+    """
+    Hash of a saved file's bytes: the manifest's content_hash, which ingestion compares against its ledger.
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def ensure_in_manifest(manifest, filename, url):
+    """
+    Add an unchanged file to the manifest if it predates the manifest.
+    """
+    if manifest is not None and manifest.lookup(filename) is None:
+        manifest.record(filename, url, saved_file_hash(filename), file_type_for(filename))
+
+# The Sheets client is not thread-safe, so one-off writes are made one at a time
+_sheet_lock = threading.Lock()
 
-def record_filename_in_sheet(url, filename):
+def record_filename_in_sheet(url, filename, recorder=None):
+    """
+    Record the saved filename next to its URL. With a recorder the write is queued
+    for the recorder's batched flush; without one, the sheet is read and written immediately.
+    """
     if not filename:
         print(f"No filename to record for URL: {url}")
         return None
 
+    if recorder is not None:
+        return recorder.record(url, filename)
+
     try:
-        result = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range='Sheet1!C:C').execute()
-        values = result.get('values', [])
-        row_index = next((i for i, row in enumerate(values) if row and row[0] == url), None)
-        
-        if row_index is not None:
-            source_url = url
-            range_name = f'Sheet1!H{row_index + 1}'
-            body = {'values': [[filename]]}
-            service.spreadsheets().values().update(spreadsheetId=SPREADSHEET_ID, range=range_name, valueInputOption='RAW', body=body).execute()
+        with _sheet_lock:
+            client = get_sheet_client()
+            recorder = SheetFilenameRecorder(client, read_url_rows(client)[1])
+            source_url = recorder.record(url, filename)
+            recorder.flush()
             return source_url
-        else:
-            print(f"URL not found in sheet: {url}")
-            return None
     except Exception as e:
         print(f"Error recording filename in sheet: {e}")
         return None
 
-def check_source_metadata(filename):
+def check_source_metadata(filename, manifest=None):
+    """
+    Report the source URL of a downloaded file, from the provenance manifest in its directory.
+    Files downloaded before the manifest existed fall back to the PDF metadata or Markdown header.
+    """
     try:
-        if filename.endswith('.pdf'):
+        if manifest is None:
+            manifest = SourceManifest(os.path.dirname(filename) or '.')
+        entry = manifest.lookup(filename)
+        if entry:
+            print(f"{entry['type'].capitalize()} file {filename} has source URL: {entry['source_url']}")
+        elif filename.endswith('.pdf'):
+            import PyPDF2
+
             with open(filename, 'rb') as file:
                 reader = PyPDF2.PdfReader(file)
                 metadata = reader.metadata
-                if '/SourceURL' in metadata:
+                if metadata and '/SourceURL' in metadata:
                     print(f"PDF file {filename} has source URL: {metadata['/SourceURL']}")
                 else:
                     print(f"PDF file {filename} does not have a source URL in its metadata")
@@ -191,37 +582,67 @@ def handle_existing_file(filename):
         os.remove(filename)
 
 # Function to initialize the retrieval process
-def initialize_retrieval():
+@timed("retrieval")
+def initialize_retrieval(max_workers=MAX_WORKERS, client=None):
     """
     Initializes the retrieval process by checking if the output directory exists,
-    and if not, creating it. It then fetches URLs from the Google Sheet, downloads
-    the files, handles existing files, checks source metadata, and prints the completion message.
+    and if not, creating it. It then fetches URLs from the Google Sheet and downloads
+    each one exactly once over a shared, pooled session, with at most max_workers
+    downloads in flight (and MAX_PER_HOST per host). Unchanged sources are answered
+    from the fetch cache with a conditional request and are not rewritten to disk.
+    Filenames are written back to the sheet in one batched update at the end, and each
+    file's source URL is recorded in the provenance manifest in OUTPUT_DIR.
+    client defaults to the Google Sheet; pass an InMemorySheetClient for tests and offline runs.
+    Finally, it prints the completion message.
     """
     if not os.path.exists(OUTPUT_DIR):
         os.makedirs(OUTPUT_DIR)
     
-    urls = get_urls_from_sheet()
-    successful_downloads = 0
-    failed_downloads = 0
+    client = client or get_sheet_client()
+    try:
+        urls, url_rows = read_url_rows(client)
+    except Exception as e:
+        print(f"Error fetching URLs from Google Sheets: {e}")
+        urls, url_rows = [], {}
+    
+    session = create_session(pool_size=max_workers)
+    cache = FetchCache(OUTPUT_DIR)
+    recorder = SheetFilenameRecorder(client, url_rows)
+    manifest = SourceManifest(OUTPUT_DIR)
     
-    for url in urls:
-        filename = download_and_save(url, OUTPUT_DIR)
-        if filename:
-            handle_existing_file(filename)
-            new_filename = download_and_save(url, OUTPUT_DIR)
-            if new_filename:
-                successful_downloads += 1
-            else:
-                failed_downloads += 1
-        else:
-            failed_downloads += 1
+    def fetch(url):
+        with span("retrieval.download", url=url):
+            return download_and_save(url, OUTPUT_DIR, session, cache, recorder, manifest)
+    
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Each download runs in a copy of the caller's context, taken here rather than in the worker
+            # thread, so its span nests under the caller's
+            futures = [executor.submit(contextvars.copy_context().run, fetch, url) for url in urls]
+            filenames = [future.result() for future in futures]
+    finally:
+        with span("retrieval.flush"):
+            session.close()
+            cache.save()
+            recorder.flush()
+            manifest.compact()
+    
+    successful_downloads = sum(1 for filename in filenames if filename)
+    failed_downloads = len(filenames) - successful_downloads
+    
+    current_span().add("urls", len(urls))
+    current_span().add("downloaded", successful_downloads)
+    current_span().add("changed", len(cache.changed))
+    current_span().add("failed", failed_downloads)
     
     print("Download process completed.")
     print(f"Successfully downloaded: {successful_downloads} documents")
+    print(f"Changed since last run: {len(cache.changed)} documents")
     print(f"Failed downloads: {failed_downloads} documents")
     print(f"Total processed: {len(urls)} documents")
 
 # ------ Part 3: Main Function ------
 
 if __name__ == "__main__":
+    check_and_install_requirements()
     initialize_retrieval()
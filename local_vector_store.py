@@ -0,0 +1,263 @@
+"""
+local_vector_store.py
+Goal: a local alternative to Pinecone for the care-plan retriever, small enough corpora fit in RAM
+"""
+
+# Import Statements:
+import os
+import json
+import time
+import shutil
+import threading
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+# Configuration
+VECTOR_BACKEND = os.environ.get("VECTOR_BACKEND", "pinecone")  # "pinecone" or "local"
+LOCAL_INDEX_DIR = os.environ.get(
+    "LOCAL_INDEX_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'local_index'),
+)
+LOCAL_INDEX_DTYPE = os.environ.get("LOCAL_INDEX_DTYPE", "float32")  # or "float16" to halve memory
+VECTORS_FILE = 'vectors.npy'
+METADATA_FILE = 'metadata.jsonl'
+CURRENT_FILE = 'CURRENT'  # Names the generation subdirectory holding the live vectors and metadata
+VERSION_FILE = 'version'  # Content version of a generation, written by process_documents
+SEARCH_BLOCK_ROWS = 65536  # Rows scored per block when the matrix is float16
+
+
+def normalize(matrix):
+    """
+    Scale rows to unit length so a dot product is the cosine similarity.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def current_generation(directory):
+    """
+    The directory holding the live index files: the generation CURRENT points at, or the index
+    directory itself for an index written before generations.
+    """
+    try:
+        with open(os.path.join(directory, CURRENT_FILE), 'r', encoding='utf-8') as f:
+            return os.path.join(directory, f.read().strip())
+    except FileNotFoundError:
+        return directory
+
+def index_exists(directory):
+    return os.path.exists(os.path.join(current_generation(directory), VECTORS_FILE))
+
+def read_index_version(directory=LOCAL_INDEX_DIR):
+    """
+    The content version stored with the live generation, or None if it has none.
+    """
+    try:
+        with open(os.path.join(current_generation(directory), VERSION_FILE), 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+class LocalVectorStore(VectorStore):
+    """
+    Exact cosine-similarity search over a memory-mapped matrix of unit vectors
+    (vectors.npy, float32 or float16) with a sidecar metadata table (metadata.jsonl,
+    one row per vector: id, text, metadata). Sits behind the usual LangChain retriever
+    interface, so vectorstore.as_retriever() works with create_retrieval_chain unchanged.
+    Each write goes to a new generation subdirectory, published by atomically replacing the
+    CURRENT pointer, so vectors and metadata always come from the same write. Searches pick
+    up a re-ingested index: when CURRENT points somewhere new, it is mapped before the next search.
+    """
+    def __init__(self, directory=LOCAL_INDEX_DIR, embedding=None):
+        self.directory = directory
+        self.embedding = embedding
+        self.lock = threading.Lock()
+        self._load()
+
+    def _files_version(self, generation=None):
+        generation = generation or current_generation(self.directory)
+        stat = os.stat(os.path.join(generation, VECTORS_FILE))
+        return generation, stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load(self):
+        generation = current_generation(self.directory)
+        vectors_path = os.path.join(generation, VECTORS_FILE)
+        metadata_path = os.path.join(generation, METADATA_FILE)
+        if not os.path.exists(vectors_path):
+            raise FileNotFoundError(f"No local vector index at {self.directory}; build it with process_documents first")
+        version = self._files_version(generation)
+        vectors = np.load(vectors_path, mmap_mode='r')
+        with open(metadata_path, 'r', encoding='utf-8') as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        if len(rows) != vectors.shape[0]:
+            raise ValueError(f"Local vector index at {self.directory} is inconsistent: "
+                             f"{vectors.shape[0]} vectors, {len(rows)} metadata rows")
+        self.vectors, self.rows, self.version = vectors, rows, version
+
+    def _reload_if_replaced(self):
+        try:
+            if self._files_version() == self.version:
+                return
+            with self.lock:
+                if self._files_version() != self.version:
+                    self._load()
+        except (OSError, ValueError):
+            # The generation went away while it was being read (e.g. an old index being pruned),
+            # or the index was written by hand inconsistently; keep the mapped index until the next search
+            pass
+
+    @property
+    def embeddings(self):
+        return self.embedding
+
+    def _scores(self, vectors, query_vector):
+        if vectors.dtype == np.float32:
+            return vectors @ query_vector
+        # float16 has no BLAS path, so score block by block in float32
+        return np.concatenate([
+            vectors[start:start + SEARCH_BLOCK_ROWS].astype(np.float32) @ query_vector
+            for start in range(0, vectors.shape[0], SEARCH_BLOCK_ROWS)
+        ]) if vectors.shape[0] else np.empty(0, dtype=np.float32)
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4):
+        self._reload_if_replaced()
+        vectors, rows = self.vectors, self.rows
+        if not rows:
+            return []
+        scores = self._scores(vectors, normalize(embedding))
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (Document(page_content=rows[i]['text'], metadata=rows[i]['metadata']), float(scores[i]))
+            for i in top
+        ]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector_with_score(self.embedding.embed_query(query), k)
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def _select_relevance_score_fn(self):
+        # Cosine similarity in [-1, 1] mapped to a relevance score in [0, 1]
+        return lambda score: (score + 1.0) / 2.0
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(i) for i in range(len(self.rows), len(self.rows) + len(texts))]
+        sink = LocalVectorSink(self.directory)
+        sink.upsert(list(zip(ids, self.embedding.embed_documents(texts), texts, metadatas)))
+        sink.close()
+        self._load()
+        return ids
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, directory=LOCAL_INDEX_DIR, **kwargs):
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(i) for i in range(len(texts))]
+        sink = LocalVectorSink(directory, reset=True)
+        sink.upsert(list(zip(ids, embedding.embed_documents(texts), texts, metadatas)))
+        sink.close()
+        return cls(directory, embedding)
+
+
+class LocalVectorSink:
+    """
+    Builds and updates a LocalVectorStore directory, with the same interface as the vector
+    sinks in process_documents. The existing index is read on open, changes are applied
+    in memory and close() writes a new generation, so nothing upserted is on disk before close().
+    """
+    writes_on_close = True
+
+    def __init__(self, directory=LOCAL_INDEX_DIR, dtype=LOCAL_INDEX_DTYPE, reset=False):
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self.records = {}
+        self.version = None
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        if not reset and index_exists(directory):
+            store = LocalVectorStore(directory)
+            for row, vector in zip(store.rows, store.vectors):
+                self.records[row['id']] = (np.asarray(vector, dtype=np.float32), row['text'], row['metadata'])
+
+    def is_empty(self):
+        return not self.records
+
+    def upsert(self, records):
+        vectors = normalize([vector for _, vector, _, _ in records]) if records else []
+        with self.lock:
+            for (record_id, _, text, metadata), vector in zip(records, vectors):
+                self.records[record_id] = (vector, text, metadata)
+
+    def update_metadata(self, updates):
+        with self.lock:
+            for record_id, metadata in updates.items():
+                if record_id in self.records:
+                    vector, text, current = self.records[record_id]
+                    self.records[record_id] = (vector, text, {**current, **metadata})
+
+    def delete(self, ids):
+        with self.lock:
+            for record_id in ids:
+                self.records.pop(record_id, None)
+
+    def delete_all(self):
+        with self.lock:
+            self.records.clear()
+
+    def set_version(self, version):
+        """
+        Content version to store with the next generation.
+        """
+        self.version = version
+
+    def close(self):
+        """
+        Write the matrix and metadata table into a new generation and point CURRENT at it,
+        replacing the previous index in one step. The generation before it is kept for
+        readers still loading it; older ones are removed.
+        """
+        with self.lock:
+            ids = sorted(self.records)
+            if ids:
+                matrix = np.stack([self.records[record_id][0] for record_id in ids]).astype(self.dtype)
+            else:
+                matrix = np.empty((0, 0), dtype=self.dtype)
+            previous = current_generation(self.directory)
+            name = f"generation-{time.time_ns()}"
+            generation = os.path.join(self.directory, name)
+            os.makedirs(generation)
+            with open(os.path.join(generation, VECTORS_FILE), 'wb') as f:
+                np.save(f, matrix)
+            with open(os.path.join(generation, METADATA_FILE), 'w', encoding='utf-8') as f:
+                for record_id in ids:
+                    _, text, metadata = self.records[record_id]
+                    f.write(json.dumps({'id': record_id, 'text': text, 'metadata': metadata}) + '\n')
+            if self.version is not None:
+                with open(os.path.join(generation, VERSION_FILE), 'w', encoding='utf-8') as f:
+                    f.write(self.version)
+            pointer_tmp = os.path.join(self.directory, CURRENT_FILE + '.tmp')
+            with open(pointer_tmp, 'w', encoding='utf-8') as f:
+                f.write(name)
+            os.replace(pointer_tmp, os.path.join(self.directory, CURRENT_FILE))
+            self._prune(keep={name, os.path.basename(previous)})
+
+    def _prune(self, keep):
+        for entry in os.listdir(self.directory):
+            if entry.startswith('generation-') and entry not in keep:
+                shutil.rmtree(os.path.join(self.directory, entry), ignore_errors=True)
+        # Files of an index written before generations, now superseded
+        for name in (VECTORS_FILE, METADATA_FILE):
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path):
+                os.remove(path)
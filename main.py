@@ -4,10 +4,24 @@ Main.py
 
 # Import statements
 import os
+import json
+import time
+import asyncio
+import logging
+import hashlib
+import itertools
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
 # LangChain Imports necessary for RAG
-from langchain_openai import OpenAIEmbeddings # handle word embeddings
+from embedding_cache import cached_embeddings # handle word embeddings, behind the on-disk cache
 from langchain_pinecone import PineconeVectorStore
+from local_vector_store import VECTOR_BACKEND, LocalVectorStore
+from care_plan_cache import CARE_PLAN_CACHE_ENABLED, CarePlanCache
+from openai_scheduler import BATCH, OPENAI_CLIENT_MAX_RETRIES, request_priority, scheduled_chat
+from telemetry import record, span
+from context_packing import CONTEXT_PACKING_ENABLED, DOCUMENT_SEPARATOR, ContextPacker, document_sources
 from langchain_core.prompts import PromptTemplate
 from langchain_openai import ChatOpenAI
 import langchain_core.prompts.chat
@@ -21,7 +35,6 @@ from langchain import hub
 
 # New imports for creating document chains + retrieval
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.chains.retrieval import create_retrieval_chain
 
 # Runnable PassThrough - node connections with no ops
 from langchain_core.runnables import RunnablePassthrough
@@ -33,6 +46,7 @@ from langchain.chains.combine_documents import create_stuff_documents_chain
 from dotenv import load_dotenv
 load_dotenv()
 
+logger = logging.getLogger(__name__)
 
 
 
@@ -85,42 +99,9 @@ Further assessments may be needed to fully understand the patient's frailty stat
 This care plan is based on the information provided and is intended to guide caregivers in supporting the patient. It is not a substitute for professional medical advice. Always consult with healthcare professionals for a comprehensive assessment and personalized care plan.
 """
 
-# --------- Function to Generate Care Plan ---------
-
-def generate_frailty_care_plan(
-    first_gait_test_speed: float,
-    first_gait_test_time: float,
-    first_tug_test_time: float,
-    gait_speed_test_risk: str,
-    second_gait_test_speed: float,
-    second_gait_test_time: float,
-    second_tug_test_time: float,
-    tug_test_risk: str,
-    older_than_85: bool,
-    is_male: bool,
-    has_limiting_health_problems: bool,
-    needs_regular_help: bool,
-    has_homebound_health_problems: bool,
-    has_close_help: bool,
-    uses_mobility_aid: bool
-):
-    # Initialize OpenAI Embeddings
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
-
-    # Connect to PineCone vector store
-    vectorstore = PineconeVectorStore(
-        index_name=os.environ["INDEX_NAME"],
-        embedding=embeddings
-    )
-
-    # Create the retriever
-    retriever = vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": 10})
-
-    # Create the chat model
-    chat = ChatOpenAI(verbose=True, temperature=0, model="gpt-4")
+# --------- Prompts ---------
 
-    # Create the prompts
-    first_invocation_prompt = PromptTemplate.from_template("""
+FIRST_INVOCATION_TEMPLATE = """
     You are an expert chatbot focused on frailty care, analyzing a patient's condition based on their PRISMA-7 survey responses and test results. Your task is to provide a factual analysis based solely on the given information. Do not make assumptions or infer information that is not explicitly stated.
 
     Patient's PRISMA-7 Responses and GAIT/TUG Test Results:
@@ -151,9 +132,9 @@ def generate_frailty_care_plan(
     Your goal is to provide an accurate understanding of the patient's frailty status based strictly on the given information. If there are gaps in the information or if more assessment is needed, state this clearly.
 
     Remember, do not provide any medical advice. Your role is to analyze the given information to support the development of a care plan by healthcare professionals.
-    """)
+    """
 
-    second_invocation_prompt = PromptTemplate.from_template("""
+SECOND_INVOCATION_TEMPLATE = """
     You are an expert chatbot focused on frailty care, tasked with creating a comprehensive, personalized care plan. Your goal is to synthesize the provided analysis into an actionable, tailored care plan that supports both the caretaker and the frailty patient.
 
     You avoid humor or casual language due to the seriousness of the topic.
@@ -213,14 +194,112 @@ def generate_frailty_care_plan(
     {example}
     </example>
     
-    """)
+    """
+
+# Sectioned generation: the second invocation split into independent sections, generated
+# concurrently from the shared analysis and joined in this order
+SECTION_INVOCATION_TEMPLATE = """
+    You are an expert chatbot focused on frailty care, writing one section of a comprehensive, personalized care plan that supports both the caretaker and the frailty patient. The other sections of the care plan are written separately, so write only the section described below, and do not add an introduction or a conclusion.
+
+    You avoid humor or casual language due to the seriousness of the topic.
+
+    You are provided the following information and analysis of the patient's condition.
+    Patient's PRISMA-7 Responses, and Gait and TUG Test results:
+    <input>
+    {input}
+    </input>
+
+    I have conducted the following analysis of the patient's condition:
+    <analysis>
+    {analysis}
+    </analysis>
 
-    # Create the chains
-    stuff_documents_chain = create_stuff_documents_chain(chat, first_invocation_prompt)
-    qa = create_retrieval_chain(retriever=retriever, combine_docs_chain=stuff_documents_chain)
+    Write this section of the care plan:
+    <section>
+    {section}
+    </section>
+
+    In this section:
+    - Ensure each point is clearly linked to specific aspects of the patient's condition.
+    - Prioritize what addresses the most critical aspects of the patient's frailty status.
+    - Provide clear, actionable guidance that can be readily implemented by caregivers.
+
+    If there are any uncertainties or gaps in your knowledge, please say so and do not make up information.
+
+    While knowledgeable about frailty care, you stay within your role of developing a care plan to support the caretaker and frailty patient, without providing definitive medical advice. Should there be any uncertainty, you should state this, and suggest the user to speak with a licensed healthcare professional.
 
-    # Prepare the input data
-    input_data = {
+    Here is the same section from an example care plan for another patient; write your section in its format:
+    <example>
+    {example}
+    </example>
+    """
+
+CARE_PLAN_SECTIONS = [
+    'Summarize all the responses from the PRISMA-7 survey, and the Gait and TUG test results. End the section with the sentence "As a caretaker, you should consider the following:".',
+    'Frailty Status: Provide a concise summary of the patient\'s overall frailty status, highlighting key areas of concern.',
+    'Care Recommendations: Outline 4-5 key care recommendations. For each recommendation: a) clearly state the recommendation, b) explain the rationale behind it, citing specific aspects of the patient\'s condition, c) provide detailed, practical steps for implementation, d) identify potential challenges and suggest strategies to overcome them. Include both short-term interventions for immediate concerns and long-term strategies for ongoing care.',
+    'Safety Considerations: Address safety considerations specific to this patient\'s situation, including both home safety and broader health and wellbeing measures.',
+    'Monitoring and Evaluation: Suggest a monitoring and evaluation plan to track the patient\'s progress and adjust care as needed.',
+    'Resources and Support Services: Recommend specific resources or support services that would be particularly beneficial for this patient.',
+    'Additional Assessments: Identify any areas where additional assessment or professional consultation might be necessary, explaining why, and what additional information or next steps would be required from healthcare providers.',
+]
+# Heading that starts each section's part of example_care_plan, in CARE_PLAN_SECTIONS order
+EXAMPLE_SECTION_HEADINGS = ["Patient Summary:", "Frailty Status:", "Care Recommendations:", "Safety Considerations:",
+                            "Monitoring and Evaluation:", "Resources and Support Services:", "Additional Assessments:"]
+SECTION_SEPARATOR = "\n\n"
+SECTIONED_GENERATION = os.environ.get("SECTIONED_GENERATION", "0") == "1"
+
+# Model settings
+CHAT_MODEL = "gpt-4"
+EMBEDDING_MODEL = "text-embedding-3-large"
+
+# Retrieval settings
+RETRIEVAL_K = 10
+
+# Care plans generated at once by the batch API
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "8"))
+
+# Precomputed retrieval context, one entry per PRISMA-7 answer combination and risk levels
+RETRIEVAL_CONTEXT_ENABLED = os.environ.get("RETRIEVAL_CONTEXT_ENABLED", "1") == "1"
+RETRIEVAL_CONTEXT_PATH = os.environ.get(
+    "RETRIEVAL_CONTEXT_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.retrieval_context.json'),
+)
+RISK_LEVELS = [level.strip() for level in os.environ.get("RISK_LEVELS", "Low,Medium,High").split(",")]
+PRISMA_QUESTIONS = [
+    "Are you older than 85 years?",
+    "Are you male?",
+    "In general, do you have any health problems that require you to limit your activities?",
+    "Do you need someone to help you on a regular basis?",
+    "In general, do you have any health problems that require you to stay at home?",
+    "If you need help, can you count on someone close to you?",
+    "Do you regularly use a stick, walker or wheelchair to move about?",
+]
+RISK_FIELDS = ["Gait Speed Test Risk", "TUG Test Risk"]
+
+# --------- Care Plan Engine ---------
+
+def build_input_data(
+    first_gait_test_speed: float,
+    first_gait_test_time: float,
+    first_tug_test_time: float,
+    gait_speed_test_risk: str,
+    second_gait_test_speed: float,
+    second_gait_test_time: float,
+    second_tug_test_time: float,
+    tug_test_risk: str,
+    older_than_85: bool,
+    is_male: bool,
+    has_limiting_health_problems: bool,
+    needs_regular_help: bool,
+    has_homebound_health_problems: bool,
+    has_close_help: bool,
+    uses_mobility_aid: bool
+):
+    """
+    Turn the PRISMA-7 answers and Gait/TUG readings into the input shown to the model.
+    """
+    return {
         "Are you older than 85 years?": "Yes" if older_than_85 else "No",
         "Are you male?": "Yes" if is_male else "No",
         "In general, do you have any health problems that require you to limit your activities?": "Yes" if has_limiting_health_problems else "No",
@@ -238,26 +317,677 @@ def generate_frailty_care_plan(
         "TUG Test Risk": tug_test_risk,
     }
 
-    # Run the first invocation
-    first_result = qa.invoke(input={"input": str(input_data)})
+def profile_key(input_data):
+    """
+    Canonical key for a patient profile: identical inputs produce identical care plans requests.
+    """
+    canonical = json.dumps(input_data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def retrieval_query(input_data):
+    """
+    The part of the input used to search the knowledge base: the PRISMA-7 answers and the
+    Gait/TUG risk levels. The exact readings are left to the prompts, so every patient with
+    the same answers and risk levels retrieves the same context.
+    """
+    return str({field: input_data[field] for field in PRISMA_QUESTIONS + RISK_FIELDS})
+
+def build_vectorstore(embeddings):
+    """
+    Connect to the vector store: PineCone, or the local memory-mapped index built by process_documents.
+    """
+    if VECTOR_BACKEND == "local":
+        return LocalVectorStore(embedding=embeddings)
+    return PineconeVectorStore(
+        index_name=os.environ["INDEX_NAME"],
+        embedding=embeddings
+    )
 
-    # Run the second invocation
-    final_care_plan = chat.invoke(second_invocation_prompt.format(
-        input=str(input_data),
-        analysis=first_result["answer"],
-        example=example_care_plan
-    ))
+CARE_PLAN_HEADER = "\nCare Plan:\n"
 
-    # Format the care plan as a big string
-    care_plan_string = f"""
-Care Plan:
-{final_care_plan.content}
+def format_sources(context):
+    """
+    The "Sources used" block that ends a care plan string, listing the sources of the retrieved context.
+    """
+    return f"""
 
 Sources used:
-{chr(10).join(f"{i+1}. {source}" for i, source in enumerate(sorted(set(doc.metadata["source"] for doc in first_result["context"]))))}
+{chr(10).join(f"{i+1}. {source}" for i, source in enumerate(sorted(set(source for doc in context for source in document_sources(doc)))))}
 """
 
-    return care_plan_string
+def format_care_plan(care_plan, context):
+    """
+    Format the care plan and the sources of the retrieved context as one big string.
+    """
+    return CARE_PLAN_HEADER + care_plan + format_sources(context)
+
+class StreamTimer:
+    """
+    Time to first token and total latency of one streamed care plan, measured from the start of the request.
+    """
+    def __init__(self, on_timing=None):
+        self.on_timing = on_timing
+        self.start = time.perf_counter()
+        self.first_token = None
+        self.tokens = 0
+
+    def token(self):
+        if self.first_token is None:
+            self.first_token = time.perf_counter() - self.start
+        self.tokens += 1
+
+    def done(self):
+        timing = {"time_to_first_token": self.first_token, "total": time.perf_counter() - self.start, "chunks": self.tokens}
+        logger.info("Care plan streamed: first token after %.2fs, total %.2fs (%d chunks)",
+                    timing["time_to_first_token"] or 0.0, timing["total"], timing["chunks"])
+        record("care_plan.stream", timing["total"], chunks=timing["chunks"],
+               first_token_seconds=timing["time_to_first_token"] or 0.0)
+        if self.on_timing is not None:
+            self.on_timing(timing)
+        return timing
+
+def example_sections(example=example_care_plan):
+    """
+    Split the example care plan into its parts, one per section of CARE_PLAN_SECTIONS, at EXAMPLE_SECTION_HEADINGS.
+    """
+    starts = [example.index("\n" + heading) + 1 for heading in EXAMPLE_SECTION_HEADINGS]
+    return [example[start:end].strip() for start, end in zip(starts, starts[1:] + [len(example)])]
+
+class CarePlanEngine:
+    """
+    Holds everything needed to generate care plans: embeddings, vector store, retriever,
+    chat model, prompts and chains. Build it once at startup and reuse it, so clients keep
+    their HTTP connection pools warm and nothing is reconstructed per request.
+    chat and retriever can be passed in, e.g. fakes for testing.
+    """
+    def __init__(self, chat=None, retriever=None, embeddings=None, k=RETRIEVAL_K, context_table=None, context_packer=None,
+                 sectioned=SECTIONED_GENERATION):
+        self.embeddings = embeddings
+        self.vectorstore = None
+        if retriever is None:
+            # Initialize OpenAI Embeddings, reusing cached vectors for queries seen before
+            self.embeddings = embeddings or cached_embeddings(EMBEDDING_MODEL)
+            self.vectorstore = build_vectorstore(self.embeddings)
+            retriever = self.vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": k})
+        self.retriever = retriever
+
+        # Create the chat model, sharing the OpenAI rate limits with everything else in the process;
+        # stream_usage makes streamed completions report their token usage too
+        self.chat = chat or scheduled_chat(ChatOpenAI(verbose=True, temperature=0, model=CHAT_MODEL, stream_usage=True,
+                                                      max_retries=OPENAI_CLIENT_MAX_RETRIES))
+
+        # Create the prompts
+        self.first_invocation_prompt = PromptTemplate.from_template(FIRST_INVOCATION_TEMPLATE)
+        self.second_invocation_prompt = PromptTemplate.from_template(SECOND_INVOCATION_TEMPLATE)
+        self.section_invocation_prompt = PromptTemplate.from_template(SECTION_INVOCATION_TEMPLATE)
+        self.sectioned = sectioned
+
+        # Create the chain for the analysis step; its context comes from retrieve()
+        self.stuff_documents_chain = create_stuff_documents_chain(self.chat, self.first_invocation_prompt)
+
+        # Precomputed context per discrete profile, with live search as the fallback
+        if context_table is None and RETRIEVAL_CONTEXT_ENABLED:
+            context_table = RetrievalContextTable(k=k)
+        self.context_table = context_table or None
+
+        # Merge, dedupe and budget the retrieved chunks before they reach the first prompt
+        if context_packer is None and CONTEXT_PACKING_ENABLED:
+            context_packer = ContextPacker(model=CHAT_MODEL)
+        self.context_packer = context_packer or None
+
+    def cache_variant(self):
+        """
+        The generation settings a cached care plan depends on beyond the prompts, models and index.
+        """
+        parts = [f"sectioned={self.sectioned}"]
+        if self.sectioned:
+            parts += [SECTION_INVOCATION_TEMPLATE] + CARE_PLAN_SECTIONS
+        if self.context_packer is not None:
+            parts.append(f"packing={self.context_packer.token_budget},{self.context_packer.threshold}")
+        return "\n".join(parts)
+
+    def pack_context(self, input_data, context):
+        """
+        Pack the retrieved context with the engine's ContextPacker, recording prompt tokens before and after.
+        """
+        if self.context_packer is None:
+            return context
+        with span("care_plan.pack") as stage:
+            packed = self.context_packer.pack(context)
+            count_tokens = self.context_packer.count_tokens
+            before, after = (
+                count_tokens(self.first_invocation_prompt.format(
+                    input=str(input_data), context=DOCUMENT_SEPARATOR.join(doc.page_content for doc in docs)))
+                for docs in (context, packed)
+            )
+            self.context_packer.record(len(context), len(packed), before, after)
+            stage.add("prompt_tokens_before", before)
+            stage.add("prompt_tokens_after", after)
+        return packed
+
+    def retrieve(self, input_data):
+        """
+        Context for the first invocation: from the precomputed table when it is current, else a live search.
+        """
+        with span("care_plan.retrieval") as stage:
+            context = self.context_table.lookup(input_data) if self.context_table is not None else None
+            stage.set(source="table" if context is not None else "live")
+            if context is None:
+                context = self.retriever.invoke(retrieval_query(input_data))
+            stage.add("documents", len(context))
+        return context
+
+    async def aretrieve(self, input_data):
+        with span("care_plan.retrieval") as stage:
+            context = self.context_table.lookup(input_data) if self.context_table is not None else None
+            stage.set(source="table" if context is not None else "live")
+            if context is None:
+                context = await self.retriever.ainvoke(retrieval_query(input_data))
+            stage.add("documents", len(context))
+        return context
+
+    def first_invocation(self, input_data):
+        """
+        Run the first invocation; returns {"context": retrieved documents, "answer": analysis}.
+        """
+        context = self.pack_context(input_data, self.retrieve(input_data))
+        with span("care_plan.first_chain") as stage:
+            answer = self.stuff_documents_chain.invoke({"input": str(input_data), "context": context},
+                                                       config={"callbacks": stage.callbacks()})
+        return {"context": context, "answer": answer}
+
+    async def afirst_invocation(self, input_data):
+        context = self.pack_context(input_data, await self.aretrieve(input_data))
+        with span("care_plan.first_chain") as stage:
+            answer = await self.stuff_documents_chain.ainvoke({"input": str(input_data), "context": context},
+                                                              config={"callbacks": stage.callbacks()})
+        return {"context": context, "answer": answer}
+
+    def second_invocation_input(self, input_data, analysis):
+        return self.second_invocation_prompt.format(
+            input=str(input_data),
+            analysis=analysis,
+            example=example_care_plan
+        )
+
+    def section_invocation_inputs(self, input_data, analysis):
+        """
+        One prompt per section of CARE_PLAN_SECTIONS, each with only its own part of the example care plan.
+        """
+        return [
+            self.section_invocation_prompt.format(
+                input=str(input_data),
+                analysis=analysis,
+                section=section,
+                example=example
+            )
+            for section, example in zip(CARE_PLAN_SECTIONS, example_sections())
+        ]
+
+    def second_invocation(self, input_data, analysis):
+        """
+        Write the care plan text from the analysis: in one call, or in sectioned mode one
+        call per section of CARE_PLAN_SECTIONS, run concurrently and joined in order.
+        """
+        with span("care_plan.second_call", sectioned=self.sectioned) as stage:
+            if not self.sectioned:
+                return self.chat.invoke(self.second_invocation_input(input_data, analysis),
+                                        config={"callbacks": stage.callbacks()}).content
+            prompts = self.section_invocation_inputs(input_data, analysis)
+            sections = self.chat.batch(prompts, config={"max_concurrency": len(prompts), "callbacks": stage.callbacks()})
+            return SECTION_SEPARATOR.join(section.content for section in sections)
+
+    async def asecond_invocation(self, input_data, analysis):
+        with span("care_plan.second_call", sectioned=self.sectioned) as stage:
+            config = {"callbacks": stage.callbacks()}
+            if not self.sectioned:
+                return (await self.chat.ainvoke(self.second_invocation_input(input_data, analysis), config=config)).content
+            prompts = self.section_invocation_inputs(input_data, analysis)
+            sections = await asyncio.gather(*(self.chat.ainvoke(prompt, config=config) for prompt in prompts))
+            return SECTION_SEPARATOR.join(section.content for section in sections)
+
+    def stream_second_invocation(self, input_data, analysis):
+        """
+        Streaming version of second_invocation. In sectioned mode the first section streams
+        token by token while the others run in the background, then follow whole, in order.
+        """
+        with span("care_plan.second_call", sectioned=self.sectioned, streamed=True) as stage:
+            config = {"callbacks": stage.callbacks()}
+            if not self.sectioned:
+                for chunk in self.chat.stream(self.second_invocation_input(input_data, analysis), config=config):
+                    yield chunk.content
+                return
+            prompts = self.section_invocation_inputs(input_data, analysis)
+            with ThreadPoolExecutor(max_workers=len(prompts) - 1) as executor:
+                # Keep the caller's request priority and span in the section threads
+                rest = [executor.submit(contextvars.copy_context().run, self.chat.invoke, prompt, config)
+                        for prompt in prompts[1:]]
+                try:
+                    for chunk in self.chat.stream(prompts[0], config=config):
+                        yield chunk.content
+                    for future in rest:
+                        yield SECTION_SEPARATOR
+                        yield future.result().content
+                finally:
+                    for future in rest:
+                        future.cancel()
+
+    async def astream_second_invocation(self, input_data, analysis):
+        with span("care_plan.second_call", sectioned=self.sectioned, streamed=True) as stage:
+            config = {"callbacks": stage.callbacks()}
+            if not self.sectioned:
+                async for chunk in self.chat.astream(self.second_invocation_input(input_data, analysis), config=config):
+                    yield chunk.content
+                return
+            prompts = self.section_invocation_inputs(input_data, analysis)
+            rest = [asyncio.ensure_future(self.chat.ainvoke(prompt, config=config)) for prompt in prompts[1:]]
+            try:
+                async for chunk in self.chat.astream(prompts[0], config=config):
+                    yield chunk.content
+                for task in rest:
+                    yield SECTION_SEPARATOR
+                    yield (await task).content
+            finally:
+                for task in rest:
+                    task.cancel()
+
+    def generate(self, input_data):
+        """
+        Generate the care plan string for one patient's input data (see build_input_data).
+        """
+        # Run the first invocation
+        first_result = self.first_invocation(input_data)
+
+        # Run the second invocation
+        final_care_plan = self.second_invocation(input_data, first_result["answer"])
+
+        return format_care_plan(final_care_plan, first_result["context"])
+
+    async def agenerate(self, input_data):
+        """
+        Async version of generate, built on the chains' async interfaces.
+        """
+        first_result = await self.afirst_invocation(input_data)
+        final_care_plan = await self.asecond_invocation(input_data, first_result["answer"])
+        return format_care_plan(final_care_plan, first_result["context"])
+
+    def stream(self, input_data, on_timing=None):
+        """
+        Like generate, but yields the care plan string in pieces as the second invocation
+        streams its tokens, ending with the "Sources used" block. The pieces join up to the
+        same string generate returns. Time to first token and total latency are logged and,
+        if given, passed to on_timing as a dict.
+        """
+        timer = StreamTimer(on_timing)
+        first_result = self.first_invocation(input_data)
+        yield CARE_PLAN_HEADER
+        for piece in self.stream_second_invocation(input_data, first_result["answer"]):
+            if piece:
+                timer.token()
+                yield piece
+        yield format_sources(first_result["context"])
+        timer.done()
+
+    async def astream(self, input_data, on_timing=None):
+        """
+        Async iterator version of stream.
+        """
+        timer = StreamTimer(on_timing)
+        first_result = await self.afirst_invocation(input_data)
+        yield CARE_PLAN_HEADER
+        async for piece in self.astream_second_invocation(input_data, first_result["answer"]):
+            if piece:
+                timer.token()
+                yield piece
+        yield format_sources(first_result["context"])
+        timer.done()
+
+    async def agenerate_batch(self, inputs, max_concurrency=BATCH_MAX_CONCURRENCY):
+        """
+        Generate care plans for many inputs concurrently, at most max_concurrency at a time.
+        Returns results in input order; an item that failed holds its exception instead of a string.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run(input_data):
+            async with semaphore:
+                return await self.agenerate(input_data)
+
+        return await asyncio.gather(*(run(input_data) for input_data in inputs), return_exceptions=True)
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """
+    The shared CarePlanEngine, built on first use.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = CarePlanEngine()
+        return _engine
+
+_engine_loop = None
+
+def run_in_engine_loop(coroutine):
+    """
+    Run a coroutine to completion from synchronous code, on one event loop that lives for
+    the whole process. The async OpenAI clients keep pooled connections bound to the loop
+    that first used them, so a fresh asyncio.run() per call would break them. The caller's
+    context (e.g. request_priority) carries over to the coroutine.
+    """
+    global _engine_loop
+    with _engine_lock:
+        if _engine_loop is None:
+            _engine_loop = asyncio.new_event_loop()
+            threading.Thread(target=_engine_loop.run_forever, name="care-plan-loop", daemon=True).start()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is _engine_loop:
+        raise RuntimeError("run_in_engine_loop() called from the engine loop; await the coroutine instead")
+    return asyncio.run_coroutine_threadsafe(coroutine, _engine_loop).result()
+
+# --------- Care Plan Cache ---------
+
+INDEX_VERSION_CHECK_INTERVAL = 60  # Seconds between reads of the index version record
+_index_version = (None, 0.0)  # (version, monotonic time it was read)
+_index_version_lock = threading.Lock()
+
+def index_version():
+    """
+    Content version of the vector index (see process_documents.content_version), read from
+    the record ingestion stores with the index: a file in the local index's live generation,
+    or a record in its own namespace of the Pinecone index. Every host serving the index can
+    read it, ingesting or not. None when the index has no version record yet (it predates
+    them, run process_documents once) or it cannot be read; caches keyed by it are then bypassed.
+    """
+    global _index_version
+    with _index_version_lock:
+        version, checked = _index_version
+        if checked and time.monotonic() - checked < INDEX_VERSION_CHECK_INTERVAL:
+            return version
+        try:
+            if VECTOR_BACKEND == "local":
+                from local_vector_store import read_index_version
+
+                version = read_index_version()
+            else:
+                from process_documents import read_pinecone_index_version
+
+                version = read_pinecone_index_version(os.environ["INDEX_NAME"])
+        except Exception as e:
+            # Keep the last version read; a new one is tried after the interval
+            logger.warning(f"Could not read the index version: {e}")
+        if version is None and (not checked or _index_version[0] is not None):
+            logger.warning("The vector index has no version record; care-plan and context caches are bypassed")
+        _index_version = (version, time.monotonic())
+        return version
+
+def care_plan_cache_version():
+    """
+    Cached care plans are only valid for the same prompts, models and index contents.
+    None, which bypasses the cache, while the index version is unknown.
+    """
+    version = index_version()
+    if version is None:
+        return None
+    parts = [FIRST_INVOCATION_TEMPLATE, SECOND_INVOCATION_TEMPLATE, example_care_plan,
+             CHAT_MODEL, EMBEDDING_MODEL, str(RETRIEVAL_K), VECTOR_BACKEND, version]
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+_care_plan_cache = None
+
+def get_care_plan_cache():
+    """
+    The shared care-plan cache, opened on first use; None when CARE_PLAN_CACHE_ENABLED is off.
+    """
+    global _care_plan_cache
+    with _engine_lock:
+        if _care_plan_cache is None and CARE_PLAN_CACHE_ENABLED:
+            _care_plan_cache = CarePlanCache(version=care_plan_cache_version)
+        return _care_plan_cache
+
+# --------- Precomputed Retrieval Context ---------
+
+def discrete_profiles(risk_levels=RISK_LEVELS):
+    """
+    Every discrete profile: each combination of PRISMA-7 answers with each pair of
+    Gait/TUG risk levels, as the fields retrieval_query reads.
+    """
+    for answers in itertools.product(["Yes", "No"], repeat=len(PRISMA_QUESTIONS)):
+        for gait_risk, tug_risk in itertools.product(risk_levels, repeat=2):
+            profile = dict(zip(PRISMA_QUESTIONS, answers))
+            profile.update(zip(RISK_FIELDS, [gait_risk, tug_risk]))
+            yield profile
+
+def retrieval_context_settings(k=RETRIEVAL_K):
+    """
+    Settings a precomputed table must have been built with to stand in for a live search.
+    """
+    return {"index_version": index_version(), "backend": VECTOR_BACKEND,
+            "embedding_model": EMBEDDING_MODEL, "k": k}
+
+class RetrievalContextTable:
+    """
+    Retrieved context for every discrete profile, keyed by retrieval_query and stored as JSON
+    (each chunk once, profiles refer to chunks by position). Read on first use and re-read
+    when the file changes. lookup() returns None, so the caller searches live, when the
+    profile is not in the table or the table was built for an older index or other settings.
+    """
+    def __init__(self, path=RETRIEVAL_CONTEXT_PATH, k=RETRIEVAL_K):
+        self.path = path
+        self.k = k
+        self.lock = threading.Lock()
+        self.settings = None
+        self.documents = []
+        self.contexts = {}
+        self._mtime = None
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def _refresh(self):
+        mtime = os.path.getmtime(self.path) if os.path.exists(self.path) else None
+        if mtime == self._mtime:
+            return
+        from langchain_core.documents import Document
+
+        settings, documents, contexts = None, [], {}
+        if mtime is not None:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                table = json.load(f)
+            settings = table["settings"]
+            documents = [Document(page_content=doc["page_content"], metadata=doc["metadata"]) for doc in table["documents"]]
+            contexts = table["contexts"]
+        self.settings, self.documents, self.contexts, self._mtime = settings, documents, contexts, mtime
+
+    def lookup(self, input_data):
+        with self.lock:
+            self._refresh()
+            if self.settings is None:
+                self.misses += 1
+                return None
+            # A table built, or read, while the index version was unknown cannot be trusted
+            if self.settings["index_version"] is None or self.settings != retrieval_context_settings(self.k):
+                self.stale += 1
+                return None
+            positions = self.contexts.get(retrieval_query(input_data))
+            if positions is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return [self.documents[i] for i in positions]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "stale": self.stale, "profiles": len(self.contexts)}
+
+def build_retrieval_context_table(engine=None, risk_levels=RISK_LEVELS, path=RETRIEVAL_CONTEXT_PATH,
+                                  max_concurrency=BATCH_MAX_CONCURRENCY):
+    """
+    Retrieve the context for every discrete profile and store it at path. Run at the end
+    of ingestion, after the index has been updated.
+    """
+    engine = engine or get_engine()
+    # Read the settings first, so a table built while the index changes is already stale
+    settings = retrieval_context_settings(RETRIEVAL_K if engine.context_table is None else engine.context_table.k)
+    queries = [retrieval_query(profile) for profile in discrete_profiles(risk_levels)]
+    with request_priority(BATCH):
+        results = engine.retriever.batch(queries, config={"max_concurrency": max_concurrency})
+
+    documents = []
+    positions = {}  # chunk -> position in documents
+    contexts = {}
+    for query, context in zip(queries, results):
+        contexts[query] = []
+        for doc in context:
+            chunk = json.dumps([doc.page_content, doc.metadata], sort_keys=True)
+            if chunk not in positions:
+                positions[chunk] = len(documents)
+                documents.append({"page_content": doc.page_content, "metadata": doc.metadata})
+            contexts[query].append(positions[chunk])
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"settings": settings, "documents": documents, "contexts": contexts}, f)
+    os.replace(tmp_path, path)
+    print(f"Precomputed retrieval context for {len(contexts)} profiles ({len(documents)} unique chunks) in {path}")
+    return len(contexts)
+
+# --------- Function to Generate Care Plan ---------
+
+def generate_frailty_care_plan(
+    first_gait_test_speed: float,
+    first_gait_test_time: float,
+    first_tug_test_time: float,
+    gait_speed_test_risk: str,
+    second_gait_test_speed: float,
+    second_gait_test_time: float,
+    second_tug_test_time: float,
+    tug_test_risk: str,
+    older_than_85: bool,
+    is_male: bool,
+    has_limiting_health_problems: bool,
+    needs_regular_help: bool,
+    has_homebound_health_problems: bool,
+    has_close_help: bool,
+    uses_mobility_aid: bool
+):
+    """
+    Generate a care plan with the shared engine, reusing a cached care plan for the same
+    patient profile. Kept for existing callers; new code can hold a CarePlanEngine and
+    call generate(build_input_data(...)) directly.
+    """
+    assessment = dict(
+        first_gait_test_speed=first_gait_test_speed,
+        first_gait_test_time=first_gait_test_time,
+        first_tug_test_time=first_tug_test_time,
+        gait_speed_test_risk=gait_speed_test_risk,
+        second_gait_test_speed=second_gait_test_speed,
+        second_gait_test_time=second_gait_test_time,
+        second_tug_test_time=second_tug_test_time,
+        tug_test_risk=tug_test_risk,
+        older_than_85=older_than_85,
+        is_male=is_male,
+        has_limiting_health_problems=has_limiting_health_problems,
+        needs_regular_help=needs_regular_help,
+        has_homebound_health_problems=has_homebound_health_problems,
+        has_close_help=has_close_help,
+        uses_mobility_aid=uses_mobility_aid
+    )
+    with span("care_plan"):
+        engine = get_engine()
+        cache = get_care_plan_cache()
+        if cache is None:
+            return engine.generate(build_input_data(**assessment))
+        return cache.get_or_generate(assessment, lambda: engine.generate(build_input_data(**assessment)),
+                                     engine.cache_variant())
+
+async def agenerate_frailty_care_plan(**assessment):
+    """
+    Async version of generate_frailty_care_plan; takes the same keyword arguments.
+    """
+    with span("care_plan"):
+        engine = get_engine()
+        cache = get_care_plan_cache()
+        if cache is None:
+            return await engine.agenerate(build_input_data(**assessment))
+        return await cache.aget_or_generate(assessment, lambda: engine.agenerate(build_input_data(**assessment)),
+                                            engine.cache_variant())
+
+def stream_frailty_care_plan(on_timing=None, **assessment):
+    """
+    Streaming version of generate_frailty_care_plan: a generator of care plan text pieces,
+    taking the same keyword arguments. A cached care plan is yielded in one piece.
+    """
+    engine = get_engine()
+    cache = get_care_plan_cache()
+    key = cache.key(assessment, engine.cache_variant()) if cache is not None else None
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        yield cached
+        return
+    pieces = []
+    for piece in engine.stream(build_input_data(**assessment), on_timing):
+        pieces.append(piece)
+        yield piece
+    if cache is not None:
+        cache.put(key, "".join(pieces))
+
+async def astream_frailty_care_plan(on_timing=None, **assessment):
+    """
+    Async iterator version of stream_frailty_care_plan.
+    """
+    engine = get_engine()
+    cache = get_care_plan_cache()
+    key = cache.key(assessment, engine.cache_variant()) if cache is not None else None
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        yield cached
+        return
+    pieces = []
+    async for piece in engine.astream(build_input_data(**assessment), on_timing):
+        pieces.append(piece)
+        yield piece
+    if cache is not None:
+        cache.put(key, "".join(pieces))
+
+def generate_care_plans_batch(assessments, max_concurrency=BATCH_MAX_CONCURRENCY, engine=None):
+    """
+    Generate care plans for a list of assessments (dicts of generate_frailty_care_plan's
+    keyword arguments) concurrently. Returns results in input order; an item that failed
+    holds its exception instead of a care plan string. Profiles found in the care-plan
+    cache, and repeats within the batch, are not generated again. Call from synchronous
+    code only; async callers should await CarePlanEngine.agenerate_batch directly.
+    """
+    engine = engine or get_engine()
+    cache = get_care_plan_cache()
+    results = [None] * len(assessments)
+    inputs = {}  # cache key (or row index without a cache) -> input data to generate
+    rows = {}  # same key -> rows waiting for it
+    for i, assessment in enumerate(assessments):
+        try:
+            input_data = build_input_data(**assessment)
+        except Exception as e:
+            results[i] = e
+            continue
+        key = cache.key(assessment, engine.cache_variant()) if cache is not None else i
+        cached = cache.get(key) if cache is not None and key not in inputs else None
+        if cached is not None:
+            results[i] = cached
+            continue
+        inputs.setdefault(key, input_data)
+        rows.setdefault(key, []).append(i)
+    with request_priority(BATCH):
+        care_plans = run_in_engine_loop(engine.agenerate_batch(list(inputs.values()), max_concurrency))
+    for key, care_plan in zip(inputs, care_plans):
+        if cache is not None and not isinstance(care_plan, Exception):
+            cache.put(key, care_plan)
+        for i in rows[key]:
+            results[i] = care_plan
+    return results
 
 # Example usage:
 if __name__ == "__main__":
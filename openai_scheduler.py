@@ -0,0 +1,480 @@
+"""
+openai_scheduler.py
+Goal: share one OpenAI account fairly between ingestion and care-plan generation
+
+Every embedding and chat call made through the wrappers here waits for a slot from one
+process-wide scheduler. The scheduler keeps requests/min and tokens/min under the account
+limits with token buckets, serves interactive care-plan calls before batch work (ingestion,
+bulk runs), and adapts how many calls run at once to the 429s and latency it observes.
+The wrapped OpenAI clients are built with OPENAI_CLIENT_MAX_RETRIES (0 behind the scheduler),
+so 429s reach the scheduler instead of being retried inside the SDK; the wrappers retry them.
+"""
+
+# Import Statements:
+import os
+import time
+import random
+import asyncio
+import logging
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager, asynccontextmanager
+from typing import Any, Optional
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+SCHEDULER_ENABLED = os.environ.get("OPENAI_SCHEDULER_ENABLED", "1") == "1"
+REQUESTS_PER_MINUTE = float(os.environ.get("OPENAI_REQUESTS_PER_MINUTE", "500"))
+TOKENS_PER_MINUTE = float(os.environ.get("OPENAI_TOKENS_PER_MINUTE", "300000"))
+MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", "16"))
+MIN_CONCURRENCY = 1
+BATCH_CONCURRENCY_SHARE = float(os.environ.get("OPENAI_BATCH_CONCURRENCY_SHARE", "0.75"))  # Slots batch work may use
+CHAT_OUTPUT_TOKEN_ESTIMATE = 1000  # Tokens reserved for a chat completion until its real usage is known
+LATENCY_BACKOFF_RATIO = 2.0  # Shrink concurrency when latency per token reaches this multiple of its baseline
+LATENCY_WARMUP_CALLS = 20  # Calls observed before latency is used to shrink concurrency
+RATE_LIMIT_COOLDOWN = 2.0  # Seconds no new call starts after a 429
+POLL_INTERVAL = 0.05  # Longest wait between checks for a free slot
+# Retryable errors (429s, timeouts, 5xx) are retried by the wrappers, each attempt in a new slot,
+# backing off exponentially from RETRY_BACKOFF seconds, up to OPENAI_MAX_RETRIES times
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "6"))
+RETRY_BACKOFF = 0.5
+OPENAI_CLIENT_MAX_RETRIES = 0 if SCHEDULER_ENABLED else 2  # max_retries for the OpenAI clients the wrappers hold
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# Priorities: lower runs first
+INTERACTIVE = 0
+BATCH = 1
+
+_priority = contextvars.ContextVar("openai_priority", default=None)
+
+
+@contextmanager
+def request_priority(priority):
+    """
+    Run the calls made inside the block (and in tasks and LangChain threads started from it) at priority.
+    """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+def current_priority(default):
+    priority = _priority.get()
+    return default if priority is None else priority
+
+def estimate_tokens(text):
+    """
+    Rough token count, about 4 characters per token; only used to reserve capacity.
+    """
+    return len(text) // 4 + 1
+
+def is_rate_limit_error(error):
+    return getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+
+def is_retryable_error(error):
+    """
+    Errors the OpenAI SDK would have retried: rate limits, timeouts, connection problems and 5xx responses.
+    """
+    if is_rate_limit_error(error) or isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    if getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES:
+        return True
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError", "InternalServerError")
+
+def retry_delay(attempt):
+    return RETRY_BACKOFF * (2 ** attempt) * (0.5 + random.random())
+
+def mark_retried(error):
+    """
+    Tag an error the scheduler gave up on, so callers with their own retry loop do not retry it again.
+    """
+    if is_retryable_error(error):
+        error.scheduler_retried = True
+
+
+class TokenBucket:
+    """
+    Holds up to per_minute units and refills continuously at per_minute per minute.
+    """
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """
+        Seconds until amount units are available (requests bigger than the bucket wait for a full bucket).
+        """
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self.level -= amount  # May go negative when usage turns out higher than reserved
+
+    def drain(self):
+        self.level = min(self.level, 0.0)
+
+
+class OpenAIScheduler:
+    """
+    Hands out slots for OpenAI calls. A call waits until it is the highest-priority, oldest
+    waiter, a concurrency slot is free (batch work may only use BATCH_CONCURRENCY_SHARE of
+    them) and both buckets hold enough capacity. The concurrency limit is halved on a 429,
+    reduced by one when latency per token degrades, and grows back by one per limit's
+    worth of healthy calls.
+    """
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE,
+                 max_concurrency=MAX_CONCURRENCY, min_concurrency=MIN_CONCURRENCY, batch_share=BATCH_CONCURRENCY_SHARE):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.batch_share = batch_share
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.waiting = {}  # ticket -> (priority, ticket)
+        self.tickets = itertools.count()
+        self.condition = threading.Condition()
+        self.cooldown_until = 0.0
+        self.baseline_latency = None  # Slow moving average of seconds per 1000 tokens
+        self.recent_latency = None  # Fast moving average of the same
+        self.latency_samples = 0
+        self.healthy_calls = 0
+        self.calls = {INTERACTIVE: 0, BATCH: 0}
+        self.rate_limited = 0
+        self.retries = 0
+        self.waited = {INTERACTIVE: 0.0, BATCH: 0.0}
+
+    def _concurrency_for(self, priority):
+        limit = max(self.min_concurrency, int(self.limit))
+        if priority == INTERACTIVE:
+            return limit
+        return max(self.min_concurrency, int(limit * self.batch_share))
+
+    def _try_acquire(self, ticket, priority, requests, tokens):
+        """
+        Take the slot if this ticket may go now; otherwise return the seconds worth waiting. Call with the lock held.
+        """
+        now = time.monotonic()
+        if min(self.waiting.values()) != (priority, ticket):
+            return POLL_INTERVAL
+        if now < self.cooldown_until:
+            return self.cooldown_until - now
+        if self.in_flight >= self._concurrency_for(priority):
+            return POLL_INTERVAL
+        wait = max(self.requests.wait_time(requests, now), self.tokens.wait_time(tokens, now))
+        if wait > 0:
+            return wait
+        self.requests.take(requests)
+        self.tokens.take(tokens)
+        self.in_flight += 1
+        del self.waiting[ticket]
+        self.condition.notify_all()
+        return 0.0
+
+    def acquire(self, tokens, priority=INTERACTIVE, requests=1):
+        start = time.monotonic()
+        with self.condition:
+            ticket = next(self.tickets)
+            self.waiting[ticket] = (priority, ticket)
+            try:
+                while True:
+                    wait = self._try_acquire(ticket, priority, requests, tokens)
+                    if wait == 0.0:
+                        break
+                    self.condition.wait(min(wait, POLL_INTERVAL))
+            finally:
+                if ticket in self.waiting:
+                    del self.waiting[ticket]
+                    self.condition.notify_all()
+            self.waited[priority] += time.monotonic() - start
+
+    async def aacquire(self, tokens, priority=INTERACTIVE, requests=1):
+        start = time.monotonic()
+        with self.condition:
+            ticket = next(self.tickets)
+            self.waiting[ticket] = (priority, ticket)
+        try:
+            while True:
+                with self.condition:
+                    wait = self._try_acquire(ticket, priority, requests, tokens)
+                if wait == 0.0:
+                    break
+                await asyncio.sleep(min(wait, POLL_INTERVAL))
+        finally:
+            with self.condition:
+                if ticket in self.waiting:
+                    del self.waiting[ticket]
+                    self.condition.notify_all()
+        with self.condition:
+            self.waited[priority] += time.monotonic() - start
+
+    def release(self, priority, seconds, reserved_tokens, used_tokens=None, rate_limited=False):
+        """
+        Free the slot and adapt: correct the token bucket to the real usage, then adjust the concurrency limit.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            self.calls[priority] += 1
+            if used_tokens is not None:
+                self.tokens.take(used_tokens - reserved_tokens)
+            if rate_limited:
+                self.rate_limited += 1
+                self.limit = max(self.min_concurrency, self.limit / 2)
+                self.cooldown_until = time.monotonic() + RATE_LIMIT_COOLDOWN
+                self.requests.drain()
+                self.healthy_calls = 0
+                logger.warning("OpenAI rate limit hit; concurrency limit now %d", int(self.limit))
+            else:
+                latency = seconds * 1000.0 / max(used_tokens or reserved_tokens, 1)
+                self.recent_latency = latency if self.recent_latency is None else 0.7 * self.recent_latency + 0.3 * latency
+                self.baseline_latency = latency if self.baseline_latency is None else 0.98 * self.baseline_latency + 0.02 * latency
+                self.latency_samples += 1
+                if (self.latency_samples >= LATENCY_WARMUP_CALLS
+                        and self.recent_latency > LATENCY_BACKOFF_RATIO * self.baseline_latency):
+                    self.limit = max(self.min_concurrency, self.limit - 1)
+                    # One slow spell costs one slot; start measuring afresh from the baseline
+                    self.recent_latency = self.baseline_latency
+                    self.healthy_calls = 0
+                else:
+                    self.healthy_calls += 1
+                    if self.healthy_calls >= self.limit:
+                        self.limit = min(self.max_concurrency, self.limit + 1)
+                        self.healthy_calls = 0
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self, tokens, priority=INTERACTIVE, requests=1):
+        """
+        Hold a slot for one call. Set outcome["tokens"] to the real token usage when it is known.
+        """
+        self.acquire(tokens, priority, requests)
+        start = time.monotonic()
+        outcome = {"tokens": None, "rate_limited": False}
+        try:
+            yield outcome
+        except Exception as e:
+            outcome["rate_limited"] = is_rate_limit_error(e)
+            raise
+        finally:
+            self.release(priority, time.monotonic() - start, tokens, outcome["tokens"], outcome["rate_limited"])
+
+    @asynccontextmanager
+    async def aslot(self, tokens, priority=INTERACTIVE, requests=1):
+        await self.aacquire(tokens, priority, requests)
+        start = time.monotonic()
+        outcome = {"tokens": None, "rate_limited": False}
+        try:
+            yield outcome
+        except Exception as e:
+            outcome["rate_limited"] = is_rate_limit_error(e)
+            raise
+        finally:
+            self.release(priority, time.monotonic() - start, tokens, outcome["tokens"], outcome["rate_limited"])
+
+    def call(self, function, tokens, priority=INTERACTIVE, requests=1, used_tokens=None):
+        """
+        Run function() in a slot, retrying retryable errors in a fresh slot after a backoff.
+        used_tokens(result) reports the real token usage, when the result carries it.
+        """
+        for attempt in itertools.count():
+            try:
+                with self.slot(tokens, priority, requests) as outcome:
+                    result = function()
+                    if used_tokens is not None:
+                        outcome["tokens"] = used_tokens(result)
+                    return result
+            except Exception as e:
+                if attempt >= OPENAI_MAX_RETRIES or not is_retryable_error(e):
+                    mark_retried(e)
+                    raise
+                self._count_retry(e)
+            time.sleep(retry_delay(attempt))
+
+    async def acall(self, function, tokens, priority=INTERACTIVE, requests=1, used_tokens=None):
+        """
+        Like call(), for a function returning an awaitable.
+        """
+        for attempt in itertools.count():
+            try:
+                async with self.aslot(tokens, priority, requests) as outcome:
+                    result = await function()
+                    if used_tokens is not None:
+                        outcome["tokens"] = used_tokens(result)
+                    return result
+            except Exception as e:
+                if attempt >= OPENAI_MAX_RETRIES or not is_retryable_error(e):
+                    mark_retried(e)
+                    raise
+                self._count_retry(e)
+            await asyncio.sleep(retry_delay(attempt))
+
+    def _count_retry(self, error):
+        with self.condition:
+            self.retries += 1
+        logger.info("Retrying OpenAI call after %s", type(error).__name__)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "concurrency_limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "waiting": len(self.waiting),
+                "interactive_calls": self.calls[INTERACTIVE],
+                "batch_calls": self.calls[BATCH],
+                "interactive_wait_seconds": self.waited[INTERACTIVE],
+                "batch_wait_seconds": self.waited[BATCH],
+                "rate_limited": self.rate_limited,
+                "retries": self.retries,
+            }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    """
+    The process-wide scheduler, created on first use.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = OpenAIScheduler()
+        return _scheduler
+
+
+# --------- Wrappers ---------
+
+class ScheduledEmbeddings(Embeddings):
+    """
+    Wraps a LangChain Embeddings object so every call waits for a scheduler slot.
+    priority applies unless the caller set one with request_priority.
+    """
+    def __init__(self, embeddings, priority=INTERACTIVE, scheduler=None):
+        self.embeddings = embeddings
+        self.priority = priority
+        self.scheduler = scheduler or get_scheduler()
+
+    def _cost(self, texts):
+        # OpenAIEmbeddings sends up to chunk_size texts per request
+        chunk_size = getattr(self.embeddings, "chunk_size", None) or 1000
+        return sum(estimate_tokens(text) for text in texts), max(1, -(-len(texts) // chunk_size))
+
+    def embed_documents(self, texts):
+        tokens, requests = self._cost(texts)
+        return self.scheduler.call(lambda: self.embeddings.embed_documents(texts),
+                                   tokens, current_priority(self.priority), requests)
+
+    def embed_query(self, text):
+        return self.scheduler.call(lambda: self.embeddings.embed_query(text),
+                                   estimate_tokens(text), current_priority(self.priority))
+
+    async def aembed_documents(self, texts):
+        tokens, requests = self._cost(texts)
+        return await self.scheduler.acall(lambda: self.embeddings.aembed_documents(texts),
+                                          tokens, current_priority(self.priority), requests)
+
+    async def aembed_query(self, text):
+        return await self.scheduler.acall(lambda: self.embeddings.aembed_query(text),
+                                          estimate_tokens(text), current_priority(self.priority))
+
+
+class ScheduledChatModel(BaseChatModel):
+    """
+    Wraps a LangChain chat model (e.g. ChatOpenAI) so every completion, streamed or not,
+    holds a scheduler slot for its whole duration. Usable anywhere the wrapped model is.
+    """
+    chat: BaseChatModel
+    priority: int = INTERACTIVE
+    scheduler: Optional[Any] = None
+
+    @property
+    def _llm_type(self):
+        return f"scheduled-{self.chat._llm_type}"
+
+    def _scheduler(self):
+        return self.scheduler or get_scheduler()
+
+    def _combine_llm_outputs(self, llm_outputs):
+        # Keep the wrapped model's token usage in the combined result
+        return self.chat._combine_llm_outputs(llm_outputs)
+
+    def _reserve(self, messages):
+        return sum(estimate_tokens(str(message.content)) for message in messages) + CHAT_OUTPUT_TOKEN_ESTIMATE
+
+    @staticmethod
+    def _used_tokens(result):
+        usage = (result.llm_output or {}).get("token_usage") or {}
+        return usage.get("total_tokens")
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return self._scheduler().call(lambda: self.chat._generate(messages, stop=stop, **kwargs),
+                                      self._reserve(messages), current_priority(self.priority), used_tokens=self._used_tokens)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        return await self._scheduler().acall(lambda: self.chat._agenerate(messages, stop=stop, **kwargs),
+                                             self._reserve(messages), current_priority(self.priority), used_tokens=self._used_tokens)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        # A stream is retried only while nothing has been yielded from it
+        for attempt in itertools.count():
+            started = False
+            try:
+                with self._scheduler().slot(self._reserve(messages), current_priority(self.priority)):
+                    for chunk in self.chat._stream(messages, stop=stop, **kwargs):
+                        started = True
+                        if run_manager:
+                            run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                        yield chunk
+                return
+            except Exception as e:
+                if started or attempt >= OPENAI_MAX_RETRIES or not is_retryable_error(e):
+                    mark_retried(e)
+                    raise
+                self._scheduler()._count_retry(e)
+            time.sleep(retry_delay(attempt))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        for attempt in itertools.count():
+            started = False
+            try:
+                async with self._scheduler().aslot(self._reserve(messages), current_priority(self.priority)):
+                    async for chunk in self.chat._astream(messages, stop=stop, **kwargs):
+                        started = True
+                        if run_manager:
+                            await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                        yield chunk
+                return
+            except Exception as e:
+                if started or attempt >= OPENAI_MAX_RETRIES or not is_retryable_error(e):
+                    mark_retried(e)
+                    raise
+                self._scheduler()._count_retry(e)
+            await asyncio.sleep(retry_delay(attempt))
+
+
+def scheduled_embeddings(embeddings, priority=INTERACTIVE):
+    """
+    embeddings behind the shared scheduler, or unchanged when OPENAI_SCHEDULER_ENABLED is off.
+    Build OpenAI embeddings with max_retries=OPENAI_CLIENT_MAX_RETRIES, so the scheduler sees their 429s.
+    """
+    return ScheduledEmbeddings(embeddings, priority) if SCHEDULER_ENABLED else embeddings
+
+def scheduled_chat(chat, priority=INTERACTIVE):
+    """
+    chat behind the shared scheduler, or unchanged when OPENAI_SCHEDULER_ENABLED is off.
+    Build ChatOpenAI with max_retries=OPENAI_CLIENT_MAX_RETRIES, so the scheduler sees its 429s.
+    """
+    return ScheduledChatModel(chat=chat, priority=priority) if SCHEDULER_ENABLED else chat
@@ -4,16 +4,27 @@ Goal: process documents, then put into Vector Store, "PineCone"
 """
 
 # Import Statements:
+# LangChain, Pinecone, OpenAI, PyPDF2 and the embedding cache are imported inside the functions that use them,
+# so importing this module does not pay their startup cost.
 import os
+import json
+import time
+import queue
+import hashlib
 import logging
+import itertools
+import random
+import threading
+import contextvars
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from dotenv import load_dotenv
-from langchain_community.document_loaders import PDFMinerLoader, PyPDFLoader, UnstructuredPDFLoader
-from langchain.schema import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_pinecone import PineconeVectorStore
-from langchain_openai import OpenAIEmbeddings
-from pinecone import Pinecone
-import PyPDF2
+
+# Code from other files:
+from source_manifest import SourceManifest
+from telemetry import current_span, record, span, timed
 
 # Load environment variables
 load_dotenv()
@@ -22,6 +33,38 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 logger = logging.getLogger(__name__)
 
+# Number of worker processes used to parse documents; 1 parses in the main process
+LOAD_WORKERS = int(os.environ.get("LOAD_WORKERS", "1"))
+
+# PDF loaders, in the order they are tried for a file with no memo entry
+PDF_LOADERS = ["PDFMinerLoader", "PyPDFLoader", "UnstructuredPDFLoader"]
+# Wall-clock limit per loader attempt, in seconds; 0 runs loaders inline with no limit
+PDF_LOADER_TIMEOUT = float(os.environ.get("PDF_LOADER_TIMEOUT", "120"))
+PDF_LOADER_MEMO_FILE = '.pdf_loader_memo.json'  # Lives inside the downloads directory
+PDF_WORKER_START_TIMEOUT = 120  # Seconds the loader worker may take to start and import the loaders
+
+# Streaming ingestion: at most LOAD_WINDOW_PER_WORKER parsed files per worker are held
+# in memory ahead of the splitter
+LOAD_WINDOW_PER_WORKER = 2
+
+# Upsert engine: chunks are embedded EMBED_BATCH_SIZE at a time and written to the index
+# UPSERT_BATCH_SIZE at a time by UPSERT_WORKERS threads; retryable errors back off
+# exponentially from UPSERT_BACKOFF seconds, up to UPSERT_MAX_RETRIES times
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "256"))
+UPSERT_BATCH_SIZE = int(os.environ.get("UPSERT_BATCH_SIZE", "100"))
+UPSERT_WORKERS = int(os.environ.get("UPSERT_WORKERS", "4"))
+UPSERT_MAX_RETRIES = 5
+UPSERT_BACKOFF = 1.0
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# Chunking settings; changing them invalidates every chunk recorded in the ingest ledger
+CHUNK_SIZE = 1000  # Reduced from 2000
+CHUNK_OVERLAP = 200  # Reduced from 300
+INGEST_LEDGER_FILE = '.ingest_ledger.{index_name}.json'  # Lives inside the downloads directory
+# Content version of a Pinecone index, stored with it so serving hosts without the ledger can read it
+INDEX_VERSION_NAMESPACE = 'index-version'
+INDEX_VERSION_ID = 'index-version'
+
 
 # -------------- Part 1: Functions and Classes -------------- #
 
@@ -39,129 +82,956 @@ class EncodingMarkdownLoader:
         """
         Some doc string here
         """
+        from langchain.schema import Document
+
         with open(self.file_path, 'r', encoding='utf-8') as file:
             text = file.read()
         metadata = {"source": self.file_path}
         return [Document(page_content=text, metadata=metadata)]
 
-def load_pdf(file_path):
+def _run_pdf_loader(loader_name, file_path):
+    from langchain_community import document_loaders
+
+    loader = getattr(document_loaders, loader_name)(file_path)
+    return loader.load()
+
+def _pdf_loader_worker(requests, results):
     """
-    Handle loading using langchain loaders, for PDF files.
+    Body of the PDF loader worker process: import the loaders once, then run jobs until told to stop.
+    """
+    try:
+        import langchain_community.document_loaders  # noqa: F401
+    except Exception:
+        pass
+    results.put(("ready", None))
+    for loader_name, file_path in iter(requests.get, None):
+        try:
+            results.put(("ok", _run_pdf_loader(loader_name, file_path)))
+        except Exception as e:
+            results.put(("error", f"{type(e).__name__}: {e}"))
+
+def process_context():
+    """
+    Context for worker processes. Forking a process that already runs threads (the upsert
+    engine's, the scheduler's) can deadlock the child, so workers start from a clean interpreter.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+class PdfLoaderWorker:
+    """
+    One long-lived process that runs PDF loaders with the loader stack already imported.
+    A loader that overruns its timeout gets the process killed; the next job starts a new one.
+    """
+    def __init__(self):
+        self.process = None
+        self.lock = threading.Lock()
+
+    def _start(self, timeout):
+        context = process_context()
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(target=_pdf_loader_worker, args=(self.requests, self.results), daemon=True)
+        self.process.start()
+        # Importing the loaders does not count against a job's timeout
+        self._receive("PDF loader worker", max(timeout, PDF_WORKER_START_TIMEOUT))
+
+    def _receive(self, what, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self.results.get(timeout=min(0.5, max(deadline - time.monotonic(), 0.01)))
+            except queue.Empty:
+                if not self.process.is_alive():
+                    exitcode = self.process.exitcode
+                    self.stop()
+                    raise RuntimeError(f"{what} process exited with code {exitcode}")
+                if time.monotonic() >= deadline:
+                    self.stop()
+                    raise TimeoutError(f"{what} timed out after {timeout:g}s")
+
+    def ensure_started(self, timeout):
+        """
+        Start the process if it is not running. Returns the seconds spent starting it (0 if it was running).
+        """
+        with self.lock:
+            if self.process is not None and self.process.is_alive():
+                return 0.0
+            start = time.perf_counter()
+            self._start(timeout)
+            seconds = time.perf_counter() - start
+        logger.info(f"Started the PDF loader worker in {seconds:.2f}s")
+        return seconds
+
+    def run(self, loader_name, file_path, timeout):
+        with self.lock:
+            if self.process is None or not self.process.is_alive():
+                self._start(timeout)
+            self.requests.put((loader_name, file_path))
+            status, payload = self._receive(loader_name, timeout)
+        if status == "error":
+            raise RuntimeError(payload)
+        return payload
+
+    def stop(self):
+        if self.process is not None:
+            if self.process.is_alive():
+                self.process.kill()
+            self.process.join()
+            self.process = None
+
+_pdf_worker = PdfLoaderWorker()
+
+def run_pdf_loader(loader_name, file_path, timeout=PDF_LOADER_TIMEOUT):
+    """
+    Run one langchain PDF loader on a file. With a timeout the loader runs in a worker
+    process that is killed once the limit passes, so a pathological PDF cannot hang
+    the run. Raises TimeoutError on timeout and RuntimeError if the loader fails.
+    """
+    if not timeout:
+        return _run_pdf_loader(loader_name, file_path)
+    return _pdf_worker.run(loader_name, file_path, timeout)
+
+def load_pdf_with_attempts(file_path, preferred_loader=None, timeout=PDF_LOADER_TIMEOUT):
+    """
+    Try the PDF loaders in turn, starting with preferred_loader when given.
+    Returns (documents, attempts) where attempts lists (loader_name, outcome, seconds)
+    and outcome is "success", "failure" or "timeout". Starting the loader worker is not
+    counted in the seconds of the attempt that needed it.
     """
-    loaders = [PDFMinerLoader, PyPDFLoader, UnstructuredPDFLoader]
-    for loader_class in loaders:
+    loaders = list(PDF_LOADERS)
+    if preferred_loader in loaders:
+        loaders.remove(preferred_loader)
+        loaders.insert(0, preferred_loader)
+    
+    attempts = []
+    for loader_name in loaders:
+        start = time.perf_counter()
         try:
-            loader = loader_class(file_path)
-            return loader.load()
+            if timeout:
+                _pdf_worker.ensure_started(timeout)
+                start = time.perf_counter()
+            documents = run_pdf_loader(loader_name, file_path, timeout)
+            outcome = "success"
+        except TimeoutError:
+            outcome = "timeout"
         except Exception:
-            pass
+            outcome = "failure"
+        attempts.append((loader_name, outcome, time.perf_counter() - start))
+        if outcome == "success":
+            return documents, attempts
     logger.error(f"All PDF loaders failed for {file_path}")
-    return []
+    return [], attempts
 
-def load_documents(directory):
+def load_pdf(file_path, preferred_loader=None):
     """
-    Handle document loading for both PDF and Markdown files, from a directory.
+    Handle loading using langchain loaders, for PDF files.
+    """
+    return load_pdf_with_attempts(file_path, preferred_loader)[0]
+
+class PdfLoaderMemo:
+    """
+    Persistent memo of which loader last worked for each PDF (by content hash), plus
+    cumulative per-loader telemetry: attempts, successes, failures, timeouts and latency.
+    """
+    def __init__(self, directory):
+        self.path = os.path.join(directory, PDF_LOADER_MEMO_FILE)
+        self.winners = {}
+        self.stats = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.winners = data.get('winners', {})
+                self.stats = data.get('stats', {})
+            except Exception as e:
+                logger.info(f"Ignoring unreadable PDF loader memo {self.path}: {e}")
+
+    def preferred_loader(self, content_hash):
+        return self.winners.get(content_hash)
+
+    def record(self, content_hash, attempts):
+        for loader_name, outcome, seconds in attempts:
+            stats = self.stats.setdefault(loader_name, {"attempts": 0, "success": 0, "failure": 0, "timeout": 0, "seconds": 0.0})
+            stats["attempts"] += 1
+            stats[outcome] += 1
+            stats["seconds"] += seconds
+            if outcome == "success":
+                self.winners[content_hash] = loader_name
+
+    def log_summary(self):
+        for loader_name in PDF_LOADERS:
+            stats = self.stats.get(loader_name)
+            if stats and stats["attempts"]:
+                mean_ms = 1000 * stats["seconds"] / stats["attempts"]
+                logger.info(f"{loader_name}: {stats['success']}/{stats['attempts']} succeeded, "
+                            f"{stats['timeout']} timed out, mean {mean_ms:.0f} ms per attempt")
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'winners': self.winners, 'stats': self.stats}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+def file_content_hash(file_path, manifest=None):
+    """
+    Content hash of a file, taken from the manifest when available.
     """
+    entry = manifest.lookup(file_path) if manifest is not None else None
+    if entry and entry.get('content_hash'):
+        return entry['content_hash']
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def resolve_source_url(file_path, manifest=None):
+    """
+    Find the source URL of a downloaded file: one manifest lookup, falling back to the
+    PDF metadata or Markdown header for files downloaded before the manifest existed.
+    """
+    source_url = manifest.source_url(file_path) if manifest is not None else None
+    if source_url:
+        return source_url
+    if file_path.lower().endswith('.pdf'):
+        import PyPDF2
+
+        with open(file_path, 'rb') as pdf_file:
+            metadata = PyPDF2.PdfReader(pdf_file).metadata or {}
+            return metadata.get('/SourceURL', file_path)
+    with open(file_path, 'r', encoding='utf-8') as md_file:
+        first_line = md_file.readline().strip()
+    if first_line.startswith('<!-- Source URL:'):
+        return first_line.replace('<!-- Source URL: ', '').replace(' -->', '')
+    return file_path
+
+def load_file(file_path, source_url=None, preferred_loader=None):
+    """
+    Load a single PDF or Markdown file and stamp its Documents with the source URL.
+    Runs in worker processes, so it never raises: returns (status, documents, error, attempts)
+    where status is "processed", "unsupported" or "error", and attempts are the loader attempts
+    as (loader_name, outcome, seconds).
+    """
+    file_extension = os.path.splitext(file_path)[1].lower()
+    attempts = []
+    try:
+        if file_extension == '.pdf':
+            file_documents, attempts = load_pdf_with_attempts(file_path, preferred_loader)
+        elif file_extension == '.md':
+            start = time.perf_counter()
+            loader = EncodingMarkdownLoader(file_path)
+            file_documents = loader.load()
+            attempts = [("EncodingMarkdownLoader", "success", time.perf_counter() - start)]
+        else:
+            return "unsupported", [], None, attempts
+        
+        # Update metadata with correct source URL, resolved once per file rather than per page,
+        # and only when there are documents to stamp (an unreadable PDF has none)
+        if file_documents:
+            source_url = source_url or resolve_source_url(file_path)
+            for doc in file_documents:
+                doc.metadata['source'] = source_url
+        return "processed", file_documents, None, attempts
+    except Exception as e:
+        return "error", [], str(e), attempts
+
+def load_file_isolated(job):
+    """
+    Run load_file for one job in its own single-worker pool, so a native crash only loses this file.
+    """
+    try:
+        with ProcessPoolExecutor(max_workers=1, mp_context=process_context()) as executor:
+            return executor.submit(load_file, *job).result()
+    except BrokenProcessPool:
+        return ("error", [], "worker process crashed", [])
+
+def iter_load_results(jobs, workers):
+    """
+    Run load_file over an iterable of (file_path, source_url, preferred_loader) jobs in a
+    process pool, yielding results in job order. Only a bounded window of jobs is in
+    flight at once, so memory does not grow with the number of files.
+    If a worker process dies (e.g. a native crash inside a PDF library), the pool is
+    replaced, the job at the head of the queue is retried on its own, and the rest of
+    the in-flight jobs are resubmitted, so only the culprit is lost.
+    """
+    jobs = iter(jobs)
+    window = workers * LOAD_WINDOW_PER_WORKER
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=process_context())
+    
+    def submit(job):
+        # A pool that has just broken refuses new work; None marks the job for resubmission
+        try:
+            return executor.submit(load_file, *job)
+        except BrokenProcessPool:
+            return None
+    
+    def finished(future):
+        return future is not None and future.done() and future.exception() is None
+    
+    pending = deque()
+    try:
+        while True:
+            for job in itertools.islice(jobs, window - len(pending)):
+                pending.append((job, submit(job)))
+            if not pending:
+                return
+            job, future = pending.popleft()
+            try:
+                if future is None:
+                    raise BrokenProcessPool("process pool is not usable anymore")
+                yield future.result()
+            except BrokenProcessPool:
+                executor.shutdown(wait=True)
+                executor = ProcessPoolExecutor(max_workers=workers, mp_context=process_context())
+                yield load_file_isolated(job)
+                pending = deque(
+                    (pending_job, pending_future if finished(pending_future) else submit(pending_job))
+                    for pending_job, pending_future in pending
+                )
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def list_document_files(downloads_dir):
+    """
+    Files in the downloads directory that are candidates for loading, in sorted order.
+    """
+    return [
+        filename for filename in sorted(os.listdir(downloads_dir))
+        # Skip bookkeeping files such as the manifest and fetch cache
+        if not filename.startswith('.') and os.path.isfile(os.path.join(downloads_dir, filename))
+    ]
+
+def iter_documents(directory, workers=None, only_files=None):
+    """
+    Handle document loading for both PDF and Markdown files, from a directory, yielding
+    (filename, documents) one file at a time. When only_files is given, other files are
+    left unread. With workers > 1 files are parsed in a process
+    pool; output order and counters are the same as a serial run (files are taken in
+    sorted filename order). PDFs go straight to the loader that last worked for the same
+    content, per the loader memo.
+    """
+    workers = workers or LOAD_WORKERS
     script_dir = os.path.dirname(os.path.abspath(__file__))
     downloads_dir = os.path.join(script_dir, directory)
     
     if not os.path.exists(downloads_dir):
         logger.error(f"The directory {downloads_dir} does not exist.")
-        return []
+        return
     
-    documents = []
+    manifest = SourceManifest(downloads_dir)
+    loader_memo = PdfLoaderMemo(downloads_dir)
     total_files = 0
     processed_files = 0
     skipped_files = 0
+    total_documents = 0
     
-    for filename in os.listdir(downloads_dir):
-        total_files += 1
-        file_path = os.path.join(downloads_dir, filename)
-        if os.path.isfile(file_path):
-            file_extension = os.path.splitext(filename)[1].lower()
-            try:
-                if file_extension == '.pdf':
-                    file_documents = load_pdf(file_path)
-                    processed_files += 1
-                elif file_extension == '.md':
-                    loader = EncodingMarkdownLoader(file_path)
-                    file_documents = loader.load()
-                    processed_files += 1
-                else:
-                    logger.info(f"Skipping unsupported file: {filename}")
-                    skipped_files += 1
-                    continue
-                
-                # Update metadata with correct source URL
-                for doc in file_documents:
-                    if file_extension == '.pdf':
-                        # For PDFs, read the SourceURL from metadata
-                        with open(file_path, 'rb') as pdf_file:
-                            pdf_reader = PyPDF2.PdfReader(pdf_file)
-                            source_url = pdf_reader.metadata.get('/SourceURL', file_path)
-                    elif file_extension == '.md':
-                        # For Markdown, read the first line for the source URL
-                        with open(file_path, 'r', encoding='utf-8') as md_file:
-                            first_line = md_file.readline().strip()
-                            source_url = first_line.replace('<!-- Source URL: ', '').replace(' -->', '') if first_line.startswith('<!-- Source URL:') else file_path
-                    
-                    doc.metadata['source'] = source_url
-                
-                documents.extend(file_documents)
-                logger.info(f"Successfully processed: {filename}")
-            except Exception as e:
-                logger.error(f"Error loading {filename}: {e}")
-                skipped_files += 1
+    filenames = list_document_files(downloads_dir)
+    if only_files is not None:
+        filenames = [filename for filename in filenames if filename in only_files]
+    total_files = len(filenames)
+    
+    pdf_hashes = {}
+    
+    def make_jobs():
+        for filename in filenames:
+            file_path = os.path.join(downloads_dir, filename)
+            preferred_loader = None
+            if filename.lower().endswith('.pdf'):
+                pdf_hashes[filename] = file_content_hash(file_path, manifest)
+                preferred_loader = loader_memo.preferred_loader(pdf_hashes[filename])
+            yield (file_path, manifest.source_url(filename), preferred_loader)
+    
+    if workers > 1 and len(filenames) > 1:
+        results = iter_load_results(make_jobs(), workers)
+    else:
+        results = (load_file(*job) for job in make_jobs())
+    
+    for filename, (status, file_documents, error, attempts) in zip(filenames, results):
+        if filename in pdf_hashes:
+            loader_memo.record(pdf_hashes[filename], attempts)
+        # Parsing may have run in a worker process, so record the time it measured there
+        record("ingest.parse", sum(seconds for _, _, seconds in attempts), files=1,
+               documents=len(file_documents), errors=int(status == "error"))
+        if status == "processed":
+            processed_files += 1
+            total_documents += len(file_documents)
+            logger.info(f"Successfully processed: {filename}")
+            yield filename, file_documents
+        elif status == "unsupported":
+            logger.info(f"Skipping unsupported file: {filename}")
+            skipped_files += 1
+        else:
+            logger.error(f"Error loading {filename}: {error}")
+            skipped_files += 1
     
     logger.info(f"Total files in directory: {total_files}")
     logger.info(f"Successfully processed files: {processed_files}")
     logger.info(f"Skipped or errored files: {skipped_files}")
-    logger.info(f"Total documents loaded: {len(documents)}")
-    
+    logger.info(f"Total documents loaded: {total_documents}")
+    loader_memo.log_summary()
+    loader_memo.save()
+
+def load_documents(directory, workers=None):
+    """
+    Handle document loading for both PDF and Markdown files, from a directory.
+    Returns every Document at once; see iter_documents for the streaming version.
+    """
+    documents = []
+    for _, file_documents in iter_documents(directory, workers):
+        documents.extend(file_documents)
     return documents
 
 
+def make_text_splitter():
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    return RecursiveCharacterTextSplitter(
+        separators=["\n\n", "\n", " ", ""],
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        length_function=len,
+    )
+
+
+def iter_chunks(document_batches, splitter=None):
+    """
+    Split each batch of Documents as it arrives, yielding chunks one at a time.
+    """
+    splitter = splitter or make_text_splitter()
+    for documents in document_batches:
+        yield from splitter.split_documents(documents)
+
+
 def text_splitter(documents):
-    total_splits = []    
-    for doc in documents:
-        splitter = RecursiveCharacterTextSplitter(
-            separators=["\n\n", "\n", " ", ""],
-            chunk_size=1000,  # Reduced from 2000
-            chunk_overlap=200,  # Reduced from 300
-            length_function=len,
-        )
-        
-        splits = splitter.split_documents([doc])
-        total_splits.extend(splits)
-    return total_splits
+    return list(iter_chunks([documents]))
+
+
+def batched(iterable, size):
+    """
+    Yield lists of up to size items from an iterable.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def chunk_id(chunk):
+    """
+    Deterministic vector ID for a chunk: a hash of its source URL and of its content.
+    """
+    content_hash = hashlib.sha256(chunk.page_content.encode('utf-8')).hexdigest()
+    return hashlib.sha256(f"{chunk.metadata.get('source', '')}\n{content_hash}".encode('utf-8')).hexdigest()[:40]
+
+
+def content_version(chunk_ids, sources):
+    """
+    Content version of an index: a hash of its chunk IDs (each hashes a chunk's source and text)
+    and of the source lists ({id: [url, ...]}) of chunks that duplicates were folded into.
+    A run that changes nothing keeps the version, so caches keyed by it survive the run.
+    """
+    digest = hashlib.sha256("\n".join(sorted(chunk_ids)).encode('utf-8'))
+    digest.update(json.dumps({record_id: sorted(set(urls)) for record_id, urls in sources.items()},
+                             sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class IngestLedger:
+    """
+    Local record of what has been ingested into one index: for every file, the content
+    hash it had, the chunking settings it was split with and the IDs of the chunks it
+    produced. Lets a run parse only changed files, upsert only new chunks and delete the
+    vectors of chunks that went away.
+    """
+    def __init__(self, directory, index_name, dedup_settings=None):
+        self.path = os.path.join(directory, INGEST_LEDGER_FILE.format(index_name=index_name))
+        # Switching chunk dedup on or off, or changing its settings, changes which chunks are indexed
+        self.chunking = f"{CHUNK_SIZE}/{CHUNK_OVERLAP}" + (f" dedup {dedup_settings}" if dedup_settings else "")
+        self.files = {}
+        # Vector IDs that must still be deleted from the index, kept across interrupted runs
+        self.pending_deletes = set()
+        self.exists = os.path.exists(self.path)
+        if self.exists:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.files = data.get('files', {})
+            self.pending_deletes = set(data.get('pending_deletes', []))
+            # Older ledgers kept one chunking key for the whole file
+            for entry in self.files.values():
+                entry.setdefault('chunking', data.get('chunking'))
+
+    def is_current(self, filename, content_hash):
+        # Chunking is kept per file, so a run interrupted after a settings change still redoes the rest
+        entry = self.files.get(filename)
+        return entry is not None and entry['content_hash'] == content_hash and entry['chunking'] == self.chunking
+
+    def chunk_ids(self, filename):
+        entry = self.files.get(filename)
+        return entry['chunk_ids'] if entry else []
+
+    def set_file(self, filename, content_hash, chunk_ids):
+        self.files[filename] = {'content_hash': content_hash, 'chunking': self.chunking, 'chunk_ids': chunk_ids}
+
+    def remove_file(self, filename):
+        self.files.pop(filename, None)
+
+    def live_chunk_ids(self):
+        return {chunk_id for entry in self.files.values() for chunk_id in entry['chunk_ids']}
+
+    def reset(self):
+        self.files = {}
+        self.pending_deletes = set()
+
+    def save(self):
+        self.exists = True
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'files': self.files, 'pending_deletes': sorted(self.pending_deletes)}, f)
+        os.replace(tmp_path, self.path)
 
 
 def is_index_empty(index_name):
+    from pinecone import Pinecone
+
     pc = Pinecone(api_key=os.environ.get("PINECONE_API_KEY"))
     index = pc.Index(index_name)
     stats = index.describe_index_stats()
-    return stats.total_vector_count == 0
+    # The index version record lives in its own namespace and is not a document
+    version_records = (stats.namespaces or {}).get(INDEX_VERSION_NAMESPACE)
+    return stats.total_vector_count - (version_records.vector_count if version_records else 0) == 0
 
+def read_pinecone_index_version(index_name):
+    """
+    The content version process_documents stored with a Pinecone index, or None if it has none.
+    """
+    from pinecone import Pinecone
+
+    index = Pinecone(api_key=os.environ.get("PINECONE_API_KEY")).Index(index_name)
+    record = index.fetch(ids=[INDEX_VERSION_ID], namespace=INDEX_VERSION_NAMESPACE).vectors.get(INDEX_VERSION_ID)
+    return (record.metadata or {}).get('version') if record is not None else None
+
+
+class PineconeVectorSink:
+    """
+    Writes precomputed vectors straight to a Pinecone index, in the same layout as
+    PineconeVectorStore (chunk text under the "text" metadata key), so the retriever
+    in main.py reads them unchanged.
+    """
+    def __init__(self, index_name, text_key="text"):
+        from pinecone import Pinecone
+
+        self.index_name = index_name
+        self.text_key = text_key
+        self.index = Pinecone(api_key=os.environ.get("PINECONE_API_KEY")).Index(index_name)
+
+    def is_empty(self):
+        return is_index_empty(self.index_name)
+
+    def upsert(self, records):
+        vectors = [
+            {"id": record_id, "values": vector, "metadata": {**metadata, self.text_key: text}}
+            for record_id, vector, text, metadata in records
+        ]
+        self.index.upsert(vectors=vectors)
+
+    def update_metadata(self, updates):
+        for record_id, metadata in updates.items():
+            self.index.update(id=record_id, set_metadata=metadata)
+
+    def delete(self, ids):
+        self.index.delete(ids=list(ids))
 
-def process_documents():
+    def delete_all(self):
+        self.index.delete(delete_all=True)
+
+    def set_version(self, version):
+        """
+        Store the index's content version as a record in its own namespace, out of the retriever's way.
+        """
+        dimension = self.index.describe_index_stats().dimension
+        self.index.upsert(vectors=[{"id": INDEX_VERSION_ID, "values": [1.0] + [0.0] * (dimension - 1),
+                                    "metadata": {"version": version}}], namespace=INDEX_VERSION_NAMESPACE)
+
+    def close(self):
+        pass
+
+
+class InMemoryVectorSink:
     """
-    Handle document processing, then put into Vector Store, "PineCone"
+    In-process stand-in for PineconeVectorSink, for tests and offline runs.
+    Can be told to fail the first few upserts with a retryable error.
     """
-    documents = load_documents("downloads")
-    logger.info(f"Processed {len(documents)} documents")
+    def __init__(self, fail_first=0):
+        self.vectors = {}
+        self.version = None
+        self.upsert_calls = 0
+        self.fail_first = fail_first
+        self.lock = threading.Lock()
+
+    def is_empty(self):
+        return not self.vectors
+
+    def upsert(self, records):
+        with self.lock:
+            self.upsert_calls += 1
+            if self.upsert_calls <= self.fail_first:
+                raise ConnectionError("simulated transient upsert failure")
+            for record_id, vector, text, metadata in records:
+                self.vectors[record_id] = (vector, text, metadata)
+
+    def update_metadata(self, updates):
+        with self.lock:
+            for record_id, metadata in updates.items():
+                if record_id in self.vectors:
+                    vector, text, current = self.vectors[record_id]
+                    self.vectors[record_id] = (vector, text, {**current, **metadata})
+
+    def delete(self, ids):
+        with self.lock:
+            for record_id in ids:
+                self.vectors.pop(record_id, None)
+
+    def delete_all(self):
+        with self.lock:
+            self.vectors.clear()
+
+    def set_version(self, version):
+        self.version = version
+
+    def close(self):
+        pass
+
+
+def is_retryable(error):
+    """
+    Transient errors worth retrying: connection problems, timeouts, rate limits and 5xx responses.
+    Errors the OpenAI scheduler already retried (see openai_scheduler.mark_retried) are not retried again.
+    """
+    if getattr(error, "scheduler_retried", False):
+        return False
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    status = getattr(error, "status", None) or getattr(error, "status_code", None)
+    if status is None and getattr(error, "response", None) is not None:
+        status = getattr(error.response, "status_code", None)
+    if status is not None:
+        try:
+            return int(status) in RETRYABLE_STATUS_CODES
+        except (TypeError, ValueError):
+            return False
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError", "RateLimitError", "ServiceException")
+
+
+class UpsertEngine:
+    """
+    Embeds and upserts chunks in batches on a bounded pool of worker threads.
+    add() blocks once 2 * workers batches are in flight, so a fast producer cannot run
+    ahead of the index. Retryable errors are retried with exponential backoff and jitter;
+    a batch that still fails is reported and left for the next run. Finished chunks'
+    tags are handed back through completed_tags() for the caller's bookkeeping.
+    """
+    def __init__(self, sink, embeddings, embed_batch_size=EMBED_BATCH_SIZE, upsert_batch_size=UPSERT_BATCH_SIZE,
+                 workers=UPSERT_WORKERS, max_retries=UPSERT_MAX_RETRIES, backoff=UPSERT_BACKOFF):
+        self.sink = sink
+        self.embeddings = embeddings
+        self.embed_batch_size = embed_batch_size
+        self.upsert_batch_size = upsert_batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers * 2)
+        self.futures = []
+        self.buffer = []
+        self.completed = queue.Queue()
+        self.lock = threading.Lock()
+        self.upserted_chunks = 0
+        self.upserted_bytes = 0
+        self.failed_chunks = 0
+        self.retries = 0
+        self.errors = []
+        self.dimensions = 0
+        self.started = time.perf_counter()
+
+    def add(self, record_id, chunk, tag=None):
+        self.buffer.append((record_id, chunk, tag))
+        if len(self.buffer) >= self.embed_batch_size:
+            self._submit()
+
+    def _submit(self):
+        batch, self.buffer = self.buffer, []
+        self.slots.acquire()
+        # Run in a copy of the caller's context, so the batch's spans nest under the ingestion span
+        future = self.executor.submit(contextvars.copy_context().run, self._process, batch)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures = [f for f in self.futures if not f.done()] + [future]
+
+    def _with_retry(self, function, *args):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return function(*args)
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    raise
+                with self.lock:
+                    self.retries += 1
+                current_span().add("retries")
+                time.sleep(self.backoff * (2 ** attempt) * (0.5 + random.random()))
+
+    def _process(self, batch):
+        done = 0
+        try:
+            texts = [chunk.page_content for _, chunk, _ in batch]
+            with span("ingest.embed") as stage:
+                vectors = self._with_retry(self.embeddings.embed_documents, texts)
+                self.dimensions = len(vectors[0]) if vectors else self.dimensions
+                stage.add("chunks", len(texts))
+                stage.add("bytes", sum(len(text.encode('utf-8')) for text in texts))
+            for start in range(0, len(batch), self.upsert_batch_size):
+                part = batch[start:start + self.upsert_batch_size]
+                records = [(record_id, vector, chunk.page_content, chunk.metadata)
+                           for (record_id, chunk, _), vector in zip(part, vectors[start:start + self.upsert_batch_size])]
+                with span("ingest.upsert") as stage:
+                    self._with_retry(self.sink.upsert, records)
+                    stage.add("vectors", len(records))
+                with self.lock:
+                    self.upserted_chunks += len(part)
+                    self.upserted_bytes += sum(len(text.encode('utf-8')) + 4 * len(vector) for _, vector, text, _ in records)
+                self.completed.put([tag for _, _, tag in part])
+                done += len(part)
+        except Exception as e:
+            with self.lock:
+                self.failed_chunks += len(batch) - done
+                self.errors.append(e)
+            logger.error(f"Upsert batch failed after retries: {e}")
+
+    def completed_tags(self):
+        """
+        Tags of chunks upserted since the last call.
+        """
+        tags = []
+        while True:
+            try:
+                tags.extend(self.completed.get_nowait())
+            except queue.Empty:
+                return tags
+
+    def flush(self):
+        """
+        Submit the partial batch and wait for every in-flight batch to finish.
+        """
+        if self.buffer:
+            self._submit()
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+    def update_metadata(self, updates):
+        """
+        Rewrite record metadata in batches across the worker pool, retrying like upserts.
+        Raises the first batch's error once every batch has finished.
+        """
+        parts = [dict(part) for part in batched(updates.items(), self.upsert_batch_size)]
+        futures = [self.executor.submit(contextvars.copy_context().run, self._with_retry, self.sink.update_metadata, part)
+                   for part in parts]
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+    def report(self):
+        seconds = max(time.perf_counter() - self.started, 1e-9)
+        return {
+            "chunks": self.upserted_chunks,
+            "bytes": self.upserted_bytes,
+            "failed_chunks": self.failed_chunks,
+            "retries": self.retries,
+            "seconds": seconds,
+            "chunks_per_sec": self.upserted_chunks / seconds,
+            "bytes_per_sec": self.upserted_bytes / seconds,
+        }
+
+
+@timed("ingest.process_documents")
+def process_documents(rebuild=False, sink=None, embeddings=None, backend=None, downloads_dir=None):
+    """
+    Handle document processing, then put into Vector Store, "PineCone".
+    Only files whose content changed since the last run are parsed; their new chunks are
+    embedded and upserted under deterministic IDs by the upsert engine, and vectors of
+    chunks that no longer exist are deleted. rebuild=True wipes the index and ledger and
+    ingests everything. embeddings default to cached OpenAI embeddings, and sink to the
+    index of the chosen backend: "pinecone" or "local" (see local_vector_store.VECTOR_BACKEND).
+    downloads_dir defaults to the downloads folder next to this file.
+    """
+    from local_vector_store import VECTOR_BACKEND, LocalVectorSink
+    from chunk_dedup import CHUNK_DEDUP_ENABLED, ChunkDeduplicator
+
+    backend = backend or VECTOR_BACKEND
+    index_name = os.environ["INDEX_NAME"] if backend == "pinecone" else "local"
+    downloads_dir = downloads_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), "downloads")
+    if not os.path.exists(downloads_dir):
+        logger.error(f"The directory {downloads_dir} does not exist.")
+        return
     
-    text_split_chunks = text_splitter(documents)
+    if embeddings is None:
+        from embedding_cache import cached_embeddings
+        from openai_scheduler import BATCH
+
+        # Ingestion yields to live care-plan requests for the shared OpenAI rate limits
+        embeddings = cached_embeddings("text-embedding-3-large", priority=BATCH)
+    if sink is None:
+        sink = PineconeVectorSink(index_name) if backend == "pinecone" else LocalVectorSink()
+    dedup = ChunkDeduplicator(downloads_dir, index_name) if CHUNK_DEDUP_ENABLED else None
+    ledger = IngestLedger(downloads_dir, index_name, dedup.settings if dedup else None)
     
-    if is_index_empty(os.environ["INDEX_NAME"]):
-        logger.info("Ingesting documents into vector store...")
-        embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
-        PineconeVectorStore.from_documents(text_split_chunks, embeddings, index_name=os.environ["INDEX_NAME"])
-        logger.info("Document ingestion complete.")
-    else:
-        logger.info("Vector store already contains documents. Skipping ingestion.")
+    if rebuild:
+        logger.info("Rebuilding: deleting all vectors from the index...")
+        if not sink.is_empty():
+            sink.delete_all()
+        ledger.reset()
+        if dedup:
+            dedup.reset()
+    elif not ledger.exists and not sink.is_empty():
+        # Vectors from before the ledger have random IDs we cannot reconcile against
+        logger.info("Vector store already contains documents but has no ingest ledger. "
+                    "Run once with --rebuild (process_documents.py or ingestion_pipeline.py) "
+                    "to switch to incremental ingestion.")
+        return
+    
+    # Work out which files changed since the last run
+    manifest = SourceManifest(downloads_dir)
+    current_hashes = {filename: file_content_hash(os.path.join(downloads_dir, filename), manifest)
+                      for filename in list_document_files(downloads_dir)}
+    changed_files = {filename for filename, content_hash in current_hashes.items()
+                     if not ledger.is_current(filename, content_hash)}
+    removed_files = [filename for filename in ledger.files if filename not in current_hashes]
+    logger.info(f"Files unchanged since last ingest: {len(current_hashes) - len(changed_files)}, "
+                f"changed or new: {len(changed_files)}, removed: {len(removed_files)}")
+    
+    for filename in removed_files:
+        ledger.pending_deletes.update(ledger.chunk_ids(filename))
+        ledger.remove_file(filename)
+        if dedup:
+            dedup.forget_file(filename)
+    ledger.save()
+    
+    # Stream changed files -> chunks -> upsert engine. A file is only written to the
+    # ledger once all of its new chunks have been upserted, so an interrupted or
+    # partially failed run picks up where it stopped. A sink that only writes its index
+    # in close() (the local index) holds the ledger back until then too.
+    splitter = make_text_splitter()
+    engine = UpsertEngine(sink, embeddings)
+    pending_files = {}
+    save_as_committed = not getattr(sink, "writes_on_close", False)
+    
+    def commit_finished_files():
+        for filename in engine.completed_tags():
+            pending_files[filename][0] -= 1
+        finished = [filename for filename, (remaining, _, _) in pending_files.items() if remaining == 0]
+        for filename in finished:
+            _, content_hash, chunk_ids = pending_files.pop(filename)
+            ledger.set_file(filename, content_hash, chunk_ids)
+        if finished:
+            if save_as_committed:
+                ledger.save()
+            logger.info(f"Upserted {engine.upserted_chunks} chunks so far")
+    
+    try:
+        for filename, documents in iter_documents(downloads_dir, only_files=changed_files):
+            old_ids = set(ledger.chunk_ids(filename))
+            chunk_ids = []
+            new_chunks = []
+            with span("ingest.split") as stage:
+                chunks = splitter.split_documents(documents)
+                stage.add("documents", len(documents))
+                stage.add("chunks", len(chunks))
+                stage.add("bytes", sum(len(chunk.page_content.encode('utf-8')) for chunk in chunks))
+            if dedup:
+                dedup.forget_file(filename)
+            for chunk in chunks:
+                new_id = chunk_id(chunk)
+                duplicate = False
+                if dedup:
+                    # A duplicate is not embedded; the file references the chunk it duplicates instead
+                    new_id, duplicate = dedup.resolve(new_id, chunk, filename)
+                if new_id in chunk_ids:
+                    continue
+                chunk_ids.append(new_id)
+                if new_id not in old_ids and not duplicate:
+                    new_chunks.append((new_id, chunk))
+            ledger.pending_deletes.update(old_ids - set(chunk_ids))
+            pending_files[filename] = [len(new_chunks), current_hashes[filename], chunk_ids]
+            for new_id, chunk in new_chunks:
+                engine.add(new_id, chunk, tag=filename)
+            commit_finished_files()
+    finally:
+        engine.flush()
+        commit_finished_files()
+        if dedup:
+            dedup.save()
+    
+    try:
+        # Chunks can be shared across files, so only delete IDs nothing references any more
+        stale_ids = sorted(ledger.pending_deletes - ledger.live_chunk_ids())
+        with span("ingest.delete") as stage:
+            for batch in batched(stale_ids, UPSERT_BATCH_SIZE):
+                sink.delete(batch)
+            stage.add("vectors", len(stale_ids))
+        if dedup:
+            # Canonical chunks list the sources of every duplicate folded into them; the rewrites
+            # share the upsert engine's worker pool and retries
+            source_updates = dedup.source_updates(ledger.live_chunk_ids())
+            with span("ingest.update_sources") as stage:
+                engine.update_metadata(source_updates)
+                stage.add("vectors", len(source_updates))
+            dedup.save()
+    finally:
+        engine.close()
+    live_ids = ledger.live_chunk_ids()
+    sources = {record_id: dedup.sources(record_id) for record_id in live_ids if dedup and record_id in dedup.chunks}
+    sink.set_version(content_version(live_ids, sources))
+    with span("ingest.close"):
+        sink.close()
+    ledger.pending_deletes = set()
+    ledger.save()
+    
+    report = engine.report()
+    current_span().add("files_changed", len(changed_files))
+    current_span().add("chunks_upserted", report['chunks'])
+    current_span().add("chunks_failed", report['failed_chunks'])
+    logger.info(f"Document ingestion complete: {report['chunks']} chunks upserted, {len(stale_ids)} deleted.")
+    logger.info(f"Upsert throughput: {report['chunks_per_sec']:.1f} chunks/sec, "
+                f"{report['bytes_per_sec'] / 1024:.1f} KiB/sec over {report['seconds']:.1f}s, {report['retries']} retries")
+    if report['failed_chunks']:
+        logger.error(f"{report['failed_chunks']} chunks failed to upsert; their files will be retried on the next run.")
+    if dedup:
+        dedup_report = dedup.report(engine.dimensions)
+        current_span().add("chunks_deduplicated", dedup_report['duplicates'])
+        logger.info(f"Chunk dedup: {dedup_report['duplicates']} of {dedup_report['chunks']} chunks were duplicates "
+                    f"({dedup_report['exact_duplicates']} exact, {dedup_report['near_duplicates']} near), "
+                    f"saving about {dedup_report['embedding_tokens_saved']} embedding tokens and "
+                    f"{dedup_report['index_bytes_saved'] / 1024:.1f} KiB of index space; "
+                    f"{len(source_updates)} chunks had their sources updated")
+    if hasattr(embeddings, "cache"):
+        cache_stats = embeddings.cache.stats()
+        logger.info(f"Embedding cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['evictions']} evictions")
+    scheduled = getattr(embeddings, "embeddings", embeddings)
+    if hasattr(scheduled, "scheduler"):
+        scheduler_stats = scheduled.scheduler.stats()
+        logger.info(f"OpenAI scheduler: {scheduler_stats['batch_calls']} batch calls, waited {scheduler_stats['batch_wait_seconds']:.1f}s, "
+                    f"{scheduler_stats['rate_limited']} rate limited, concurrency limit {scheduler_stats['concurrency_limit']}")
 
 # -------------- Part 2: Main Control -------------- #
 
 # If running this file directly...
 if __name__ == "__main__":
-    process_documents()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Ingest the downloaded documents into the vector store.")
+    parser.add_argument("--rebuild", action="store_true", help="Delete every vector and the ingest ledger, then ingest everything")
+    process_documents(rebuild=parser.parse_args().rebuild)
@@ -0,0 +1,77 @@
+"""
+source_manifest.py
+Goal: keep track of where every downloaded file came from, in a sidecar manifest next to the downloads
+"""
+
+# Import Statements:
+import os
+import json
+import time
+import threading
+
+# Configuration
+MANIFEST_FILE = '.manifest.jsonl'  # Lives inside the downloads directory
+
+
+class SourceManifest:
+    """
+    Append-only JSON-lines manifest mapping each downloaded file (by basename) to its
+    source URL, content hash and type. The whole manifest is read once into a dict,
+    so each lookup afterwards is O(1). Later lines override earlier ones for the same file.
+    """
+    def __init__(self, directory):
+        self.path = os.path.join(directory, MANIFEST_FILE)
+        self.directory = directory
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A run that crashed mid-write can leave a partial last line
+                        continue
+                    self.entries[entry['file']] = entry
+
+    def record(self, file_path, source_url, content_hash, file_type):
+        """
+        Record the provenance of a file. Appends one line; nothing else is rewritten.
+        """
+        entry = {
+            'file': os.path.basename(file_path),
+            'source_url': source_url,
+            'content_hash': content_hash,
+            'type': file_type,
+            'recorded_at': int(time.time()),
+        }
+        with self.lock:
+            self.entries[entry['file']] = entry
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+        return entry
+
+    def lookup(self, file_path):
+        return self.entries.get(os.path.basename(file_path))
+
+    def source_url(self, file_path, default=None):
+        entry = self.lookup(file_path)
+        return entry['source_url'] if entry else default
+
+    def compact(self):
+        """
+        Rewrite the manifest with one line per file that still exists on disk.
+        """
+        with self.lock:
+            self.entries = {
+                name: entry for name, entry in self.entries.items()
+                if os.path.exists(os.path.join(self.directory, name))
+            }
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry) + '\n')
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,272 @@
+"""
+telemetry.py
+Goal: see where the time goes in ingestion and care-plan generation
+
+Spans time a stage and carry counters (items, bytes, LLM tokens). Finished spans are appended
+to a JSON-lines file and summed per stage for a Prometheus text endpoint. Off by default; when
+TELEMETRY_ENABLED is not "1", span() hands back one shared no-op object, so instrumented code
+costs a function call and nothing else.
+"""
+
+# Import Statements:
+import os
+import json
+import time
+import functools
+import itertools
+import threading
+import contextvars
+
+# Configuration
+TELEMETRY_ENABLED = os.environ.get("TELEMETRY_ENABLED", "0") == "1"
+TELEMETRY_FILE = os.environ.get(
+    "TELEMETRY_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telemetry.jsonl'),
+)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))  # Serve Prometheus text on this port; 0 for no endpoint
+METRIC_PREFIX = "frailty"
+
+_current = contextvars.ContextVar("telemetry_span", default=None)
+_span_ids = itertools.count(1)
+
+
+class NoopSpan:
+    """
+    Stands in for a span when telemetry is off.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def add(self, counter, amount=1):
+        pass
+
+    def set(self, **attributes):
+        pass
+
+    def callbacks(self):
+        return []
+
+NOOP_SPAN = NoopSpan()
+
+
+class Span:
+    """
+    One timed stage. add() accumulates counters, set() attaches attributes; both are safe
+    to call from several threads. Spans opened inside another span in the same thread or
+    task record it as their parent; work handed to a thread pool keeps its parent when
+    submitted through contextvars.copy_context().run.
+    """
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.counters = {}
+        self.span_id = next(_span_ids)
+        parent = _current.get()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.status = "ok"
+        self._token = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        seconds = time.perf_counter() - self.start
+        try:
+            _current.reset(self._token)
+        except ValueError:
+            # Closed from another context, e.g. an abandoned streaming generator finalized later
+            pass
+        if exc_type is not None:
+            self.status = "error"
+            self.attributes["error"] = f"{exc_type.__name__}: {exc}"
+        get_telemetry().finish(self, seconds)
+        return False
+
+    def add(self, counter, amount=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def set(self, **attributes):
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def callbacks(self):
+        """
+        LangChain callbacks that add the token usage of LLM calls to this span.
+        """
+        return [token_usage_handler(self)]
+
+
+def span(name, **attributes):
+    """
+    Time the enclosed block as stage name: `with span("ingest.embed") as s: ... s.add("chunks", n)`.
+    """
+    if not TELEMETRY_ENABLED:
+        return NOOP_SPAN
+    return Span(name, attributes)
+
+def timed(name):
+    """
+    Decorator: run the function inside span(name).
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not TELEMETRY_ENABLED:
+                return function(*args, **kwargs)
+            with Span(name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def current_span():
+    """
+    The innermost open span, or the no-op span, for adding counters without passing the span around.
+    """
+    if not TELEMETRY_ENABLED:
+        return NOOP_SPAN
+    return _current.get() or NOOP_SPAN
+
+def record(name, seconds, **counters):
+    """
+    Record a stage timed elsewhere, e.g. parsing measured inside a worker process.
+    """
+    if not TELEMETRY_ENABLED:
+        return
+    finished = Span(name, {})
+    finished.start_time = time.time() - seconds
+    finished.counters = counters
+    get_telemetry().finish(finished, seconds)
+
+def token_usage_handler(target):
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class TokenUsageHandler(BaseCallbackHandler):
+        def on_llm_end(self, response, **kwargs):
+            usage = (response.llm_output or {}).get("token_usage") or {}
+            prompt_tokens = usage.get("prompt_tokens")
+            completion_tokens = usage.get("completion_tokens")
+            if prompt_tokens is None:
+                # Streamed and wrapped models report usage on the messages instead
+                prompt_tokens = completion_tokens = 0
+                for generations in response.generations:
+                    for generation in generations:
+                        metadata = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                        prompt_tokens += metadata.get("input_tokens", 0)
+                        completion_tokens += metadata.get("output_tokens", 0)
+            target.add("llm_calls")
+            target.add("prompt_tokens", prompt_tokens or 0)
+            target.add("completion_tokens", completion_tokens or 0)
+
+    return TokenUsageHandler()
+
+
+class Telemetry:
+    """
+    Sink for finished spans: appends each as a JSON line to path, and keeps per-stage
+    totals (calls, errors, seconds, counters) for prometheus_text().
+    """
+    def __init__(self, path=TELEMETRY_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.file = open(path, 'a', encoding='utf-8') if path else None
+
+    def finish(self, finished, seconds):
+        line = json.dumps({
+            "name": finished.name,
+            "span_id": finished.span_id,
+            "parent_id": finished.parent_id,
+            "start": finished.start_time,
+            "seconds": seconds,
+            "status": finished.status,
+            "attributes": finished.attributes,
+            "counters": finished.counters,
+        }, default=str)
+        with self.lock:
+            stage = self.stages.setdefault(finished.name, {"calls": 0, "errors": 0, "seconds": 0.0, "counters": {}})
+            stage["calls"] += 1
+            stage["errors"] += finished.status == "error"
+            stage["seconds"] += seconds
+            for counter, amount in finished.counters.items():
+                stage["counters"][counter] = stage["counters"].get(counter, 0) + amount
+            if self.file is not None:
+                self.file.write(line + '\n')
+                self.file.flush()
+
+    def prometheus_text(self):
+        """
+        Per-stage totals in the Prometheus text exposition format.
+        """
+        with self.lock:
+            stages = {name: dict(stage, counters=dict(stage["counters"])) for name, stage in sorted(self.stages.items())}
+        lines = [
+            f"# HELP {METRIC_PREFIX}_stage_seconds Time spent in each stage.",
+            f"# TYPE {METRIC_PREFIX}_stage_seconds summary",
+        ]
+        for name, stage in stages.items():
+            lines.append(f'{METRIC_PREFIX}_stage_seconds_sum{{stage="{name}"}} {stage["seconds"]:.6f}')
+            lines.append(f'{METRIC_PREFIX}_stage_seconds_count{{stage="{name}"}} {stage["calls"]}')
+        lines += [
+            f"# HELP {METRIC_PREFIX}_stage_errors_total Stage runs that raised.",
+            f"# TYPE {METRIC_PREFIX}_stage_errors_total counter",
+        ]
+        for name, stage in stages.items():
+            lines.append(f'{METRIC_PREFIX}_stage_errors_total{{stage="{name}"}} {stage["errors"]}')
+        lines += [
+            f"# HELP {METRIC_PREFIX}_stage_counter_total Items, bytes and tokens counted in each stage.",
+            f"# TYPE {METRIC_PREFIX}_stage_counter_total counter",
+        ]
+        for name, stage in stages.items():
+            for counter, amount in sorted(stage["counters"].items()):
+                lines.append(f'{METRIC_PREFIX}_stage_counter_total{{stage="{name}",counter="{counter}"}} {amount}')
+        return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(port, telemetry=None):
+    """
+    Serve prometheus_text() at http://<host>:port/metrics from a daemon thread.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = (telemetry or get_telemetry()).prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+
+def get_telemetry():
+    """
+    The process-wide telemetry sink, opened on first use; also starts the metrics endpoint if METRICS_PORT is set.
+    """
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            _telemetry = Telemetry()
+            if METRICS_PORT:
+                start_metrics_server(METRICS_PORT, _telemetry)
+        return _telemetry
@@ -0,0 +1,45 @@
+"""
+test_import_time.py
+Goal: guard startup latency, importing the retrieval and ingestion modules must stay cheap
+
+Each import runs in a fresh interpreter, so modules already loaded by pytest do not hide the cost.
+"""
+
+# Import Statements:
+import os
+import sys
+import json
+import subprocess
+import pytest
+
+# Configuration
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_BUDGET_SECONDS = float(os.environ.get("IMPORT_BUDGET_SECONDS", "1.0"))
+HEAVY_MODULES = ("langchain", "langchain_core", "langchain_community", "langchain_openai", "langchain_pinecone",
+                 "pinecone", "openai", "googleapiclient", "google.oauth2", "bs4", "html2text", "chardet",
+                 "requests", "PyPDF2", "numpy", "tiktoken")
+
+MEASURE = """
+import sys, json, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+heavy = sorted(name for name in sys.modules if any(name == prefix or name.startswith(prefix + ".") for prefix in {heavy!r}))
+print(json.dumps({{"seconds": seconds, "heavy": heavy}}))
+"""
+
+
+def measure_import(module):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get("PYTHONPATH")])))
+    result = subprocess.run([sys.executable, "-c", MEASURE.format(module=module, heavy=HEAVY_MODULES)],
+                            cwd=REPO_DIR, env=env, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize("module", ["initial_retrieval", "process_documents"])
+def test_import_is_cheap(module):
+    pytest.importorskip("dotenv")
+    measured = measure_import(module)
+    assert measured["heavy"] == [], f"importing {module} loaded {measured['heavy']}"
+    assert measured["seconds"] < IMPORT_BUDGET_SECONDS, f"importing {module} took {measured['seconds']:.2f}s"
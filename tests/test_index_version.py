@@ -0,0 +1,46 @@
+"""
+test_index_version.py
+Goal: the content version ingestion stores with the index changes with the chunks, not with every run
+"""
+
+# Import Statements:
+import pytest
+
+
+class FakeEmbeddings:
+    def embed_documents(self, texts):
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+def ingest(directory, sink):
+    from process_documents import process_documents
+
+    process_documents(sink=sink, embeddings=FakeEmbeddings(), backend="local", downloads_dir=directory)
+    return sink.version
+
+
+def test_version_is_stable_across_runs_and_follows_content(tmp_path):
+    pytest.importorskip("langchain.text_splitter")
+    from process_documents import InMemoryVectorSink
+
+    (tmp_path / "walking.md").write_text("Walk thirty minutes every day to keep up your strength.", encoding="utf-8")
+    (tmp_path / "falls.md").write_text("Remove loose rugs and add grab bars to prevent falls.", encoding="utf-8")
+    sink = InMemoryVectorSink()
+    first = ingest(str(tmp_path), sink)
+    assert first is not None
+    assert ingest(str(tmp_path), sink) == first
+
+    (tmp_path / "falls.md").write_text("Install night lights along the way to the bathroom.", encoding="utf-8")
+    assert ingest(str(tmp_path), sink) != first
+
+
+def test_local_index_stores_its_version(tmp_path):
+    pytest.importorskip("numpy")
+    from local_vector_store import LocalVectorSink, read_index_version
+
+    assert read_index_version(str(tmp_path)) is None
+    sink = LocalVectorSink(str(tmp_path))
+    sink.upsert([("a", [1.0, 0.0], "text", {})])
+    sink.set_version("v1")
+    sink.close()
+    assert read_index_version(str(tmp_path)) == "v1"
@@ -0,0 +1,54 @@
+"""
+test_local_vector_store.py
+Goal: a LocalVectorStore open during a rewrite must only ever see vectors and metadata from the same write
+"""
+
+# Import Statements:
+import os
+import json
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("langchain_core")
+
+
+def write_index(directory, texts, reset=False):
+    from local_vector_store import LocalVectorSink
+
+    sink = LocalVectorSink(directory, reset=reset)
+    sink.upsert([(f"id-{i}", np.eye(len(texts))[i], text, {"source": text}) for i, text in enumerate(texts)])
+    sink.close()
+
+
+def test_reader_picks_up_a_rewrite_with_the_same_row_count(tmp_path):
+    from local_vector_store import LocalVectorStore
+
+    directory = str(tmp_path)
+    write_index(directory, ["old first", "old second"])
+    store = LocalVectorStore(directory)
+    write_index(directory, ["new first", "new second"], reset=True)
+    [(doc, score)] = store.similarity_search_by_vector_with_score([0.0, 1.0], k=1)
+    assert doc.page_content == "new second"
+    assert score == pytest.approx(1.0)
+
+
+def test_old_generations_are_pruned(tmp_path):
+    directory = str(tmp_path)
+    for round_number in range(4):
+        write_index(directory, [f"text {round_number}"], reset=True)
+    generations = [name for name in os.listdir(directory) if name.startswith("generation-")]
+    assert len(generations) == 2
+
+
+def test_index_written_before_generations_is_read_and_replaced(tmp_path):
+    from local_vector_store import LocalVectorStore, VECTORS_FILE, METADATA_FILE
+
+    directory = str(tmp_path)
+    np.save(os.path.join(directory, VECTORS_FILE), np.eye(1, dtype=np.float32))
+    with open(os.path.join(directory, METADATA_FILE), "w", encoding="utf-8") as f:
+        f.write(json.dumps({"id": "legacy", "text": "legacy text", "metadata": {}}) + "\n")
+    store = LocalVectorStore(directory)
+    assert [doc.page_content for doc in store.similarity_search_by_vector([1.0], k=1)] == ["legacy text"]
+    write_index(directory, ["new text"])
+    assert not os.path.exists(os.path.join(directory, VECTORS_FILE))
+    assert sorted(doc.page_content for doc in store.similarity_search_by_vector([1.0], k=2)) == ["legacy text", "new text"]
@@ -0,0 +1,79 @@
+"""
+test_reconversion.py
+Goal: a page converted again after a CONVERTER_VERSION bump must be re-ingested, not left as the old Markdown
+"""
+
+# Import Statements:
+import pytest
+
+# Configuration
+URL = "https://example.org/frailty/exercise"
+PAGE = b"<html><body><nav>MENU HOME ABOUT</nav><p>Walk thirty minutes every day to keep up your strength.</p></body></html>"
+
+
+class FakeResponse:
+    def __init__(self):
+        self.status_code = 200
+        self.headers = {'Content-Type': 'text/html; charset=utf-8', 'ETag': '"v1"'}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield PAGE
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    def get(self, url, headers=None, **kwargs):
+        # The page never changes on the server
+        return FakeResponse()
+
+
+class FakeRecorder:
+    def record(self, url, filename):
+        return None
+
+
+class FakeEmbeddings:
+    def embed_documents(self, texts):
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+def indexed_text(sink):
+    return " ".join(text for _, text, _ in sink.vectors.values())
+
+
+def test_reconverted_page_is_reupserted(tmp_path, monkeypatch):
+    pytest.importorskip("html2text")
+    pytest.importorskip("langchain.text_splitter")
+    import initial_retrieval
+    from source_manifest import SourceManifest
+    from process_documents import InMemoryVectorSink, process_documents
+
+    downloads = str(tmp_path)
+    sink = InMemoryVectorSink()
+
+    def download():
+        cache = initial_retrieval.FetchCache(downloads)
+        filename = initial_retrieval.download_and_save(URL, downloads, FakeSession(), cache, FakeRecorder(),
+                                                       SourceManifest(downloads))
+        cache.save()
+        return filename
+
+    # An older converter that kept the navigation
+    monkeypatch.setattr(initial_retrieval, "CONVERTER_VERSION", 1)
+    monkeypatch.setattr(initial_retrieval, "html_to_markdown",
+                        lambda html: initial_retrieval.make_html2text(strip_boilerplate=False).handle(html))
+    first = download()
+    process_documents(sink=sink, embeddings=FakeEmbeddings(), backend="local", downloads_dir=downloads)
+    assert "MENU" in indexed_text(sink)
+
+    monkeypatch.undo()
+    second = download()
+    assert second == first
+    process_documents(sink=sink, embeddings=FakeEmbeddings(), backend="local", downloads_dir=downloads)
+    assert "MENU" not in indexed_text(sink)
+    assert "thirty minutes" in indexed_text(sink)